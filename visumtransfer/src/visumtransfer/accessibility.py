@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Mapping, Union
+
+import numpy as np
+import pandas as pd
+
+from visumtransfer.visum_table import VisumTransfer
+from visumtransfer.visum_tables import Zone
+
+
+class Accessibilities:
+    """
+    calculate the accessibilities of params.accessibilities offline
+
+    In Visum, the accessibility of a zone is
+    LN([MATROWSUM(no)]) of the formula-matrix
+    EXP(Matrix([CODE] = "<matname_logsum>")) * TO[<potential>].
+    This is calculated here as the log-sum-exp over the rows of the
+    logsum-matrix plus the log of the potential, which does not overflow
+    for large logsums. The matrices are processed in chunks of rows,
+    the accessibilities of the persongroups and activities in parallel threads.
+    """
+    chunksize = 1000
+
+    def __init__(self,
+                 accessibilities: pd.DataFrame,
+                 logsums: Mapping[str, Union[np.ndarray, str]],
+                 zones: pd.DataFrame,
+                 chunksize: int = None,
+                 max_workers: int = None):
+        """
+        Parameters
+        ----------
+        accessibilities : pd.DataFrame
+            the params.accessibilities with the matname_logsum, the potential
+            and the zone_attribute
+        logsums : Mapping
+            the logsum-matrices by matname_logsum, as array or as filename
+            of a .npy-file, which is opened as memory-map
+        zones : pd.DataFrame
+            the zone attributes with the potentials, with the zone numbers
+            as index in the order of the matrices
+        chunksize : int, optional
+            the number of rows processed at once
+        max_workers : int, optional
+            the number of threads
+        """
+        self.accessibilities = accessibilities
+        self.logsums = {}
+        for code, array in logsums.items():
+            if isinstance(array, (str, os.PathLike)):
+                array = np.load(array, mmap_mode='r')
+            self.logsums[code] = array
+        self.zones = zones
+        #  the attribute names are not case-sensitive in Visum
+        self._zone_columns = {str(c).upper(): c for c in zones.columns}
+        if chunksize:
+            self.chunksize = chunksize
+        self.max_workers = max_workers
+
+    def get_potential(self, potential: str) -> np.ndarray:
+        """return the potential of the zones"""
+        try:
+            column = self._zone_columns[potential.upper()]
+        except KeyError:
+            raise KeyError(f'potential {potential} not in the zone attributes')
+        return self.zones[column].to_numpy(dtype='f8')
+
+    def calc(self, matname_logsum: str, potential: str) -> np.ndarray:
+        """
+        return the accessibility of each zone to the `potential`
+        by the logsum-matrix `matname_logsum`.
+        Zones, that reach no potential, get -inf like LN(0)
+        """
+        logsum = self.logsums[matname_logsum]
+        n = len(self.zones)
+        if logsum.shape != (n, n):
+            raise ValueError(f'logsum-matrix {matname_logsum} of shape '
+                             f'{logsum.shape} does not fit to {n} zones')
+        with np.errstate(divide='ignore'):
+            log_potential = np.log(self.get_potential(potential))
+        reachable = log_potential > -np.inf
+        log_potential = log_potential[reachable]
+        result = np.full(n, -np.inf)
+        if not reachable.any():
+            return result
+        for start in range(0, n, self.chunksize):
+            rows = slice(start, min(start + self.chunksize, n))
+            block = np.asarray(logsum[rows], dtype='f8')[:, reachable]
+            block += log_potential
+            result[rows] = self.logsumexp(block)
+        return result
+
+    @staticmethod
+    def logsumexp(block: np.ndarray) -> np.ndarray:
+        """
+        return log(sum(exp(block))) of each row, subtracting the maximum
+        of the row before the exponentiation. `block` is overwritten
+        """
+        maximum = block.max(axis=1)
+        finite = np.isfinite(maximum)
+        block[finite] -= maximum[finite, np.newaxis]
+        np.exp(block, out=block)
+        with np.errstate(divide='ignore'):
+            result = np.log(block.sum(axis=1))
+        result[finite] += maximum[finite]
+        result[~finite] = maximum[~finite]
+        return result
+
+    def calc_all(self) -> pd.DataFrame:
+        """
+        return the accessibilities of all rows of params.accessibilities
+        with the zone_attributes as columns and the zones as index
+        """
+        rows = self.accessibilities[['matname_logsum', 'potential',
+                                     'zone_attribute']].astype(str)
+        jobs = list(rows.itertuples(index=False))
+
+        def calc(job) -> np.ndarray:
+            return self.calc(job.matname_logsum, job.potential)
+
+        n_workers = min(self.max_workers or os.cpu_count() or 1,
+                        max(len(jobs), 1))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(calc, jobs))
+        return pd.DataFrame({job.zone_attribute: result
+                             for job, result in zip(jobs, results)},
+                            index=pd.Index(self.zones.index, name='NO'))
+
+    def to_table(self) -> Zone:
+        """
+        return the accessibilities as Zone-table to update the zones.
+        Visum cannot read -inf, so the accessibility of zones,
+        that reach no potential, is left empty
+        """
+        zones = Zone(mode='*')
+        zones.df = self.calc_all().replace(-np.inf, np.nan)
+        return zones
+
+    def add_to_transfer(self,
+                        vt: VisumTransfer,
+                        key: str = 'Erreichbarkeiten'):
+        """
+        add the accessibilities as Zone-table to the transfer,
+        empty for zones, that reach no potential
+        """
+        vt.tables[key] = self.to_table()
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Mapping, Union
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from visumtransfer.visum_table import VisumTable, VisumTransfer
+from visumtransfer.visum_tables import Activity, Mainzone, Zone
+from visumtransfer.matrix_io import Array, is_sparse, to_csr
+
+
+class BalancingResult:
+    """the balancing factors of the rows and columns of a matrix"""
+
+    def __init__(self,
+                 row_factors: np.ndarray,
+                 col_factors: np.ndarray,
+                 iterations: int,
+                 converged: bool):
+        self.row_factors = row_factors
+        self.col_factors = col_factors
+        self.iterations = iterations
+        self.converged = converged
+
+    def __repr__(self) -> str:
+        state = 'converged' if self.converged else 'not converged'
+        return f'BalancingResult {state} after {self.iterations} iterations'
+
+    def apply(self, matrix: Array) -> np.ndarray:
+        """return the balanced matrix"""
+        if isinstance(matrix, xr.DataArray):
+            matrix = matrix.data
+        if is_sparse(matrix):
+            matrix = to_csr(matrix).toarray()
+        return (self.row_factors[:, np.newaxis] * np.asarray(matrix) *
+                self.col_factors)
+
+
+class Furness:
+    """
+    balance matrices to the target trips of the origins and/or destinations
+    (Furness/IPF, Randsummenabgleich)
+
+    The factors are iterated until the correction factors target / actual
+    of all zones are within the thresholds of the RSA-converged attributes
+    of the Activities. The matrix itself is not changed, only the
+    row and column sums are calculated in chunks of rows.
+    Several matrices are balanced in parallel threads.
+    """
+    threshold_min = Activity.rsa_threshold_min
+    threshold_max = Activity.rsa_threshold_max
+    max_iterations = 100
+    chunksize = 1000
+
+    def __init__(self,
+                 threshold_min: float = None,
+                 threshold_max: float = None,
+                 max_iterations: int = None,
+                 chunksize: int = None,
+                 max_workers: int = None):
+        """
+        Parameters
+        ----------
+        threshold_min, threshold_max : float, optional
+            the range of the correction factors of a converged matrix
+        max_iterations : int, optional
+            the maximum number of iterations
+        chunksize : int, optional
+            the number of rows processed at once
+        max_workers : int, optional
+            the number of threads of `balance_all`
+        """
+        if threshold_min is not None:
+            self.threshold_min = threshold_min
+        if threshold_max is not None:
+            self.threshold_max = threshold_max
+        if max_iterations is not None:
+            self.max_iterations = max_iterations
+        if chunksize:
+            self.chunksize = chunksize
+        self.max_workers = max_workers
+
+    def iter_blocks(self, matrix: Array):
+        """yield the rows and the dense values of the blocks of rows"""
+        n = matrix.shape[0]
+        for start in range(0, n, self.chunksize):
+            rows = slice(start, min(start + self.chunksize, n))
+            block = matrix[rows]
+            if isinstance(block, xr.DataArray):
+                block = block.data
+            yield rows, np.asarray(block, dtype='f8')
+
+    def row_sums(self, matrix: Array, col_factors: np.ndarray) -> np.ndarray:
+        """the row sums of the matrix with the column factors"""
+        if is_sparse(matrix):
+            return matrix @ col_factors
+        result = np.empty(matrix.shape[0])
+        for rows, block in self.iter_blocks(matrix):
+            result[rows] = block @ col_factors
+        return result
+
+    def col_sums(self, matrix: Array, row_factors: np.ndarray) -> np.ndarray:
+        """the column sums of the matrix with the row factors"""
+        if is_sparse(matrix):
+            return matrix.T @ row_factors
+        result = np.zeros(matrix.shape[1])
+        for rows, block in self.iter_blocks(matrix):
+            result += row_factors[rows] @ block
+        return result
+
+    @staticmethod
+    def get_correction(target: np.ndarray, actual: np.ndarray) -> np.ndarray:
+        """
+        the correction factors target / actual,
+        1 for zones without actual trips like the ZONE_KF-formula
+        """
+        correction = np.ones(len(actual))
+        has_trips = actual > 0
+        correction[has_trips] = target[has_trips] / actual[has_trips]
+        return correction
+
+    def is_converged(self, correction: np.ndarray) -> bool:
+        """are all correction factors within the thresholds"""
+        if not len(correction):
+            return True
+        return (correction.min() >= self.threshold_min and
+                correction.max() <= self.threshold_max)
+
+    def balance(self,
+                matrix: Array,
+                origins: Iterable[float] = None,
+                destinations: Iterable[float] = None,
+                row_factors: Iterable[float] = None,
+                col_factors: Iterable[float] = None) -> BalancingResult:
+        """
+        balance the zone or mainzone matrix to the targets
+
+        Parameters
+        ----------
+        matrix : np.ndarray, np.memmap, DataArray or sparse matrix
+            the unbalanced matrix
+        origins : list of float, optional
+            the target trips from the origins
+        destinations : list of float, optional
+            the target trips to the destinations.
+            If origins are given as well, the destinations are scaled
+            to the total of the origins
+        row_factors, col_factors : list of float, optional
+            the factors of a previous run to start from
+
+        Returns
+        -------
+        result : BalancingResult
+        """
+        if origins is None and destinations is None:
+            raise ValueError('neither origins nor destinations given')
+        n_rows, n_cols = matrix.shape
+        if is_sparse(matrix):
+            matrix = to_csr(matrix)
+        if origins is not None:
+            origins = np.asarray(origins, dtype='f8')
+            if len(origins) != n_rows:
+                raise ValueError(f'{len(origins)} origins given '
+                                 f'for {n_rows} rows')
+        if destinations is not None:
+            destinations = np.asarray(destinations, dtype='f8')
+            if len(destinations) != n_cols:
+                raise ValueError(f'{len(destinations)} destinations given '
+                                 f'for {n_cols} columns')
+            if origins is not None and destinations.sum() > 0:
+                destinations = destinations * (origins.sum() /
+                                               destinations.sum())
+        row_factors = np.ones(n_rows) if row_factors is None \
+            else np.array(row_factors, dtype='f8')
+        col_factors = np.ones(n_cols) if col_factors is None \
+            else np.array(col_factors, dtype='f8')
+
+        iterations = 0
+        converged = False
+        while not converged and iterations < self.max_iterations:
+            converged = True
+            if origins is not None:
+                actual = row_factors * self.row_sums(matrix, col_factors)
+                correction = self.get_correction(origins, actual)
+                converged &= self.is_converged(correction)
+                row_factors *= correction
+            if destinations is not None:
+                actual = col_factors * self.col_sums(matrix, row_factors)
+                correction = self.get_correction(destinations, actual)
+                converged &= self.is_converged(correction)
+                col_factors *= correction
+            iterations += 1
+        return BalancingResult(row_factors, col_factors,
+                               iterations, converged)
+
+    def balance_all(self,
+                    matrices: Mapping[str, Array],
+                    origins: Mapping[str, Iterable[float]] = None,
+                    destinations: Mapping[str, Iterable[float]] = None,
+                    warm_start: Mapping[str, BalancingResult] = None,
+                    ) -> Dict[str, BalancingResult]:
+        """
+        balance the matrices by activity code in parallel threads
+
+        Parameters
+        ----------
+        matrices : Mapping
+            the unbalanced matrices by code
+        origins, destinations : Mapping, optional
+            the target trips by code
+        warm_start : Mapping, optional
+            the results of a previous run by code, e.g. from `read_factors`,
+            or the column factors
+
+        Returns
+        -------
+        results : dict
+            the BalancingResult by code
+        """
+        origins = origins or {}
+        destinations = destinations or {}
+        warm_start = warm_start or {}
+
+        def balance(code: str) -> BalancingResult:
+            previous = warm_start.get(code)
+            if isinstance(previous, BalancingResult):
+                row_factors = previous.row_factors
+                col_factors = previous.col_factors
+            else:
+                row_factors, col_factors = None, previous
+            return self.balance(matrices[code],
+                                origins=origins.get(code),
+                                destinations=destinations.get(code),
+                                row_factors=row_factors,
+                                col_factors=col_factors)
+
+        codes = list(matrices)
+        if not codes:
+            return {}
+        n_workers = min(self.max_workers or os.cpu_count() or 1, len(codes))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            return dict(zip(codes, executor.map(balance, codes)))
+
+    @staticmethod
+    def read_factors(table: Union[VisumTable, pd.DataFrame],
+                     codes: Iterable[str],
+                     prefix: str = 'BF_',
+                     row_prefix: str = 'BFQ_') -> Dict[str, BalancingResult]:
+        """
+        return the balancing factors BF_<code> of the destinations and
+        BFQ_<code> of the origins of a previous run from a Zone- or
+        Mainzone-table to warm-start `balance_all`.
+        Missing factors are 1, codes without any column are skipped
+        """
+        df = table.df if isinstance(table, VisumTable) else table
+        columns = {str(c).upper(): c for c in df.columns}
+
+        def get_factors(column_prefix: str, code: str) -> np.ndarray:
+            column = columns.get(f'{column_prefix}{code}'.upper())
+            if column is None:
+                return None
+            return pd.to_numeric(df[column]).fillna(1).to_numpy()
+
+        factors = {}
+        for code in codes:
+            col_factors = get_factors(prefix, code)
+            row_factors = get_factors(row_prefix, code)
+            if col_factors is None and row_factors is None:
+                continue
+            ones = np.ones(len(df))
+            factors[code] = BalancingResult(
+                ones if row_factors is None else row_factors,
+                ones if col_factors is None else col_factors,
+                iterations=0,
+                converged=False)
+        return factors
+
+    @staticmethod
+    def to_table(results: Mapping[str, BalancingResult],
+                 zones: Iterable[int],
+                 mainzones: bool = False,
+                 prefix: str = 'BF_',
+                 row_prefix: str = 'BFQ_') -> VisumTable:
+        """
+        return the column factors as attributes BF_<code> of a
+        Zone(mode='*') or Mainzone(mode='*')-table.
+        The row factors of results balanced to the origins are added
+        as attributes BFQ_<code>, which have to be defined in Visum.
+        Results balanced only to the destinations have no BFQ_-attribute
+        """
+        table = Mainzone(mode='*') if mainzones else Zone(mode='*')
+        factors = {}
+        for code, result in results.items():
+            factors[f'{prefix}{code}'] = result.col_factors
+        for code, result in results.items():
+            if not np.all(result.row_factors == 1):
+                factors[f'{row_prefix}{code}'] = result.row_factors
+        table.df = pd.DataFrame(
+            factors, index=pd.Index(np.asarray(zones), name='NO'))
+        return table
+
+    def add_to_transfer(self,
+                        vt: VisumTransfer,
+                        results: Mapping[str, BalancingResult],
+                        zones: Iterable[int],
+                        mainzones: bool = False,
+                        key: str = 'Bilanzfaktoren'):
+        """add the balancing factors as table to the transfer"""
+        vt.tables[key] = self.to_table(results, zones, mainzones=mainzones)
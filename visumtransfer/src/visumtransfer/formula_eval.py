@@ -0,0 +1,529 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+from typing import Dict, Iterable, List, Mapping, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from visumtransfer.visum_table import VisumTable
+from visumtransfer.formula_graph import FormulaGraph, Reference
+from visumtransfer.matrix_io import is_sparse, require_scipy, to_csr
+
+
+#  the compiled formula is a tree of tuples
+#  ('num', value), ('matrix', no or code), ('from', att), ('to', att),
+#  ('network', att), ('neg', a), ('op', operator, a, b),
+#  ('func', name, a, ...)
+Expression = Tuple
+
+
+class FormulaSyntaxError(ValueError):
+    """the formula could not be parsed"""
+
+
+class FormulaCompiler:
+    """
+    compile Visum matrix-formulas with a recursive descent parser
+
+    expression := or
+    or         := and ('|' and)*
+    and        := comparison ('&' comparison)*
+    comparison := sum (('<' | '<=' | '>' | '>=' | '=' | '<>') sum)?
+    sum        := product (('+' | '-') product)*
+    product    := unary (('*' | '/') unary)*
+    unary      := '-' unary | '+' unary | primary
+    primary    := number | '(' expression ')' | Matrix(condition)
+                | FROM[ATT] | TO[ATT] | [ATT] | FUNCTION(expression, ...)
+    """
+    _token = re.compile(r'\s*(?:(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+                        r'|(?P<attribute>\[[^\]]*\])'
+                        r'|(?P<string>"[^"]*")'
+                        r'|(?P<name>\w+)'
+                        r'|(?P<operator><=|>=|<>|[-+*/()<>=&|:,]))')
+    _comparisons = ('<', '<=', '>', '>=', '=', '<>')
+    functions = {
+        'POW': 2, 'EXP': 1, 'LN': 1, 'LOG': 1, 'SQRT': 1, 'ABS': 1,
+        'MIN': 2, 'MAX': 2, 'ROUND': 1, 'FLOOR': 1, 'CEIL': 1, 'IF': 3,
+        'TRANSPOSE': 1, 'MATRIXSUM': 1,
+    }
+
+    def __init__(self, resolve: callable):
+        """
+        Parameters
+        ----------
+        resolve : callable
+            returns the Expression for the condition of a Matrix(...)
+        """
+        self.resolve = resolve
+
+    def compile(self, formula: str) -> Expression:
+        """compile the formula into an Expression"""
+        self.formula = formula
+        self.tokens = self.tokenize(formula)
+        self.pos = 0
+        expression = self.parse_or()
+        if self.pos < len(self.tokens):
+            self.error('unexpected token')
+        return expression
+
+    def tokenize(self, formula: str) -> List[Tuple[str, str, int]]:
+        """return the tokens as (kind, text, position in formula)"""
+        tokens = []
+        pos = 0
+        formula = formula.rstrip()
+        while pos < len(formula):
+            match = self._token.match(formula, pos)
+            if not match:
+                raise FormulaSyntaxError(
+                    f'invalid character at {pos} in {formula}')
+            kind = match.lastgroup
+            text = match[kind]
+            tokens.append((kind, text, match.start(kind)))
+            pos = match.end()
+        return tokens
+
+    def error(self, msg: str):
+        if self.pos < len(self.tokens):
+            where = f'at {self.tokens[self.pos][2]}'
+        else:
+            where = 'at the end'
+        raise FormulaSyntaxError(f'{msg} {where} in {self.formula}')
+
+    def peek(self) -> str:
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][1]
+        return ''
+
+    def expect(self, text: str):
+        if self.peek() != text:
+            self.error(f'expected "{text}"')
+        self.pos += 1
+
+    def parse_or(self) -> Expression:
+        expression = self.parse_and()
+        while self.peek() == '|':
+            self.pos += 1
+            expression = ('op', '|', expression, self.parse_and())
+        return expression
+
+    def parse_and(self) -> Expression:
+        expression = self.parse_comparison()
+        while self.peek() == '&':
+            self.pos += 1
+            expression = ('op', '&', expression, self.parse_comparison())
+        return expression
+
+    def parse_comparison(self) -> Expression:
+        expression = self.parse_sum()
+        if self.peek() in self._comparisons:
+            operator = self.peek()
+            self.pos += 1
+            expression = ('op', operator, expression, self.parse_sum())
+        return expression
+
+    def parse_sum(self) -> Expression:
+        expression = self.parse_product()
+        while self.peek() in ('+', '-'):
+            operator = self.peek()
+            self.pos += 1
+            expression = ('op', operator, expression, self.parse_product())
+        return expression
+
+    def parse_product(self) -> Expression:
+        expression = self.parse_unary()
+        while self.peek() in ('*', '/'):
+            operator = self.peek()
+            self.pos += 1
+            expression = ('op', operator, expression, self.parse_unary())
+        return expression
+
+    def parse_unary(self) -> Expression:
+        if self.peek() == '-':
+            self.pos += 1
+            expression = self.parse_unary()
+            if expression[0] == 'num':
+                return ('num', -expression[1])
+            return ('neg', expression)
+        if self.peek() == '+':
+            self.pos += 1
+            return self.parse_unary()
+        return self.parse_primary()
+
+    def parse_primary(self) -> Expression:
+        if self.pos >= len(self.tokens):
+            self.error('unexpected end')
+        kind, text, start = self.tokens[self.pos]
+        self.pos += 1
+        if kind == 'number':
+            return ('num', float(text))
+        if kind == 'attribute':
+            return ('network', text[1:-1].strip().upper())
+        if text == '(':
+            expression = self.parse_or()
+            self.expect(')')
+            return expression
+        if kind != 'name':
+            self.pos -= 1
+            self.error('unexpected token')
+        name = text.upper()
+        if name in ('FROM', 'TO') and self.peek().startswith('['):
+            att = self.tokens[self.pos][1][1:-1].strip().upper()
+            self.pos += 1
+            return (name.lower(), att)
+        if name == 'MATRIX' and self.peek() == '(':
+            return self.parse_matrix()
+        if name in self.functions:
+            return self.parse_function(name)
+        self.pos -= 1
+        self.error(f'unknown function {text}')
+
+    def parse_matrix(self) -> Expression:
+        """the condition of Matrix(...) is taken as text"""
+        start = self.tokens[self.pos][2] + 1
+        depth = 0
+        while self.pos < len(self.tokens):
+            text = self.tokens[self.pos][1]
+            if text == '(':
+                depth += 1
+            elif text == ')':
+                depth -= 1
+                if not depth:
+                    cond = self.formula[start:self.tokens[self.pos][2]]
+                    self.pos += 1
+                    return self.resolve(cond.strip())
+            self.pos += 1
+        self.error('missing ")"')
+
+    def parse_function(self, name: str) -> Expression:
+        self.expect('(')
+        args = [self.parse_or()]
+        while self.peek() in (',', ':'):
+            self.pos += 1
+            args.append(self.parse_or())
+        self.expect(')')
+        if len(args) != self.functions[name]:
+            self.error(f'{name} expects {self.functions[name]} arguments')
+        return ('func', name) + tuple(args)
+
+
+class FormulaEvaluator:
+    """
+    evaluate the formulas of formula-matrices offline with numpy
+
+    The data-matrices are read from arrays, sparse matrices
+    or memory-mapped .npy-files, the zone attributes from vectors.
+    The formulas are evaluated in chunks of rows,
+    subexpressions occuring several times are calculated once per chunk.
+    """
+    chunksize = 1000
+
+    def __init__(self,
+                 matrices: Union[VisumTable, Iterable[VisumTable]],
+                 data: Mapping[Union[int, str], Union[np.ndarray, str]],
+                 zone_attributes: Mapping[str, np.ndarray] = None,
+                 network_attributes: Mapping[str, float] = None,
+                 userdefined: Iterable[VisumTable] = (),
+                 chunksize: int = None):
+        """
+        Parameters
+        ----------
+        matrices : Matrix-table or list of Matrix-tables
+            the matrix definitions with the formulas
+        data : Mapping
+            the data-matrices by number or code, as array, as sparse matrix
+            or as filename of a .npy-file, which is opened as memory-map.
+            Sparse matrices are densified only chunk by chunk.
+            Matrices not defined in `matrices` may be given by their code
+        zone_attributes : Mapping or pd.DataFrame, optional
+            vectors of the zone attributes used as FROM[ATT] and TO[ATT]
+        network_attributes : Mapping, optional
+            the network attributes used as [ATT]
+        userdefined : list of UserDefinedAttribute-tables, optional
+            the defaultvalues of the userdefined network attributes
+            are used, if not given in `network_attributes`
+        chunksize : int, optional
+            the number of rows evaluated at once
+        """
+        if isinstance(matrices, VisumTable):
+            matrices = [matrices]
+        userdefined = list(userdefined)
+        self.graph = FormulaGraph(matrices, userdefined)
+        self.data = {}
+        for key, array in data.items():
+            if isinstance(array, (str, os.PathLike)):
+                array = np.load(array, mmap_mode='r')
+            elif is_sparse(array):
+                #  the rows and columns of csr-matrices can be sliced
+                array = to_csr(array)
+            self.data[key] = array
+        self.zone_attributes = {
+            k.upper(): np.asarray(v, dtype='f8')
+            for k, v in (zone_attributes or {}).items()}
+        self.network_attributes = self.get_network_defaults(userdefined)
+        self.network_attributes.update(
+            {k.upper(): v for k, v in (network_attributes or {}).items()})
+        if chunksize:
+            self.chunksize = chunksize
+        self.compiler = FormulaCompiler(self.resolve)
+        self._compiled: Dict[int, Expression] = {}
+        self._compiling: List[int] = []
+        self._cache: Dict[tuple, np.ndarray] = {}
+        self._scalars: Dict[Expression, float] = {}
+
+    @staticmethod
+    def get_network_defaults(userdefined: List[VisumTable]) -> Dict[str, float]:
+        """the defaultvalues of the userdefined network attributes"""
+        defaults = {}
+        for table in userdefined:
+            df = table.df.reset_index()
+            if 'DEFAULTVALUE' not in df:
+                continue
+            is_network = df['OBJID'].str.upper() == 'NETWORK'
+            values = pd.to_numeric(df.loc[is_network, 'DEFAULTVALUE'],
+                                   errors='coerce')
+            for attid, value in zip(df.loc[is_network, 'ATTID'], values):
+                if not np.isnan(value):
+                    defaults[attid.upper()] = value
+        return defaults
+
+    @property
+    def n_zones(self) -> int:
+        for array in self.data.values():
+            return array.shape[0]
+        for vector in self.zone_attributes.values():
+            return len(vector)
+        raise ValueError('no matrix or zone attribute given')
+
+    def resolve(self, cond: str) -> Expression:
+        """return the Expression of the matrix referenced by the condition"""
+        nodes = self.graph.resolve(Reference('matrix', cond, cond))
+        if not nodes:
+            #  matrices of the Visum-Version may be given by their code
+            code = self.graph.parser.parse_condition(cond).get('CODE')
+            if code in self.data:
+                return ('matrix', code)
+        if len(nodes) != 1:
+            raise ValueError(f'Matrix({cond}) refers to {len(nodes)} '
+                             f'matrices, not exactly one')
+        return self.matrix_expression(nodes[0][1])
+
+    def matrix_expression(self, no: int) -> Expression:
+        """
+        return the Expression of matrix `no`: the data, if given,
+        otherwise the compiled formula of the matrix
+        """
+        code = self.graph.matrices['CODE'][no]
+        if no in self.data or code in self.data:
+            return ('matrix', no)
+        formula = self.graph.matrices['FORMULA'].get(no)
+        if not isinstance(formula, str) or not formula:
+            raise KeyError(f'no data given for matrix {no} ({code})')
+        return self.compile_matrix(no)
+
+    def compile_matrix(self, no: int) -> Expression:
+        """compile the formula of matrix `no`"""
+        try:
+            return self._compiled[no]
+        except KeyError:
+            pass
+        if no in self._compiling:
+            raise ValueError(f'cyclic formulas: {self._compiling + [no]}')
+        self._compiling.append(no)
+        try:
+            expression = FormulaCompiler(self.resolve).compile(
+                self.graph.matrices['FORMULA'][no])
+        finally:
+            self._compiling.pop()
+        self._compiled[no] = expression
+        return expression
+
+    def compile(self, formula: str) -> Expression:
+        """compile a formula"""
+        return self.compiler.compile(formula)
+
+    def evaluate(self,
+                 formula: Union[str, int],
+                 out: np.ndarray = None,
+                 sparse: bool = False) -> np.ndarray:
+        """
+        evaluate the formula or the formula-matrix with the number `formula`
+
+        Parameters
+        ----------
+        formula : str or int
+            the formula or the number of the formula-matrix
+        out : np.ndarray, optional
+            the array to write the result to, e.g. a np.memmap
+        sparse : bool, optional
+            collect the non-zero values of the chunks in a
+            scipy.sparse csr-matrix instead of a dense array
+
+        Returns
+        -------
+        out : np.ndarray or csr-matrix
+            the zone x zone matrix
+        """
+        if isinstance(formula, str):
+            expression = self.compile(formula)
+        else:
+            expression = self.compile_matrix(formula)
+        n = self.n_zones
+        if sparse:
+            if out is not None:
+                raise ValueError('no out-array for a sparse result')
+            blocks = []
+        elif out is None:
+            out = np.empty((n, n), dtype='f8')
+        cols = slice(0, n)
+        for start in range(0, n, self.chunksize):
+            rows = slice(start, min(start + self.chunksize, n))
+            self._cache.clear()
+            result = self.eval(expression, rows, cols)
+            result = np.broadcast_to(result, (rows.stop - rows.start, n))
+            if sparse:
+                blocks.append(require_scipy().csr_matrix(result))
+            else:
+                out[rows] = result
+        self._cache.clear()
+        if sparse:
+            return to_csr(require_scipy().vstack(blocks))
+        return out
+
+    def eval(self,
+             expression: Expression,
+             rows: slice,
+             cols: slice) -> Union[np.ndarray, float]:
+        """
+        evaluate the `expression` for the block of `rows` and `cols`.
+        The result may be a scalar or broadcastable to the block
+        """
+        kind = expression[0]
+        if kind == 'num':
+            return expression[1]
+        if kind == 'network':
+            try:
+                return self.network_attributes[expression[1]]
+            except KeyError:
+                raise KeyError(f'network attribute {expression[1]} not given')
+        if kind in ('from', 'to'):
+            try:
+                vector = self.zone_attributes[expression[1]]
+            except KeyError:
+                raise KeyError(f'zone attribute {expression[1]} not given')
+            if kind == 'from':
+                return vector[rows, np.newaxis]
+            return vector[np.newaxis, cols]
+        if kind == 'func' and expression[1] == 'MATRIXSUM':
+            return self.matrix_sum(expression[2])
+
+        key = (expression, rows.start, rows.stop, cols.start, cols.stop)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        if kind == 'matrix':
+            matrix = expression[1]
+            array = self.data.get(matrix)
+            if array is None:
+                array = self.data[self.graph.matrices['CODE'][matrix]]
+            result = array[rows, cols]
+            if is_sparse(result):
+                result = to_csr(result).toarray()
+            result = np.asarray(result, dtype='f8')
+        elif kind == 'neg':
+            result = -self.eval(expression[1], rows, cols)
+        elif kind == 'op':
+            result = self.operate(expression[1],
+                                  self.eval(expression[2], rows, cols),
+                                  self.eval(expression[3], rows, cols))
+        elif expression[1] == 'TRANSPOSE':
+            result = np.transpose(self.eval(expression[2], cols, rows))
+        else:
+            args = [self.eval(arg, rows, cols) for arg in expression[2:]]
+            result = self.call(expression[1], args)
+        self._cache[key] = result
+        return result
+
+    def matrix_sum(self, expression: Expression) -> float:
+        """the sum over the whole matrix, calculated once"""
+        try:
+            return self._scalars[expression]
+        except KeyError:
+            pass
+        n = self.n_zones
+        cache = self._cache
+        #  the rows of the sum are not the rows currently calculated
+        self._cache = {}
+        total = 0.
+        cols = slice(0, n)
+        for start in range(0, n, self.chunksize):
+            rows = slice(start, min(start + self.chunksize, n))
+            self._cache.clear()
+            result = self.eval(expression, rows, cols)
+            total += np.broadcast_to(result,
+                                     (rows.stop - rows.start, n)).sum()
+        self._cache = cache
+        self._scalars[expression] = total
+        return total
+
+    @staticmethod
+    def operate(operator: str, a, b):
+        """calculate the binary operation like Visum, True is 1"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if operator == '+':
+                return a + b
+            if operator == '-':
+                return a - b
+            if operator == '*':
+                return a * b
+            if operator == '/':
+                return np.divide(a, b)
+        if operator == '<':
+            result = np.less(a, b)
+        elif operator == '<=':
+            result = np.less_equal(a, b)
+        elif operator == '>':
+            result = np.greater(a, b)
+        elif operator == '>=':
+            result = np.greater_equal(a, b)
+        elif operator == '=':
+            result = np.equal(a, b)
+        elif operator == '<>':
+            result = np.not_equal(a, b)
+        elif operator == '&':
+            result = np.logical_and(a, b)
+        elif operator == '|':
+            result = np.logical_or(a, b)
+        else:
+            raise ValueError(f'unknown operator {operator}')
+        return result.astype('f8')
+
+    @staticmethod
+    def call(name: str, args: list):
+        """call the function `name`"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if name == 'POW':
+                return np.power(args[0], args[1])
+            if name == 'EXP':
+                return np.exp(args[0])
+            if name in ('LN', 'LOG'):
+                return np.log(args[0])
+            if name == 'SQRT':
+                return np.sqrt(args[0])
+        if name == 'ABS':
+            return np.abs(args[0])
+        if name == 'MIN':
+            return np.minimum(args[0], args[1])
+        if name == 'MAX':
+            return np.maximum(args[0], args[1])
+        if name == 'ROUND':
+            return np.round(args[0])
+        if name == 'FLOOR':
+            return np.floor(args[0])
+        if name == 'CEIL':
+            return np.ceil(args[0])
+        if name == 'IF':
+            return np.where(np.asarray(args[0]) != 0, args[1], args[2])
+        raise ValueError(f'unknown function {name}')
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set, Tuple
+
+import pandas as pd
+
+from visumtransfer.visum_table import VisumTable, VisumTransfer
+
+
+#  a node is ('MATRIX', no) or (OBJID, ATTID) of an attribute
+Node = Tuple[str, object]
+
+
+class Reference:
+    """a reference in a formula"""
+
+    def __init__(self, kind: str, text: str, key=None):
+        """
+        Parameters
+        ----------
+        kind : str
+            matrix, prefix, number, attribute or persongroup
+        text : str
+            the text of the reference in the formula
+        key : optional
+            the condition, code, number or (OBJID, ATTID) referenced
+        """
+        self.kind = kind
+        self.text = text
+        self.key = key
+
+    def __repr__(self) -> str:
+        return f'Reference {self.kind}: {self.text}'
+
+
+class FormulaParser:
+    """
+    find the references to matrices and attributes in Visum-formulas
+    """
+    _matrix_filter = re.compile(r'\bMATRIX\s*\((?P<cond>[^()]*)\)',
+                                re.IGNORECASE)
+    _condition = re.compile(
+        r'\[(?P<att>\w+)\]\s*=\s*(?:"(?P<text>[^"]*)"|(?P<number>[-\d.]+))')
+    _matrix_number = re.compile(
+        r'\[(?:MATROWSUM|MATCOLSUM)\(\s*(?P<no>\d+)\s*\)\]', re.IGNORECASE)
+    _numpersons = re.compile(r'\[NUMPERSONS\((?P<code>[^)]*)\)\]',
+                             re.IGNORECASE)
+    _table_lookup = re.compile(r'\bTABLELOOKUP\s*\(\s*(?P<objid>\w+)\s+'
+                               r'(?P<var>\w+)\s*[:,]', re.IGNORECASE)
+    _from_to = re.compile(r'\b(?P<direction>FROM|TO)\[(?P<att>\w+)\]',
+                          re.IGNORECASE)
+    _string = re.compile(r'"[^"]*"')
+    _attribute = re.compile(r'\[(?P<att>\w+)\]')
+
+    def parse(self,
+              formula: str,
+              objid: str = 'MATRIX',
+              zone_objid: str = 'ZONE') -> List[Reference]:
+        """
+        return the references in the `formula`
+
+        Parameters
+        ----------
+        formula : str
+            the formula
+        objid : str, optional
+            the object type of the formula. Attributes like [ATT] in a
+            matrix formula refer to the network, otherwise to the object
+        zone_objid : str, optional
+            the object type of FROM[ATT] and TO[ATT], the OBJECTTYPEREF of
+            the matrix
+        """
+        objid = objid.upper()
+        references = []
+
+        def remove(pattern: re.Pattern, text: str, add) -> str:
+            def replace(match: re.Match) -> str:
+                add(match)
+                return ' '
+            return pattern.sub(replace, text)
+
+        def add_matrix_filter(match: re.Match):
+            cond = match['cond'].strip()
+            if re.fullmatch(r'\[NO\]\s*=\s*\d+', cond, re.IGNORECASE):
+                no = int(cond.split('=')[1])
+                references.append(Reference('number', match[0], no))
+            else:
+                references.append(Reference('matrix', match[0], cond))
+
+        def add_number(match: re.Match):
+            references.append(Reference('number', match[0], int(match['no'])))
+
+        def add_numpersons(match: re.Match):
+            references.append(Reference('persongroup', match[0],
+                                        match['code'].strip()))
+
+        def add_from_to(match: re.Match):
+            references.append(Reference('attribute', match[0],
+                                        (zone_objid.upper(),
+                                         match['att'].upper())))
+
+        text = remove(self._matrix_filter, formula, add_matrix_filter)
+        text = remove(self._matrix_number, text, add_number)
+        text = remove(self._numpersons, text, add_numpersons)
+        text = remove(self._from_to, text, add_from_to)
+        for match in list(self._table_lookup.finditer(text)):
+            lookup_objid = match['objid'].upper()
+            var_attribute = re.compile(
+                rf'\b{match["var"]}\[(?P<att>\w+)\]'
+                r'(?:\s*=\s*"(?P<prefix>[^"]*)"\s*\+?)?')
+
+            def add_lookup(m: re.Match):
+                if lookup_objid != 'MATRIX':
+                    references.append(Reference('attribute', m[0],
+                                                (lookup_objid,
+                                                 m['att'].upper())))
+                elif m['att'].upper() == 'CODE' and m['prefix'] is not None:
+                    #  the code is composed in the formula,
+                    #  all matrices with the code as prefix may be read
+                    references.append(Reference('prefix', m[0], m['prefix']))
+            text = remove(var_attribute, text, add_lookup)
+        text = self._string.sub(' ', text)
+        for match in self._attribute.finditer(text):
+            owner = 'NETWORK' if objid == 'MATRIX' else objid
+            references.append(Reference('attribute', match[0],
+                                        (owner, match['att'].upper())))
+        return references
+
+    def parse_condition(self, cond: str) -> Dict[str, object]:
+        """
+        return the attribute-values of a matrix-condition like
+        [CODE]="Visem_O" & [DSEGCODE]="O"
+        """
+        conditions = {}
+        for match in self._condition.finditer(cond):
+            if match['text'] is not None:
+                conditions[match['att'].upper()] = match['text']
+            else:
+                conditions[match['att'].upper()] = float(match['number'])
+        return conditions
+
+
+class FormulaGraph:
+    """
+    dependency graph of the formula-matrices and formula-attributes
+
+    The references are resolved to the matrices and to the userdefined
+    attributes. References to attributes, that are not userdefined,
+    are attributes of Visum and are not part of the graph.
+    """
+    parser = FormulaParser()
+    _time_columns = ('FROMTIME', 'TOTIME')
+
+    def __init__(self,
+                 matrices: Iterable[VisumTable],
+                 userdefined: Iterable[VisumTable] = (),
+                 persongroups: Iterable[VisumTable] = None):
+        """
+        Parameters
+        ----------
+        matrices : list of Matrix-tables
+        userdefined : list of UserDefinedAttribute-tables, optional
+        persongroups : list of PersonGroup-tables, optional
+            if given, NUMPERSONS-references to unknown persongroups
+            are dangling
+        """
+        self.matrices = pd.concat([m.df for m in matrices])
+        self.attributes = pd.concat(
+            [u.df.reset_index() for u in userdefined] or
+            [pd.DataFrame(columns=['OBJID', 'ATTID', 'FORMULA'])])
+        if persongroups is None:
+            self.persongroups = None
+        else:
+            self.persongroups = set().union(
+                *(p.df.index.astype(str) for p in persongroups))
+
+        self._by_code: Dict[str, List[int]] = defaultdict(list)
+        for no, code in self.matrices['CODE'].items():
+            self._by_code[code].append(no)
+        self._resolved: Dict[Tuple[str, object], Tuple[Node]] = {}
+        self.attribute_nodes = {(objid.upper(), attid.upper())
+                                for objid, attid in zip(
+                                    self.attributes['OBJID'],
+                                    self.attributes['ATTID'])}
+
+        self.edges: Dict[Node, Set[Node]] = {}
+        self.dangling: List[Tuple[Node, Reference]] = []
+        self._build()
+
+    @classmethod
+    def from_transfer(cls, vt: VisumTransfer) -> 'FormulaGraph':
+        """build the graph from the tables of the transfer"""
+        tables = defaultdict(list)
+        for table in vt.tables.values():
+            tables[table.code].append(table)
+        return cls(tables['MATRIX'],
+                   tables['USERATTDEF'],
+                   tables['PERSONGROUP'] or None)
+
+    def _build(self):
+        for no, row in self.matrices.iterrows():
+            node = ('MATRIX', no)
+            self.edges[node] = set()
+            formula = row.get('FORMULA')
+            if isinstance(formula, str) and formula:
+                zone_objid = row.get('OBJECTTYPEREF')
+                if not isinstance(zone_objid, str) or not zone_objid:
+                    zone_objid = 'ZONE'
+                for ref in self.parser.parse(formula, 'MATRIX', zone_objid):
+                    self._add_reference(node, ref)
+            obb_ref = row.get('OBB_MATRIX_REF')
+            if isinstance(obb_ref, str) and obb_ref:
+                self._add_reference(node, Reference('matrix', obb_ref,
+                                                    obb_ref))
+        for objid, attid, formula in zip(self.attributes['OBJID'],
+                                         self.attributes['ATTID'],
+                                         self.attributes['FORMULA']):
+            node = (objid.upper(), attid.upper())
+            self.edges[node] = set()
+            if isinstance(formula, str) and formula:
+                for ref in self.parser.parse(formula, objid):
+                    self._add_reference(node, ref)
+
+    def _add_reference(self, node: Node, ref: Reference):
+        if ref.kind == 'persongroup':
+            if self.persongroups is not None and \
+               ref.key not in self.persongroups:
+                self.dangling.append((node, ref))
+            return
+        targets = self.resolve(ref)
+        if targets is None:
+            #  an attribute of Visum
+            return
+        if not targets:
+            self.dangling.append((node, ref))
+        self.edges[node].update(targets)
+
+    def resolve(self, ref: Reference) -> Tuple[Node]:
+        """
+        return the nodes referenced, cached by the kind of the reference
+        and the condition, code or number.
+        Return None for attributes, that are not userdefined
+        """
+        key = (ref.kind, ref.key)
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+        if ref.kind == 'number':
+            nodes = (('MATRIX', ref.key), ) \
+                if ref.key in self.matrices.index else ()
+        elif ref.kind == 'prefix':
+            nodes = tuple(('MATRIX', no)
+                          for code, numbers in self._by_code.items()
+                          if code.startswith(ref.key)
+                          for no in numbers)
+        elif ref.kind == 'matrix':
+            nodes = tuple(('MATRIX', no) for no in self.find_matrices(ref.key))
+        else:
+            nodes = (ref.key, ) if ref.key in self.attribute_nodes else None
+        self._resolved[key] = nodes
+        return nodes
+
+    def find_matrices(self, cond: str) -> List[int]:
+        """
+        return the numbers of the matrices matching the condition.
+        Text-values and the times in seconds are compared,
+        other numeric attributes like object types are coded differently
+        in Visum than stored in the transfer-file
+        """
+        conditions = self.parser.parse_condition(cond)
+        if 'CODE' in conditions:
+            numbers = self._by_code.get(conditions.pop('CODE'), [])
+        elif 'NO' in conditions:
+            no = int(conditions.pop('NO'))
+            numbers = [no] if no in self.matrices.index else []
+        else:
+            numbers = self.matrices.index.tolist()
+        for att, value in conditions.items():
+            if att not in self.matrices:
+                continue
+            values = self.matrices[att]
+            if isinstance(value, str):
+                numbers = [no for no in numbers if values[no] == value]
+            elif att in self._time_columns:
+                numbers = [no for no in numbers
+                           if self.get_seconds(values[no]) == value]
+        return numbers
+
+    @staticmethod
+    def get_seconds(time: str) -> float:
+        """convert a time string HH:MM:SS into seconds, None if empty"""
+        if not isinstance(time, str) or not time:
+            return None
+        seconds = 0
+        for part in time.split(':'):
+            seconds = seconds * 60 + float(part)
+        return seconds
+
+    @property
+    def readers(self) -> Dict[Node, Set[Node]]:
+        """the nodes reading each node"""
+        readers = {node: set() for node in self.edges}
+        for node, targets in self.edges.items():
+            for target in targets:
+                readers[target].add(node)
+        return readers
+
+    def cycles(self) -> List[List[Node]]:
+        """return the strongly connected components forming cycles"""
+        index: Dict[Node, int] = {}
+        lowlink: Dict[Node, int] = {}
+        stack: List[Node] = []
+        on_stack: Set[Node] = set()
+        cycles = []
+        for start in self.edges:
+            if start in index:
+                continue
+            #  iterative version of Tarjan's algorithm
+            work = [(start, iter(sorted(self.edges[start], key=str)))]
+            index[start] = lowlink[start] = len(index)
+            stack.append(start)
+            on_stack.add(start)
+            while work:
+                node, targets = work[-1]
+                for target in targets:
+                    if target not in index:
+                        index[target] = lowlink[target] = len(index)
+                        stack.append(target)
+                        on_stack.add(target)
+                        work.append((target,
+                                     iter(sorted(self.edges[target], key=str))))
+                        break
+                    if target in on_stack:
+                        lowlink[node] = min(lowlink[node], index[target])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+                    if lowlink[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        if len(component) > 1 or node in self.edges[node]:
+                            cycles.append(component[::-1])
+        return cycles
+
+    def order(self) -> List[Node]:
+        """
+        return the nodes in the order of evaluation,
+        the referenced nodes come first
+
+        Raises
+        ------
+        ValueError
+            if there are cycles
+        """
+        cycles = self.cycles()
+        if cycles:
+            raise ValueError(f'the formulas have cycles: {cycles}')
+        order = []
+        done = set()
+        for start in self.edges:
+            work = [(start, iter(self.edges[start]))]
+            if start in done:
+                continue
+            done.add(start)
+            while work:
+                node, targets = work[-1]
+                for target in targets:
+                    if target not in done:
+                        done.add(target)
+                        work.append((target, iter(self.edges[target])))
+                        break
+                else:
+                    work.pop()
+                    order.append(node)
+        return order
+
+    def unused_data_matrices(self, read_codes: Iterable[str] = ()) -> pd.DataFrame:
+        """
+        return the data-matrices, that are read by no formula,
+        no OBB_MATRIX_REF and no demand stratum
+
+        Parameters
+        ----------
+        read_codes : list of str, optional
+            the codes of matrices read by procedures in Visum
+        """
+        readers = self.readers
+        read_codes = set(read_codes)
+        df = self.matrices
+        is_data = df['DATASOURCETYPE'] != 'FORMULA'
+        dstratset = df.get('DSTRATSET', pd.Series('', index=df.index))
+        is_unused = pd.Series([not readers[('MATRIX', no)]
+                               for no in df.index], index=df.index)
+        return df.loc[is_data & is_unused
+                      & ~dstratset.fillna('').astype(bool)
+                      & ~df['CODE'].isin(read_codes)]
+
+    def report(self, read_codes: Iterable[str] = ()) -> pd.DataFrame:
+        """
+        return the dangling references, the cycles
+        and the unused data-matrices as a DataFrame
+        with the columns node, code, reference and problem
+        """
+        rows = []
+        for node, ref in self.dangling:
+            rows.append((node, self.get_code(node), ref.text, 'dangling'))
+        for cycle in self.cycles():
+            cycle_codes = ' -> '.join(self.get_code(node) for node in cycle)
+            for node in cycle:
+                rows.append((node, self.get_code(node), cycle_codes, 'cycle'))
+        for no, code in self.unused_data_matrices(read_codes)['CODE'].items():
+            rows.append((('MATRIX', no), code, '', 'unused'))
+        return pd.DataFrame(rows,
+                            columns=['node', 'code', 'reference', 'problem'])
+
+    def get_code(self, node: Node) -> str:
+        """return the matrix code or the attribute id of the node"""
+        if node[0] == 'MATRIX':
+            return self.matrices['CODE'][node[1]]
+        return f'{node[0]}\\{node[1]}'
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+
+from typing import TYPE_CHECKING, Dict, Iterable, Mapping, Union
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from visumtransfer.visum_table import VisumTable
+from visumtransfer.formula_graph import FormulaGraph
+from visumtransfer.matrix_io import Array, is_sparse, require_scipy, to_csr
+
+if TYPE_CHECKING:
+    import scipy.sparse as sp
+
+
+class MainzoneAggregation:
+    """
+    aggregate zone matrices to mainzone (OBB) matrices and disaggregate
+    mainzone matrices to zone matrices
+
+    The dense matrices are processed in chunks of rows, the columns are
+    summed up per mainzone with np.add.reduceat and the rows with np.add.at.
+    Sparse matrices are aggregated with sparse indicator matrices.
+    """
+    chunksize = 1000
+
+    def __init__(self,
+                 zones: Iterable[int],
+                 mainzone_of_zones: Iterable[int],
+                 mainzones: Iterable[int] = None,
+                 chunksize: int = None):
+        """
+        Parameters
+        ----------
+        zones : list of int
+            the zone numbers in the order of the zone matrices
+        mainzone_of_zones : list of int
+            the mainzone number of each zone. Zones without a mainzone
+            (0 or NaN) are not aggregated
+        mainzones : list of int, optional
+            the mainzone numbers in the order of the mainzone matrices,
+            default: the sorted mainzones of the zones
+        chunksize : int, optional
+            the number of rows processed at once
+        """
+        self.zones = np.asarray(zones)
+        mainzone_of_zones = pd.to_numeric(pd.Series(mainzone_of_zones),
+                                          errors='coerce').to_numpy()
+        if len(mainzone_of_zones) != len(self.zones):
+            raise ValueError(f'{len(mainzone_of_zones)} mainzones given '
+                             f'for {len(self.zones)} zones')
+        valid = ~np.isnan(mainzone_of_zones) & (mainzone_of_zones != 0)
+        if mainzones is None:
+            mainzones = np.unique(mainzone_of_zones[valid])
+        self.mainzones = np.asarray(mainzones).astype('i8')
+        #  the position of the mainzone of each zone, -1 for no mainzone
+        self.codes = np.full(len(self.zones), -1)
+        self.codes[valid] = pd.Index(self.mainzones).get_indexer(
+            mainzone_of_zones[valid].astype('i8'))
+        if valid.any() and (self.codes[valid] < 0).any():
+            missing = np.unique(mainzone_of_zones[valid][
+                self.codes[valid] < 0])
+            raise KeyError(f'mainzones {missing} not in {self.mainzones}')
+        #  the columns sorted by mainzone for np.add.reduceat
+        assigned = np.flatnonzero(self.codes >= 0)
+        self._order = assigned[np.argsort(self.codes[assigned],
+                                          kind='stable')]
+        sorted_codes = self.codes[self._order]
+        starts = np.flatnonzero(np.diff(sorted_codes, prepend=-1) != 0)
+        self._starts = starts
+        self._start_codes = sorted_codes[starts]
+        if chunksize:
+            self.chunksize = chunksize
+
+    @classmethod
+    def from_zones(cls,
+                   zones: Union[VisumTable, pd.DataFrame],
+                   mainzones: Union[VisumTable, pd.DataFrame] = None,
+                   attribute: str = 'MAINZONENO',
+                   chunksize: int = None) -> 'MainzoneAggregation':
+        """
+        create the aggregation from the Zone-table with the attribute
+        `attribute` referencing the mainzone and the Mainzone-table
+        """
+        df = zones.df if isinstance(zones, VisumTable) else zones
+        if 'NO' in df.columns:
+            df = df.set_index('NO')
+        if mainzones is not None:
+            mdf = mainzones.df if isinstance(mainzones, VisumTable) \
+                else mainzones
+            mainzones = mdf['NO'] if 'NO' in mdf.columns else mdf.index
+        return cls(df.index, df[attribute], mainzones, chunksize=chunksize)
+
+    @property
+    def n_zones(self) -> int:
+        return len(self.zones)
+
+    @property
+    def n_mainzones(self) -> int:
+        return len(self.mainzones)
+
+    def indicator(self) -> 'sp.csr_matrix':
+        """the sparse zone x mainzone indicator matrix"""
+        sp = require_scipy()
+        assigned = np.flatnonzero(self.codes >= 0)
+        return sp.csr_matrix((np.ones(len(assigned)),
+                              (assigned, self.codes[assigned])),
+                             shape=(self.n_zones, self.n_mainzones))
+
+    def iter_blocks(self, array: Array, n: int):
+        """yield the rows and the dense values of the blocks of rows"""
+        for start in range(0, n, self.chunksize):
+            rows = slice(start, min(start + self.chunksize, n))
+            block = array[rows]
+            if isinstance(block, xr.DataArray):
+                block = block.data
+            if is_sparse(block):
+                block = to_csr(block).toarray()
+            yield rows, np.asarray(block, dtype='f8')
+
+    def check_shape(self, array: Array, n: int):
+        if array.shape != (n, n):
+            raise ValueError(f'matrix of shape {array.shape} does not fit '
+                             f'to {n} zones')
+
+    def aggregate(self,
+                  array: Array,
+                  out: np.ndarray = None) -> Array:
+        """
+        aggregate the zone matrix `array` to a mainzone matrix.
+        A sparse matrix is aggregated to a sparse mainzone matrix
+
+        Parameters
+        ----------
+        array : np.ndarray, np.memmap, DataArray or sparse matrix
+            the zone x zone matrix
+        out : np.ndarray, optional
+            the mainzone x mainzone array to write the result to
+        """
+        self.check_shape(array, self.n_zones)
+        if is_sparse(array):
+            indicator = self.indicator()
+            return to_csr(indicator.T @ to_csr(array) @ indicator)
+        if out is None:
+            out = np.zeros((self.n_mainzones, self.n_mainzones))
+        else:
+            out[:] = 0
+        if not len(self._order):
+            return out
+        for rows, block in self.iter_blocks(array, self.n_zones):
+            codes = self.codes[rows]
+            assigned = codes >= 0
+            #  sum up the columns of each mainzone
+            columns = np.add.reduceat(block[assigned][:, self._order],
+                                      self._starts, axis=1)
+            summed = np.zeros((len(columns), self.n_mainzones))
+            summed[:, self._start_codes] = columns
+            #  and the rows of each mainzone
+            np.add.at(out, codes[assigned], summed)
+        return out
+
+    def get_shares(self, weights: Iterable[float] = None) -> np.ndarray:
+        """
+        the share of each zone on its mainzone, 1 without weights.
+        The weights of a mainzone without weights are distributed equally
+        """
+        if weights is None:
+            return (self.codes >= 0).astype('f8')
+        weights = np.asarray(weights, dtype='f8')
+        assigned = self.codes >= 0
+        totals = np.bincount(self.codes[assigned], weights=weights[assigned],
+                             minlength=self.n_mainzones)
+        counts = np.bincount(self.codes[assigned],
+                             minlength=self.n_mainzones)
+        shares = np.zeros(self.n_zones)
+        total = totals[self.codes[assigned]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shares[assigned] = np.where(
+                total > 0, weights[assigned] / total,
+                1 / counts[self.codes[assigned]])
+        return shares
+
+    def disaggregate(self,
+                     array: Array,
+                     weights: Iterable[float] = None,
+                     out: np.ndarray = None) -> np.ndarray:
+        """
+        disaggregate the mainzone matrix `array` to a zone matrix
+
+        Parameters
+        ----------
+        array : np.ndarray, DataArray or sparse matrix
+            the mainzone x mainzone matrix
+        weights : list of float, optional
+            the weights of the zones, e.g. the inhabitants.
+            The value of a mainzone pair is distributed to the zone pairs
+            proportional to the product of the weights of the origin
+            and the destination. Without weights, each zone pair gets
+            the value of its mainzone pair like a matrix with OBB_MATRIX_REF
+        out : np.ndarray, optional
+            the zone x zone array to write the result to, e.g. a np.memmap
+        """
+        self.check_shape(array, self.n_mainzones)
+        if isinstance(array, xr.DataArray):
+            array = array.data
+        if is_sparse(array):
+            array = to_csr(array).toarray()
+        array = np.asarray(array, dtype='f8')
+        shares = self.get_shares(weights)
+        if out is None:
+            out = np.empty((self.n_zones, self.n_zones))
+        #  a dummy row and column for the zones without mainzone
+        padded = np.zeros((self.n_mainzones + 1, self.n_mainzones + 1))
+        padded[:-1, :-1] = array
+        n = self.n_zones
+        for start in range(0, n, self.chunksize):
+            rows = slice(start, min(start + self.chunksize, n))
+            block = padded[self.codes[rows, np.newaxis], self.codes]
+            block *= shares[rows, np.newaxis]
+            block *= shares
+            out[rows] = block
+        return out
+
+    def get_pairs(self,
+                  matrices: Union[VisumTable, Iterable[VisumTable]]
+                  ) -> Dict[int, int]:
+        """
+        return the mainzone matrix referenced by OBB_MATRIX_REF
+        for each zone matrix
+
+        Raises
+        ------
+        KeyError
+            if the reference matches no matrix or several matrices
+        """
+        if isinstance(matrices, VisumTable):
+            matrices = [matrices]
+        graph = FormulaGraph(matrices)
+        if 'OBB_MATRIX_REF' not in graph.matrices:
+            return {}
+        pairs = {}
+        for no, ref in graph.matrices['OBB_MATRIX_REF'].items():
+            if not isinstance(ref, str) or not ref:
+                continue
+            numbers = graph.find_matrices(ref)
+            if len(numbers) != 1:
+                raise KeyError(f'OBB_MATRIX_REF {ref} of matrix {no} '
+                               f'refers to {len(numbers)} matrices')
+            pairs[no] = numbers[0]
+        return pairs
+
+    def aggregate_matrices(self,
+                           matrices: Union[VisumTable, Iterable[VisumTable]],
+                           data: Mapping[Union[int, str], Array]
+                           ) -> Dict[int, Array]:
+        """
+        aggregate all zone matrices given in `data` by number or by code
+        to the mainzone matrices referenced by their OBB_MATRIX_REF
+
+        Returns
+        -------
+        results : dict
+            the mainzone matrices by number
+        """
+        results = {}
+        for no, obb_no, array in self._iter_data(matrices, data,
+                                                 mainzone=False):
+            if obb_no in results:
+                raise ValueError(f'several zone matrices are aggregated '
+                                 f'to the mainzone matrix {obb_no}')
+            results[obb_no] = self.aggregate(array)
+        return results
+
+    def disaggregate_matrices(self,
+                              matrices: Union[VisumTable,
+                                              Iterable[VisumTable]],
+                              data: Mapping[Union[int, str], Array],
+                              weights: Iterable[float] = None
+                              ) -> Dict[int, np.ndarray]:
+        """
+        disaggregate all mainzone matrices given in `data` to the
+        zone matrices referencing them with OBB_MATRIX_REF
+
+        Returns
+        -------
+        results : dict
+            the zone matrices by number
+        """
+        return {no: self.disaggregate(array, weights=weights)
+                for no, obb_no, array in self._iter_data(matrices, data,
+                                                         mainzone=True)}
+
+    def _iter_data(self, matrices, data, mainzone: bool):
+        """yield the pairs with the data of the zone or mainzone matrix"""
+        if isinstance(matrices, VisumTable):
+            matrices = [matrices]
+        matrices = list(matrices)
+        codes = pd.concat([m.df['CODE'] for m in matrices])
+        for no, obb_no in self.get_pairs(matrices).items():
+            key = obb_no if mainzone else no
+            array = data.get(key)
+            if array is None:
+                array = data.get(codes[key])
+            if array is not None:
+                yield no, obb_no, array
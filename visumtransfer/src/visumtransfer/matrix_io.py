@@ -0,0 +1,678 @@
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Mapping, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+try:
+    import scipy.sparse as sp
+except ImportError:
+    #  scipy is optional, only needed for sparse matrices
+    sp = None
+
+from visumtransfer.visum_table import VisumTable
+
+
+Array = Union[np.ndarray, xr.DataArray]
+
+
+def require_scipy():
+    """return scipy.sparse or raise an ImportError, if not installed"""
+    if sp is None:
+        raise ImportError('sparse matrices require scipy, install it with '
+                          '`pip install visumtransfer[sparse]`')
+    return sp
+
+
+def is_sparse(array) -> bool:
+    """
+    return True, if the array is a scipy.sparse-matrix or -array
+    or a sparse COO-array with a `to_scipy_sparse`-method
+    """
+    if sp is not None and sp.issparse(array):
+        return True
+    return hasattr(array, 'to_scipy_sparse')
+
+
+def to_csr(array) -> 'sp.csr_matrix':
+    """convert a sparse array into a csr-matrix with sorted indices"""
+    require_scipy()
+    if hasattr(array, 'to_scipy_sparse'):
+        array = array.to_scipy_sparse()
+    array = sp.csr_matrix(array, dtype='f8')
+    array.sort_indices()
+    return array
+
+
+class MatrixFile:
+    """
+    Visum matrix-files in text format
+
+    $V: the full matrix with the zone numbers and one line per row
+    $O: a list of origin, destination and value, either for all cells
+        or only for the cells with values other than 0 (sparse)
+    """
+    extension = '.mtx'
+    formats = ('V', 'O')
+    chunksize = 1000
+
+    def __init__(self,
+                 fmt: str = 'V',
+                 decimals: int = 2,
+                 sparse: bool = False,
+                 from_hour: float = 0,
+                 to_hour: float = 24,
+                 factor: float = 1,
+                 chunksize: int = None):
+        """
+        Parameters
+        ----------
+        fmt : str, optional
+            V or O
+        decimals : int, optional
+            the number of decimal places written
+        sparse : bool, optional
+            write only the cells with values other than 0, only for $O
+        from_hour, to_hour : float, optional
+            the time interval of the matrix
+        factor : float, optional
+            the factor of the matrix
+        chunksize : int, optional
+            the number of rows formatted at once
+        """
+        fmt = fmt.upper()
+        if fmt not in self.formats:
+            raise ValueError(f'format {fmt} not in {self.formats}')
+        if sparse and fmt != 'O':
+            raise ValueError('only the $O-format can be written sparse')
+        self.fmt = fmt
+        self.decimals = decimals
+        self.sparse = sparse
+        self.from_hour = from_hour
+        self.to_hour = to_hour
+        self.factor = factor
+        if chunksize:
+            self.chunksize = chunksize
+
+    @staticmethod
+    def format_hour(hour: float) -> str:
+        """format the hour as H.MM like Visum"""
+        minutes = int(round(hour * 60))
+        return f'{minutes // 60}.{minutes % 60:02d}'
+
+    @staticmethod
+    def get_zones(array: Array, zones: Iterable[int] = None) -> np.ndarray:
+        """
+        return the zone numbers given,
+        or the coords of the first dimension of a DataArray
+        or 1..n
+        """
+        if zones is None:
+            if isinstance(array, xr.DataArray):
+                zones = array[array.dims[0]].values
+            else:
+                zones = np.arange(1, array.shape[0] + 1)
+        zones = np.asarray(zones)
+        if array.shape != (len(zones), len(zones)):
+            raise ValueError(f'matrix of shape {array.shape} '
+                             f'does not fit to {len(zones)} zones')
+        return zones
+
+    def write(self,
+              fn: str,
+              array: Array,
+              zones: Iterable[int] = None):
+        """
+        write the zone x zone-`array` to the file `fn`
+
+        Parameters
+        ----------
+        fn : str
+            the filename
+        array : np.ndarray, xr.DataArray or sparse matrix
+            the matrix. The rows are read chunk by chunk,
+            so it may be a np.memmap or a dask-backed DataArray.
+            A scipy.sparse or COO-matrix is written without densifying it
+            in the sparse $O-format
+        zones : list of int, optional
+            the zone numbers. If not given, take the coords of a DataArray
+            or number the zones from 1 to n
+        """
+        zones = self.get_zones(array, zones)
+        with open(fn, 'w', encoding='cp1252', newline='\n') as f:
+            f.write(f'${self.fmt}\n')
+            f.write('* Von  Bis\n')
+            f.write(f'{self.format_hour(self.from_hour)} '
+                    f'{self.format_hour(self.to_hour)}\n')
+            f.write('* Faktor\n')
+            f.write(f'{self.factor:.{self.decimals}f}\n')
+            if self.fmt == 'V':
+                self._write_v(f, array, zones)
+            else:
+                self._write_o(f, array, zones)
+
+    def iter_blocks(self, array: Array, n: int):
+        """
+        yield the first row and the values of the blocks of rows,
+        the blocks of a sparse matrix as csr-matrix
+        """
+        if is_sparse(array):
+            array = to_csr(array)
+        for start in range(0, n, self.chunksize):
+            block = array[start:start + self.chunksize]
+            if isinstance(block, xr.DataArray):
+                block = block.data
+            if is_sparse(block):
+                yield start, to_csr(block)
+            else:
+                yield start, np.asarray(block, dtype='f8')
+
+    def _write_v(self, f, array: Array, zones: np.ndarray):
+        n = len(zones)
+        value_fmt = f'%.{self.decimals}f'
+        row_fmt = ' '.join([value_fmt] * n) + '\n'
+        f.write('* Anzahl Netzobjekte\n')
+        f.write(f'{n}\n')
+        f.write('* Netzobjekt-Nummern\n')
+        f.write(' '.join(map(str, zones)) + '\n')
+        for start, block in self.iter_blocks(array, n):
+            if is_sparse(block):
+                block = block.toarray()
+            lines = []
+            for zone, row in zip(zones[start:], block):
+                lines.append(f'* Obj {zone} Summe = '
+                             f'{value_fmt % row.sum()}\n')
+                lines.append(row_fmt % tuple(row.tolist()))
+            f.write(''.join(lines))
+
+    def _write_o(self, f, array: Array, zones: np.ndarray):
+        n = len(zones)
+        #  the lines for each destination, the origin is inserted per row
+        dest_lines = [f'\0 {zone} %.{self.decimals}f\n' for zone in zones]
+        dense_lines = ''.join(dest_lines)
+        for start, block in self.iter_blocks(array, n):
+            lines = []
+            for i, zone in enumerate(zones[start:start + block.shape[0]]):
+                if is_sparse(block):
+                    #  the stored values of the row in the csr-structure
+                    cells = slice(block.indptr[i], block.indptr[i + 1])
+                    cols = block.indices[cells]
+                    row = block.data[cells]
+                    if not self.sparse:
+                        row = np.zeros(n)
+                        row[cols] = block.data[cells]
+                else:
+                    row = block[i]
+                    cols = np.arange(n)
+                if self.sparse:
+                    nonzero = row != 0
+                    cols = cols[nonzero]
+                    row_lines = ''.join([dest_lines[c] for c in cols])
+                    row = row[nonzero]
+                else:
+                    row_lines = dense_lines
+                lines.append(row_lines.replace('\0', str(zone))
+                             % tuple(row.tolist()))
+            f.write(''.join(lines))
+
+
+def get_matrix_filename(row: pd.Series,
+                        folder: str,
+                        extension: str = MatrixFile.extension) -> str:
+    """
+    return the path of the matrix-file of a row of the Matrix-table,
+    composed of the folder, the MATRIXFOLDER and the FILENAME or CODE
+    """
+    filename = row.get('FILENAME')
+    if not isinstance(filename, str) or not filename:
+        filename = row['CODE']
+    matrixfolder = row.get('MATRIXFOLDER')
+    if isinstance(matrixfolder, str) and matrixfolder:
+        folder = os.path.join(folder, matrixfolder)
+    if not os.path.splitext(filename)[1]:
+        filename += extension
+    return os.path.join(folder, filename)
+
+
+def get_matrix_row(matrices: VisumTable,
+                   key: Union[int, str]) -> Tuple[int, pd.Series]:
+    """
+    return the number and the row of the matrix with the number
+    or the code `key`. The table may be read from a modification-file,
+    where NO is a column
+
+    Raises
+    ------
+    KeyError
+        if the key refers to no or to several matrices
+    """
+    df = matrices.df
+    if 'NO' in df.columns:
+        df = df.set_index('NO')
+    if isinstance(key, (int, np.integer)) and key in df.index:
+        return key, df.loc[key]
+    numbers = df.index[df['CODE'] == key]
+    if len(numbers) != 1:
+        raise KeyError(f'{key} refers to {len(numbers)} matrices')
+    return numbers[0], df.loc[numbers[0]]
+
+
+def write_matrices(matrices: VisumTable,
+                   arrays: Mapping[Union[int, str], Array],
+                   folder: str,
+                   zones: Iterable[int] = None,
+                   fmt: str = 'V',
+                   sparse: bool = False,
+                   max_workers: int = None) -> Dict[int, str]:
+    """
+    write the matrices in parallel threads to the files defined in the
+    Matrix-table
+
+    Parameters
+    ----------
+    matrices : Matrix
+        the Matrix-table with the FILENAME, MATRIXFOLDER, NUMDECPLACES,
+        FROMTIME and TOTIME of the matrices
+    arrays : Mapping
+        the arrays to write by number or by code of the matrix
+    folder : str
+        the folder of the matrix-files
+    zones : list of int, optional
+        the zone numbers
+    fmt : str, optional
+        V or O
+    sparse : bool, optional
+        write only the values other than 0, only for $O
+    max_workers : int, optional
+        the number of threads
+
+    Returns
+    -------
+    filenames : dict
+        the file written for each matrix number
+    """
+    jobs = []
+    for key, array in arrays.items():
+        no, row = get_matrix_row(matrices, key)
+        fn = get_matrix_filename(row, folder)
+        decimals = pd.to_numeric(row.get('NUMDECPLACES'), errors='coerce')
+        writer = MatrixFile(fmt=fmt,
+                            decimals=2 if pd.isna(decimals) else int(decimals),
+                            sparse=sparse,
+                            from_hour=get_hour(row.get('FROMTIME'), 0),
+                            to_hour=get_hour(row.get('TOTIME'), 24))
+        jobs.append((no, fn, writer, array))
+    if not jobs:
+        return {}
+    filenames = pd.Series([job[1] for job in jobs])
+    if filenames.duplicated().any():
+        raise ValueError(f'several matrices are written to '
+                         f'{filenames[filenames.duplicated()].tolist()}')
+
+    def write(job) -> int:
+        no, fn, writer, array = job
+        os.makedirs(os.path.dirname(fn) or '.', exist_ok=True)
+        writer.write(fn, array, zones)
+        return no
+
+    n_workers = min(max_workers or os.cpu_count() or 1, len(jobs))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(write, jobs))
+    return {no: fn for no, fn, writer, array in jobs}
+
+
+def get_hour(time: str, default: float) -> float:
+    """convert the time string HH:MM:SS of the Matrix-table into hours"""
+    if not isinstance(time, str) or not time:
+        return default
+    hours = 0.
+    for i, part in enumerate(time.split(':')):
+        hours += float(part) / 60 ** i
+    return hours
+
+
+class MatrixReader:
+    """
+    read Visum matrix-files in $V or $O text format
+
+    The rows are decoded lazily block by block.
+    With `cache`, the decoded matrix is stored as .npy-file in a folder
+    next to the matrix-file and memory-mapped for the following reads,
+    until the matrix-file changes.
+    """
+    chunksize = 1000
+
+    def __init__(self,
+                 fn: str,
+                 cache: bool = False,
+                 chunksize: int = None,
+                 network_zones: Iterable[int] = None):
+        """
+        Parameters
+        ----------
+        fn : str
+            the matrix-file
+        cache : bool, optional
+            cache the decoded matrix as memory-mappable .npy-file
+        chunksize : int, optional
+            the number of rows decoded at once
+        network_zones : list of int, optional
+            the zones of a $O-file. If not given, the zones occuring in the
+            file are taken, a sparse file may miss some zones
+        """
+        self.fn = fn
+        self.cache = cache
+        self.network_zones = network_zones
+        if chunksize:
+            self.chunksize = chunksize
+        self.read_header()
+
+    def __repr__(self) -> str:
+        return f'MatrixReader ${self.fmt} with {len(self.zones)} zones: {self.fn}'
+
+    def iter_lines(self, f) -> Iterator[str]:
+        """yield the stripped lines, that are no comments"""
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('*'):
+                yield line
+
+    def next_line(self, f) -> str:
+        """
+        return the next line, that is no comment,
+        with readline, so that the position of the file can be told
+        """
+        for line in iter(f.readline, ''):
+            line = line.strip()
+            if line and not line.startswith('*'):
+                return line
+        raise ValueError(f'unexpected end of {self.fn}')
+
+    def read_header(self):
+        """read the format, the time interval, the factor and the zones"""
+        with open(self.fn, encoding='cp1252') as f:
+            header = self.next_line(f)
+            if not header.startswith('$'):
+                raise ValueError(f'{self.fn} is no Visum matrix-file')
+            self.fmt = header[1:].split(';')[0].strip().upper()
+            if self.fmt not in MatrixFile.formats:
+                raise ValueError(f'${self.fmt}-format of {self.fn} '
+                                 f'not supported')
+            values = self.next_line(f).split()
+            if len(values) == 1:
+                #  the old format starts with the mode
+                values = self.next_line(f).split()
+            self.from_hour, self.to_hour = map(self.parse_hour, values)
+            self.factor = float(self.next_line(f))
+            if self.fmt == 'V':
+                n = int(self.next_line(f))
+                zones = []
+                while len(zones) < n:
+                    zones.extend(int(z) for z in self.next_line(f).split())
+                self.zones = np.array(zones)
+            self._data_pos = f.tell()
+        if self.fmt == 'O' and self.network_zones is not None:
+            self.zones = np.asarray(self.network_zones)
+        elif self.fmt == 'O':
+            #  the zones of the $O-format are the zones in the list
+            zones = set()
+            for block in self.iter_o_blocks():
+                zones.update(block[:, 0].astype(int))
+                zones.update(block[:, 1].astype(int))
+            self.zones = np.array(sorted(zones))
+
+    @staticmethod
+    def parse_hour(value: str) -> float:
+        """parse the hour in format H.MM"""
+        hour, _, minutes = value.partition('.')
+        return int(hour) + int(minutes.ljust(2, '0')[:2] or 0) / 60
+
+    def iter_o_blocks(self) -> Iterator[np.ndarray]:
+        """yield blocks of lines of origin, destination and value"""
+        with open(self.fn, encoding='cp1252') as f:
+            f.seek(self._data_pos)
+            for df in pd.read_csv(f, sep=r'\s+', comment='*', header=None,
+                                  usecols=[0, 1, 2], chunksize=100000):
+                yield df.to_numpy(dtype='f8')
+
+    def iter_blocks(self,
+                    zones: Iterable[int] = None
+                    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        yield the index and the values of the rows block by block
+        decoding only the rows and columns of the given `zones`
+        """
+        if self.fmt == 'O':
+            yield self.zones_index(zones), self._read_o(zones)
+            return
+        cols = self.zones_index(zones)
+        selected = np.zeros(len(self.zones), dtype=bool)
+        selected[cols] = True
+        n = len(self.zones)
+        with open(self.fn, encoding='cp1252') as f:
+            f.seek(self._data_pos)
+            lines = self.iter_lines(f)
+            row = 0
+            values: List[str] = []
+            block_rows: List[int] = []
+            block_values: List[str] = []
+            for line in lines:
+                values.extend(line.split())
+                while len(values) >= n:
+                    if selected[row]:
+                        block_rows.append(row)
+                        block_values.extend(values[:n])
+                    values = values[n:]
+                    row += 1
+                    if len(block_rows) == self.chunksize:
+                        yield self._v_block(block_rows, block_values, cols)
+                        block_rows, block_values = [], []
+                    if row == n:
+                        break
+                if row == n:
+                    break
+            if block_rows:
+                yield self._v_block(block_rows, block_values, cols)
+
+    def _v_block(self,
+                 rows: List[int],
+                 values: List[str],
+                 cols: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        block = np.array(values, dtype='f8').reshape(len(rows), -1)[:, cols]
+        return np.array(rows), block * self.factor
+
+    def _read_o(self, zones: Iterable[int] = None) -> np.ndarray:
+        idx = self.zones_index(zones)
+        position = np.full(len(self.zones), -1)
+        position[idx] = np.arange(len(idx))
+        array = np.zeros((len(idx), len(idx)))
+        lookup = pd.Index(self.zones)
+        for block in self.iter_o_blocks():
+            rows = lookup.get_indexer(block[:, 0].astype(int))
+            cols = lookup.get_indexer(block[:, 1].astype(int))
+            if (rows < 0).any() or (cols < 0).any():
+                raise KeyError(f'{self.fn} has zones not in the '
+                               f'network_zones')
+            rows = position[rows]
+            cols = position[cols]
+            valid = (rows >= 0) & (cols >= 0)
+            array[rows[valid], cols[valid]] = block[valid, 2] * self.factor
+        return array
+
+    def zones_index(self, zones: Iterable[int] = None) -> np.ndarray:
+        """return the index of the `zones` (default: all zones)"""
+        if zones is None:
+            return np.arange(len(self.zones))
+        zones = np.asarray(zones)
+        idx = np.searchsorted(self.zones, zones)
+        idx = np.minimum(idx, len(self.zones) - 1)
+        if not (np.all(np.diff(self.zones) > 0) and
+                np.array_equal(self.zones[idx], zones)):
+            #  the zones of the file are not sorted
+            lookup = pd.Index(self.zones)
+            idx = lookup.get_indexer(zones)
+            if (idx < 0).any():
+                raise KeyError(f'zones {zones[idx < 0]} not in {self.fn}')
+        return idx
+
+    def read(self, zones: Iterable[int] = None) -> np.ndarray:
+        """
+        return the matrix or the submatrix of the `zones`.
+        With the cache, the matrix is a read-only np.memmap
+        """
+        if self.cache:
+            array = self.read_cache()
+            if zones is None:
+                return array
+            idx = self.zones_index(zones)
+            return array[np.ix_(idx, idx)]
+        return self._decode(zones)
+
+    def _decode(self, zones: Iterable[int] = None) -> np.ndarray:
+        if self.fmt == 'O':
+            return self._read_o(zones)
+        idx = self.zones_index(zones)
+        array = np.empty((len(idx), len(idx)))
+        #  the rows of the blocks are in the order of the file
+        position = np.full(len(self.zones), -1)
+        position[idx] = np.arange(len(idx))
+        for rows, block in self.iter_blocks(zones):
+            array[position[rows]] = block
+        return array
+
+    def read_sparse(self, zones: Iterable[int] = None) -> 'sp.csr_matrix':
+        """
+        return the matrix or the submatrix of the `zones` as csr-matrix.
+        Only the coordinates and values of the non-zero cells are collected,
+        so that the memory scales with the number of values in the matrix
+        """
+        require_scipy()
+        idx = self.zones_index(zones)
+        position = np.full(len(self.zones), -1)
+        position[idx] = np.arange(len(idx))
+        rows_list, cols_list, values_list = [], [], []
+        if self.fmt == 'O':
+            lookup = pd.Index(self.zones)
+            for block in self.iter_o_blocks():
+                rows = lookup.get_indexer(block[:, 0].astype(int))
+                cols = lookup.get_indexer(block[:, 1].astype(int))
+                if (rows < 0).any() or (cols < 0).any():
+                    raise KeyError(f'{self.fn} has zones not in the '
+                                   f'network_zones')
+                rows = position[rows]
+                cols = position[cols]
+                valid = (rows >= 0) & (cols >= 0)
+                rows_list.append(rows[valid])
+                cols_list.append(cols[valid])
+                values_list.append(block[valid, 2] * self.factor)
+        else:
+            for rows, block in self.iter_blocks(zones):
+                r, c = np.nonzero(block)
+                rows_list.append(position[rows[r]])
+                cols_list.append(c)
+                values_list.append(block[r, c])
+        shape = (len(idx), len(idx))
+        if not values_list:
+            return sp.csr_matrix(shape)
+        coo = sp.coo_matrix((np.concatenate(values_list),
+                             (np.concatenate(rows_list),
+                              np.concatenate(cols_list))),
+                            shape=shape)
+        #  in $O-files, later lines overwrite earlier lines of the same cell
+        #  like in the dense matrix, so duplicates are not summed up
+        return to_csr(coo) if self.fmt == 'V' else self._last_value(coo)
+
+    @staticmethod
+    def _last_value(coo: 'sp.coo_matrix') -> 'sp.csr_matrix':
+        """keep the last value of duplicate cells"""
+        keys = coo.row.astype('i8') * coo.shape[1] + coo.col
+        _, last = np.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last
+        coo = sp.coo_matrix((coo.data[last], (coo.row[last], coo.col[last])),
+                            shape=coo.shape)
+        csr = to_csr(coo)
+        csr.eliminate_zeros()
+        return csr
+
+    def to_xarray(self, zones: Iterable[int] = None) -> xr.DataArray:
+        """return the matrix as DataArray with the zones as coords"""
+        if zones is None:
+            zones = self.zones
+        return xr.DataArray(self.read(zones),
+                            coords={'origin': np.asarray(zones),
+                                    'destination': np.asarray(zones)},
+                            dims=['origin', 'destination'])
+
+    @property
+    def cache_fn(self) -> str:
+        """the .npy-file for the current version of the matrix-file"""
+        folder, fn = os.path.split(os.path.abspath(self.fn))
+        stat = os.stat(self.fn)
+        key = f'{stat.st_mtime_ns:x}{stat.st_size:x}'
+        return os.path.join(folder, 'matrix_cache',
+                            f'{os.path.splitext(fn)[0]}_{key}.npy')
+
+    def read_cache(self) -> np.memmap:
+        """return the memory-mapped matrix, decode it if not cached"""
+        cache_fn = self.cache_fn
+        if not os.path.exists(cache_fn):
+            os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+            prefix = cache_fn.rsplit('_', 1)[0]
+            for old_fn in glob.glob(f'{glob.escape(prefix)}_*.npy'):
+                if old_fn.rsplit('_', 1)[0] == prefix:
+                    os.remove(old_fn)
+            #  write to a temporary file, so that no half-written file
+            #  is read by other processes
+            tmp_fn = f'{cache_fn[:-4]}.tmp.npy'
+            out = np.lib.format.open_memmap(
+                tmp_fn, mode='w+', dtype='f8',
+                shape=(len(self.zones), len(self.zones)))
+            if self.fmt == 'O':
+                out[:] = self._read_o()
+            else:
+                for rows, block in self.iter_blocks():
+                    out[rows] = block
+            out.flush()
+            del out
+            os.replace(tmp_fn, cache_fn)
+        return np.load(cache_fn, mmap_mode='r')
+
+
+def read_matrix(fn: str,
+                zones: Iterable[int] = None,
+                cache: bool = False,
+                as_xarray: bool = False,
+                network_zones: Iterable[int] = None,
+                sparse: bool = False) -> Array:
+    """
+    read the matrix-file `fn`
+
+    Parameters
+    ----------
+    fn : str
+        the matrix-file in $V or $O-format
+    zones : list of int, optional
+        read only the submatrix of these zones
+    cache : bool, optional
+        cache the matrix as .npy-file and return a memory-map
+    as_xarray : bool, optional
+        return a DataArray with the zones as coords
+    network_zones : list of int, optional
+        the zones of a $O-file, default: the zones in the file
+    sparse : bool, optional
+        return a scipy.sparse csr-matrix without densifying the matrix,
+        requires scipy
+    """
+    if sparse and (cache or as_xarray):
+        raise ValueError('a sparse matrix is neither cached '
+                         'nor returned as DataArray')
+    reader = MatrixReader(fn, cache=cache, network_zones=network_zones)
+    if sparse:
+        return reader.read_sparse(zones)
+    if as_xarray:
+        return reader.to_xarray(zones)
+    return reader.read(zones)
@@ -1,7 +1,61 @@
+import os
+import re
 import json
+import hashlib
+import threading
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import openpyxl
-from typing import List
+from typing import Callable, Dict, Iterable, List, Optional
+
+
+class ParamsTables(MutableMapping):
+    """
+    dict of the params-tables, which loads a table on first access
+    """
+
+    def __init__(self,
+                 keys: Iterable[str],
+                 load: Callable[[str], pd.DataFrame]):
+        self._keys = list(keys)
+        self._load = load
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key: str) -> pd.DataFrame:
+        try:
+            return self._tables[key]
+        except KeyError:
+            if key not in self._keys:
+                raise
+        df = self._load(key)
+        with self._lock:
+            # if the table was loaded meanwhile by another thread, use that
+            return self._tables.setdefault(key, df)
+
+    def __setitem__(self, key: str, df: pd.DataFrame):
+        if key not in self._keys:
+            self._keys.append(key)
+        self._tables[key] = df
+
+    def __delitem__(self, key: str):
+        """unload the table, it will be loaded again on next access"""
+        del self._tables[key]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def is_loaded(self, key: str) -> bool:
+        return key in self._tables
+
+    @property
+    def loaded(self) -> List[str]:
+        """the keys of the tables already loaded"""
+        return [k for k in self._keys if k in self._tables]
 
 
 class Params:
@@ -36,24 +90,360 @@ class Params:
         dseg_matrices='DSegMatrices',
     )
 
-    def __init__(self, excel_fp: str):
-        """ Read tables from """
-        self.dataframes = {}
-        with pd.ExcelFile(excel_fp) as excel:
+    #  declared dtypes of the columns used by the model, keyed by attribute
+    #  'str' and 'category' columns are read as text,
+    #  'numeric' columns as int or float, 'int64' as int.
+    #  columns not declared here are kept as parsed by read_excel.
+    #  'category' only for columns which are not concatenated or merged
+    schema = dict(
+        group_definitions=dict(code='str',
+                               name='str',
+                               category='str',
+                               id_in_category='int64',
+                               CODEPART='str',
+                               NAMEPART='str',
+                               GROUPS_CONSTANTS='str',
+                               TARIFMATRIX='str',
+                               factor_pkwverf_anzpkw='numeric',
+                               ),
+        activities=dict(code='str',
+                        name='str',
+                        potential='str',
+                        home='int64',
+                        rank='numeric',
+                        rsa='int64',
+                        autocalibrate='int64',
+                        composite_activities='str',
+                        calcdestmode='int64',
+                        ZIELWAHL_FUNKTION='str',
+                        MATRIXCODE_PUT='str',
+                        MATRIXCODE_PARKING='str',
+                        ),
+        activitypairs=dict(code='str',
+                           qa='str',
+                           za='str',
+                           ),
+        activitypair_time_series=dict(activitypair='str'),
+        time_series=dict(code='int64',
+                         name_long='str',
+                         from_hour='int64',
+                         to_hour='int64',
+                         Ganglinie_OVFern='numeric',
+                         ),
+        trip_chain_rates=dict(code_tc='str',
+                              Sequence='str',
+                              group_generation='str',
+                              rate='numeric',
+                              ),
+        validation_activities=dict(code='str',
+                                   in_model='int64',
+                                   Target_MeanTripDistance='numeric',
+                                   ),
+        validation_activities_hauptweg=dict(code='str',
+                                            in_model='int64',
+                                            ),
+        modes=dict(code='category',
+                   name='str',
+                   ),
+        trip_chain_rates_rsa=dict(code_tc='str',
+                                  Sequence='str',
+                                  group_generation='str',
+                                  rate='numeric',
+                                  ),
+        accessibilities=dict(matname_logsum='category',
+                             matname_accessibility='category',
+                             persongroupcode='category',
+                             activitycode='category',
+                             potential='category',
+                             zone_attribute='category',
+                             balance_attribute='category',
+                             ),
+        dseg_matrices=dict(TYPE='category',
+                           CATEGORY='category',
+                           CODE='str',
+                           NAME='str',
+                           DSEGCODE='str',
+                           MODECODE='str',
+                           OBB_MATRIX_REF='str',
+                           MATRIXFOLDER='str',
+                           GROUP='str',
+                           ),
+    )
 
-            for k, v in self.attr2tablename.items():
-                #  excel-sheetnames may be only 30 letters long
-                sheet_name = v[:30]
-                df = pd.read_excel(excel, sheet_name,
-                                   keep_default_na=False)
-                for colname in df.columns:
-                    try:
-                        converted = pd.to_numeric(df[colname])
-                        df[colname] = converted
-                    except ValueError:
-                        pass
-                self.dataframes[k] = df
-                setattr(self, k, df)
+    def __init__(self,
+                 excel_fp: str,
+                 cache: bool = False,
+                 use_hash: bool = False,
+                 prefetch: Iterable[str] = None,
+                 max_workers: int = None):
+        """
+        Tables from the excel-file `excel_fp`
+        each table is read on first access of params.<name>
+        or params.dataframes[<name>]
+
+        Parameters
+        ----------
+        excel_fp : str
+            the params excel-file
+        cache : bool, optional
+            if True, store the parsed sheets as parquet-files in a folder
+            next to the excel-file and read them from there,
+            as long as the excel-file is not changed
+        use_hash : bool, optional
+            if True, detect changes of the excel-file by its hash,
+            otherwise by its modification time and size
+        prefetch : list of str, optional
+            the names of the tables to read in parallel at once
+        max_workers : int, optional
+            the number of threads to read the prefetched tables
+        """
+        self.excel_fp = excel_fp
+        self.dataframes = ParamsTables(self.attr2tablename, self._read_table)
+        if cache:
+            self.cache_folder = self.get_cache_folder(excel_fp)
+            self.cache_key = self.get_cache_key(excel_fp, use_hash)
+        else:
+            self.cache_folder = self.cache_key = None
+        if prefetch:
+            self.prefetch(prefetch, max_workers=max_workers)
+
+    def __getattr__(self, name: str) -> pd.DataFrame:
+        #  called only, if name is not found the usual way
+        if name in self.attr2tablename:
+            return self.dataframes[name]
+        raise AttributeError(
+            f"'{self.__class__.__name__}' object has no attribute '{name}'")
+
+    def __setattr__(self, name: str, value):
+        if name in self.attr2tablename:
+            self.dataframes[name] = value
+        else:
+            super().__setattr__(name, value)
+
+    def prefetch(self, keys: Iterable[str] = None, max_workers: int = None):
+        """
+        read the tables `keys` (default: all tables) in parallel threads
+        tables already loaded are skipped
+        """
+        keys = [k for k in (keys or self.attr2tablename)
+                if not self.dataframes.is_loaded(k)]
+        if not keys:
+            return
+        unknown = set(keys) - set(self.attr2tablename)
+        if unknown:
+            raise KeyError(f'{sorted(unknown)} are no params-tables')
+        n_workers = min(max_workers or os.cpu_count() or 1, len(keys))
+        # each thread reads a batch of tables from its own excel-file object
+        batches = [keys[i::n_workers] for i in range(n_workers)]
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for tables in executor.map(self._read_tables, batches):
+                for k, df in tables.items():
+                    self.dataframes[k] = df
+
+    def _read_table(self, key: str) -> pd.DataFrame:
+        return self._read_tables([key])[key]
+
+    def _read_tables(self, keys: List[str]) -> Dict[str, pd.DataFrame]:
+        """read the tables from the cache or from the excel-file"""
+        tables = {}
+        excel = None
+        try:
+            for k in keys:
+                tablename = self.attr2tablename[k]
+                df = self.read_cache(tablename)
+                if df is None:
+                    #  open the excel-file only if a sheet is not cached
+                    if excel is None:
+                        excel = pd.ExcelFile(self.excel_fp)
+                    df = self.read_sheet(excel, tablename,
+                                         self.schema.get(k))
+                    self.write_cache(tablename, df)
+                tables[k] = df
+        finally:
+            if excel is not None:
+                excel.close()
+        return tables
+
+    @classmethod
+    def read_sheet(cls,
+                   excel: pd.ExcelFile,
+                   tablename: str,
+                   schema: Dict[str, str] = None) -> pd.DataFrame:
+        """
+        read the sheet for `tablename` from the excel-file
+        and convert the columns to the dtypes declared in `schema`
+        """
+        schema = schema or {}
+        #  excel-sheetnames may be only 30 letters long
+        sheet_name = tablename[:30]
+        #  read code-columns as text, even if they look like numbers
+        text_cols = {colname: str for colname, dtype in schema.items()
+                     if dtype in ('str', 'category')}
+        df = pd.read_excel(excel, sheet_name,
+                           keep_default_na=False,
+                           dtype=text_cols)
+        columns = {colname: cls.convert_column(df[colname],
+                                               schema.get(colname))
+                   for colname in df.columns}
+        return pd.DataFrame(columns, index=df.index)
+
+    @staticmethod
+    def convert_column(col: pd.Series, dtype: str = None) -> pd.Series:
+        """
+        convert the column to the declared dtype
+        return the column as parsed, if it cannot be converted,
+        the validation reports it then
+        undeclared columns are returned as parsed
+        """
+        if dtype is None or dtype == 'str':
+            return col
+        if dtype == 'category':
+            return col.astype('category')
+        #  empty cells are missing values, other text cannot be converted
+        numbers = pd.to_numeric(col, errors='coerce')
+        if (numbers.isna() & col.notna() & col.ne('')).any():
+            return col
+        #  'int64'-columns with float values or missing values
+        #  are not truncated, the validation reports them
+        if dtype == 'int64' and numbers.notna().all() \
+                and numbers.mod(1).eq(0).all():
+            return numbers.astype('int64')
+        return numbers
+
+    @staticmethod
+    def has_dtype(col: pd.Series, dtype: str) -> bool:
+        """check if the column has the declared dtype"""
+        if dtype == 'category':
+            return isinstance(col.dtype, pd.CategoricalDtype)
+        if dtype == 'str':
+            return (pd.api.types.is_object_dtype(col)
+                    and col.map(type).eq(str).all())
+        if dtype == 'int64':
+            return pd.api.types.is_integer_dtype(col)
+        return (pd.api.types.is_numeric_dtype(col)
+                and not pd.api.types.is_bool_dtype(col))
+
+    def validation_report(self, keys: Iterable[str] = None) -> pd.DataFrame:
+        """
+        return the columns of the tables `keys` (default: the loaded tables),
+        which are missing or which do not have the declared dtype
+        """
+        if keys is None:
+            keys = self.dataframes.loaded
+        rows = []
+        for k in keys:
+            df = self.dataframes[k]
+            for colname, dtype in self.schema.get(k, {}).items():
+                if colname not in df.columns:
+                    rows.append((k, colname, dtype, '', 'missing'))
+                elif not self.has_dtype(df[colname], dtype):
+                    rows.append((k, colname, dtype, str(df[colname].dtype),
+                                 'wrong type'))
+        return pd.DataFrame(rows, columns=['table', 'column', 'expected',
+                                           'found', 'problem'])
+
+    @staticmethod
+    def get_cache_folder(excel_fp: str) -> str:
+        """return the folder for the cached sheets next to the excel-file"""
+        folder, fn = os.path.split(os.path.abspath(excel_fp))
+        return os.path.join(folder, f'{os.path.splitext(fn)[0]}_cache')
+
+    @classmethod
+    def get_cache_key(cls, excel_fp: str, use_hash: bool = False) -> str:
+        """
+        return a key, that changes when the excel-file or the schema
+        is changed, either from the hash of the file or from its mtime and size
+        """
+        schema_key = hashlib.sha1(
+            json.dumps(cls.schema, sort_keys=True).encode()).hexdigest()[:8]
+        if use_hash:
+            sha = hashlib.sha1()
+            with open(excel_fp, 'rb') as f:
+                for block in iter(lambda: f.read(2 ** 20), b''):
+                    sha.update(block)
+            return f'{sha.hexdigest()[:16]}{schema_key}'
+        stat = os.stat(excel_fp)
+        return f'{stat.st_mtime_ns:x}{stat.st_size:x}{schema_key}'
+
+    def _cache_fn(self, tablename: str, ext: str = 'parquet') -> str:
+        return os.path.join(self.cache_folder,
+                            f'{tablename}_{self.cache_key}.{ext}')
+
+    def read_cache(self, tablename: str) -> Optional[pd.DataFrame]:
+        """
+        return the cached sheet for tablename,
+        or None, if it is not cached for the current excel-file
+        """
+        if self.cache_folder is None:
+            return None
+        fn = self._cache_fn(tablename)
+        if os.path.exists(fn):
+            return pd.read_parquet(fn, engine='pyarrow')
+        #  sheets, that cannot be stored as parquet, are pickled
+        fn = self._cache_fn(tablename, ext='pkl')
+        if os.path.exists(fn):
+            return pd.read_pickle(fn)
+        return None
+
+    def write_cache(self, tablename: str, df: pd.DataFrame):
+        """cache the parsed sheet and remove outdated cache files"""
+        if self.cache_folder is None:
+            return
+        os.makedirs(self.cache_folder, exist_ok=True)
+        #  only {tablename}_{cache_key}, not tables with the same prefix
+        old_files = re.compile(
+            rf'{re.escape(tablename)}_[0-9a-f]+\.(?:parquet|pkl)')
+        for old_fn in os.listdir(self.cache_folder):
+            if old_files.fullmatch(old_fn):
+                os.remove(os.path.join(self.cache_folder, old_fn))
+        fn = self._cache_fn(tablename)
+        #  parquet stores only string column names
+        if all(isinstance(c, str) for c in df.columns):
+            try:
+                df.to_parquet(fn, engine='pyarrow')
+                return
+            except (ValueError, TypeError):
+                #  pyarrow cannot store columns with mixed types like '' and 1
+                if os.path.exists(fn):
+                    os.remove(fn)
+        df.to_pickle(self._cache_fn(tablename, ext='pkl'))
+
+    def copy(self, overrides: Dict[str, pd.DataFrame] = None) -> 'Params':
+        """
+        return a copy of the params with copies of the tables,
+        so that the original tables are not modified by the callers
+        tables not loaded yet are loaded and copied on first access
+
+        Parameters
+        ----------
+        overrides : dict, optional
+            tables to replace in the copy, keyed by the attribute name
+        """
+        overrides = overrides or {}
+        unknown = set(overrides) - set(self.attr2tablename)
+        if unknown:
+            raise KeyError(f'{sorted(unknown)} are no params-tables')
+        new = self.__class__.__new__(self.__class__)
+        for k, v in self.__dict__.items():
+            object.__setattr__(new, k, v)
+        object.__setattr__(
+            new, 'dataframes',
+            ParamsTables(self.attr2tablename,
+                         lambda k: self.dataframes[k].copy()))
+        for k, df in overrides.items():
+            new.dataframes[k] = df.copy()
+        return new
+
+    def sheet_hashes(self, keys: Iterable[str] = None) -> Dict[str, str]:
+        """
+        return a hash of the content of the tables `keys` (default: all),
+        to detect which tables have changed between two runs
+        """
+        hashes = {}
+        for k in keys or self.attr2tablename:
+            text = self.dataframes[k].to_csv()
+            hashes[k] = hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+        return hashes
 
     @property
     def mode_set(self) -> str:
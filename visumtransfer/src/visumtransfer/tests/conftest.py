@@ -0,0 +1,108 @@
+import pytest
+import numpy as np
+import pandas as pd
+
+
+@pytest.fixture
+def model_params_excel_fp(tmp_path) -> str:
+    """a small params-excelfile to build a whole transfer"""
+    rng = np.random.default_rng(1)
+    modes = pd.DataFrame({'code': list('FROMP'),
+                          'name': ['Fuss', 'Rad', 'OV', 'Mitfahrer', 'Pkw'],
+                          'bezeichnung': ['zu Fuss', 'Fahrrad', 'OEV',
+                                          'Mitfahrer', 'Pkw-Fahrer'],
+                          'distance_matrix': ['KM'] * 5,
+                          'default_nsegcode': ['', '', '', '', 'P'], })
+    groups = [('ASUMME', 'Summe', 'total', -1, '', '', ''),
+              ('occ_VZ', 'Vollzeit', 'occupation', 0, 'VZ', 'Vollzeit', ''),
+              ('occ_RE', 'Rentner', 'occupation', 1, 'RE', 'Rentner',
+               'Seniorenticket'),
+              ('ca_PKW0', 'PKW0', 'car_availability', 0, 'PKW0', 'PKW0', ''),
+              ('ca_PKW1', 'PKW1', 'car_availability', 1, 'PKW1', 'PKW1', ''),
+              ('tr_T1', 'T1', 'Teilraum', 0, 'T1', 'T1', ''),
+              ('gesamt', 'Gesamt', 'Gesamt', 0, 'G', '', ''),
+              ('rsa', 'RSA', 'RSA', 0, 'RSA_', 'RSA', ''),
+              ('pe_PE1', 'PE1', 'Pendler', 0, 'PE1', 'PE1', ''), ]
+    group_definitions = pd.DataFrame(
+        groups, columns=['code', 'name', 'category', 'id_in_category',
+                         'CODEPART', 'NAMEPART', 'TARIFMATRIX'])
+    group_definitions['GROUPS_CONSTANTS'] = group_definitions['code']
+    group_definitions['factor_pkwverf_anzpkw'] = [0., 0, 0, 0, 1, 0, 0, 0, 0]
+    for mode in 'FROMP':
+        group_definitions[f'TARGET_MS_{mode}'] = 0.2
+        group_definitions[f'BASECONST_{mode}'] = 0.5
+    activities = pd.DataFrame({
+        'code': ['W', 'A', 'E'],
+        'name': ['Wohnen', 'Arbeit', 'Einkauf'],
+        'potential': ['', 'ZP_A', 'ZP_E'],
+        'home': [1, 0, 0],
+        'rank': ['', 1, 2],
+        'rsa': [0, 1, 0],
+        'autocalibrate': [0, 1, 1],
+        'composite_activities': ['', '', ''],
+        'calcdestmode': [0, 1, 1],
+        'ZIELWAHL_FUNKTION': ['', 'X', 'X'],
+        'MATRIXCODE_PUT': ['', 'PJT_A', ''],
+        'MATRIXCODE_PARKING': ['', '', 'PARKING_E'],
+        'BASE_LS': [1., .5, .7], })
+    pairs = [('WA', 'W', 'A'), ('AW', 'A', 'W'),
+             ('WE', 'W', 'E'), ('EW', 'E', 'W')]
+    activitypairs = pd.DataFrame(pairs, columns=['code', 'qa', 'za'])
+    activitypairs['idx'] = range(len(pairs))
+    activitypair_time_series = pd.DataFrame(
+        rng.random((len(pairs), 24)).round(3), columns=list(range(24)))
+    activitypair_time_series.insert(0, 'activitypair', activitypairs['code'])
+    time_series = pd.DataFrame({'code': [1, 2, 3],
+                                'name_long': ['Nacht', 'Morgen', 'Tag'],
+                                'from_hour': [0, 6, 10],
+                                'to_hour': [6, 10, 24],
+                                'Ganglinie_OVFern': [.1, .3, .6], })
+
+    def trip_chain_rates(groups):
+        return pd.DataFrame(
+            [{'code_tc': sequence.replace(',', ''),
+              'Sequence': sequence,
+              'group_generation': group,
+              'rate': round(rng.random(), 3)}
+             for group in groups for sequence in ['W,A,W', 'W,E,W']])
+
+    validation = pd.DataFrame({'code': ['W', 'A'],
+                               'in_model': [1, 1],
+                               'Target_MeanTripDistance': [3, 4], })
+    accessibilities = pd.DataFrame({'matname_logsum': ['LS_A'],
+                                    'matname_accessibility': ['ACC_A'],
+                                    'persongroupcode': ['occ_VZ'],
+                                    'activitycode': ['A'],
+                                    'potential': ['ZP_A'],
+                                    'zone_attribute': ['ERR_A'],
+                                    'balance_attribute': ['BAL_A'], })
+    dseg_matrices = pd.DataFrame({'TYPE': ['DATA'],
+                                  'CATEGORY': ['Other_Demand'],
+                                  'CODE': ['PkwFern'],
+                                  'NAME': ['Pkw Fern'],
+                                  'DSEGCODE': ['P'],
+                                  'MODECODE': ['P'],
+                                  'OBB_MATRIX_REF': [''],
+                                  'MATRIXFOLDER': ['Fern'],
+                                  'GROUP': ['Pkw'], })
+    other = pd.DataFrame({'code': ['x'], 'value': [1]})
+    sheets = dict(group_definitions=group_definitions,
+                  groups_generation=other,
+                  activities=activities,
+                  activity_parking=other,
+                  activitypairs=activitypairs,
+                  activitypair_time_series=activitypair_time_series,
+                  time_series=time_series,
+                  trip_chain_rates=trip_chain_rates(['occ_VZ', 'occ_RE',
+                                                     'pe_PE1']),
+                  validation_activities=validation,
+                  validation_hauptweg=validation,
+                  modes=modes,
+                  trip_chain_rates_rsa=trip_chain_rates(['occ_VZ', 'pe_PE1']),
+                  accessibilities=accessibilities,
+                  DSegMatrices=dseg_matrices)
+    excel_fp = str(tmp_path / 'params.xlsx')
+    with pd.ExcelWriter(excel_fp) as excel:
+        for sheet_name, df in sheets.items():
+            df.to_excel(excel, sheet_name=sheet_name, index=False)
+    return excel_fp
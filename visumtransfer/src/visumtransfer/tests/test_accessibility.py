@@ -0,0 +1,62 @@
+import pytest
+import numpy as np
+import pandas as pd
+from visumtransfer.visum_table import VisumTransfer
+from visumtransfer.accessibility import Accessibilities
+
+
+@pytest.fixture
+def accessibilities() -> pd.DataFrame:
+    return pd.DataFrame({'matname_logsum': ['LS_A', 'LS_E'],
+                         'matname_accessibility': ['ACC_A', 'ACC_E'],
+                         'persongroupcode': ['AR', 'AR'],
+                         'activitycode': ['A', 'E'],
+                         'potential': ['ZP_Arbeit', 'ZP_Einkauf'],
+                         'zone_attribute': ['ERR_A', 'ERR_E'],
+                         'balance_attribute': ['BAL_A', 'BAL_E']})
+
+
+@pytest.fixture
+def zones() -> pd.DataFrame:
+    return pd.DataFrame({'ZP_ARBEIT': [10., 0, 5, 1, 0],
+                         'ZP_EINKAUF': [0., 0, 0, 0, 0]},
+                        index=[1, 2, 3, 4, 7])
+
+
+class TestAccessibilities:
+    def test_calc(self, tmp_path, accessibilities, zones):
+        rng = np.random.default_rng(0)
+        ls_a = -rng.random((5, 5)) * 5
+        fn = str(tmp_path / 'ls_e.npy')
+        np.save(fn, ls_a)
+        calculator = Accessibilities(accessibilities,
+                                     {'LS_A': ls_a, 'LS_E': fn},
+                                     zones, chunksize=2, max_workers=2)
+        df = calculator.calc_all()
+        expected = np.log((np.exp(ls_a) * zones['ZP_ARBEIT'].values).sum(1))
+        np.testing.assert_allclose(df['ERR_A'], expected)
+        #  no potential reachable
+        assert (df['ERR_E'] == -np.inf).all()
+        assert df.index.tolist() == [1, 2, 3, 4, 7]
+
+        vt = VisumTransfer.new_transfer()
+        calculator.add_to_transfer(vt)
+        assert vt.tables['Erreichbarkeiten']._mode == '*'
+        #  Visum cannot read -inf, the attribute is left empty
+        fn = str(tmp_path / 'erreichbarkeiten.tra')
+        vt.write(fn)
+        with open(fn, encoding='latin1') as f:
+            lines = f.read().splitlines()
+        assert not any('inf' in line for line in lines)
+        start = lines.index('$*ZONE:NO;ERR_A;ERR_E')
+        assert [line.split(';')[-1] for line in lines[start + 1:start + 6]] \
+            == [''] * 5
+
+    def test_large_logsums(self, accessibilities, zones):
+        ls = np.full((5, 5), 1000.)
+        calculator = Accessibilities(accessibilities[:1], {'LS_A': ls}, zones)
+        np.testing.assert_allclose(calculator.calc_all()['ERR_A'],
+                                   1000 + np.log(16))
+        with pytest.raises(ValueError):
+            Accessibilities(accessibilities[:1], {'LS_A': ls[:3]},
+                            zones).calc_all()
@@ -0,0 +1,129 @@
+import pytest
+import numpy as np
+from visumtransfer.visum_table import VisumTransfer
+from visumtransfer.visum_tables import (Activity,
+                                        Matrix,
+                                        UserDefinedAttribute,
+                                        UserDefinedGroup)
+from visumtransfer.balancing import Furness
+
+
+@pytest.fixture
+def matrix() -> np.ndarray:
+    rng = np.random.default_rng(1)
+    return rng.random((6, 6)) * 10
+
+
+class TestFurness:
+    def test_destinations(self, matrix):
+        targets = np.array([10., 20, 30, 0, 5, 5])
+        result = Furness(chunksize=4).balance(matrix, destinations=targets)
+        assert result.converged
+        np.testing.assert_allclose(result.apply(matrix).sum(0), targets)
+        np.testing.assert_array_equal(result.row_factors, 1)
+
+    def test_doubly_constrained(self, matrix):
+        origins = np.array([10., 20, 30, 40, 5, 15])
+        destinations = np.array([1., 2, 3, 4, 5, 5]) * 3
+        furness = Furness(chunksize=4)
+        result = furness.balance(matrix, origins, destinations)
+        assert result.converged
+        balanced = result.apply(matrix)
+        #  the destinations are scaled to the total of the origins
+        np.testing.assert_allclose(balanced.sum(0), destinations * 2)
+        correction = origins / balanced.sum(1)
+        assert furness.threshold_min <= correction.min()
+        assert correction.max() <= furness.threshold_max
+
+        #  warm-started from the previous factors
+        warm = furness.balance(matrix, origins, destinations,
+                               row_factors=result.row_factors,
+                               col_factors=result.col_factors)
+        assert warm.iterations < result.iterations
+
+        strict = Furness(threshold_min=.999999, threshold_max=1.000001,
+                         max_iterations=2).balance(matrix, origins,
+                                                   destinations)
+        assert not strict.converged and strict.iterations == 2
+
+    def test_sparse(self, matrix):
+        sp = pytest.importorskip('scipy.sparse')
+        matrix[matrix < 3] = 0
+        origins = np.arange(1., 7)
+        furness = Furness(chunksize=4)
+        sparse = furness.balance(sp.coo_matrix(matrix), origins, origins)
+        dense = furness.balance(matrix, origins, origins)
+        np.testing.assert_allclose(sparse.col_factors, dense.col_factors)
+
+    def test_balance_all(self, matrix):
+        furness = Furness(max_workers=2)
+        destinations = {'A': np.arange(6.), 'E': np.ones(6)}
+        results = furness.balance_all({'A': matrix, 'E': matrix.T},
+                                      destinations=destinations)
+        assert all(r.converged for r in results.values())
+
+        vt = VisumTransfer.new_transfer()
+        zones = [1, 2, 3, 4, 5, 7]
+        furness.add_to_transfer(vt, results, zones)
+        table = vt.tables['Bilanzfaktoren']
+        assert table.df.columns.tolist() == ['BF_A', 'BF_E']
+        assert table.df.index.tolist() == zones
+
+        factors = Furness.read_factors(table, ['a', 'E', 'W'])
+        assert list(factors) == ['a', 'E']
+        warm = furness.balance_all({'A': matrix}, destinations=destinations,
+                                   warm_start={'A': factors['a']})
+        assert warm['A'].iterations == 1
+        with pytest.raises(ValueError):
+            furness.balance(matrix)
+
+    def test_row_factors(self, matrix):
+        furness = Furness()
+        origins = {'A': np.arange(1., 7)}
+        destinations = {'A': np.ones(6), 'E': np.ones(6)}
+        results = furness.balance_all({'A': matrix, 'E': matrix},
+                                      origins=origins,
+                                      destinations=destinations)
+        zones = [1, 2, 3, 4, 5, 7]
+        table = furness.to_table(results, zones)
+        #  E is balanced only to the destinations
+        assert table.df.columns.tolist() == ['BF_A', 'BF_E', 'BFQ_A']
+
+        factors = Furness.read_factors(table, ['A', 'E'])
+        np.testing.assert_array_equal(factors['A'].row_factors,
+                                      results['A'].row_factors)
+        np.testing.assert_array_equal(factors['E'].row_factors, 1)
+        np.testing.assert_allclose(factors['A'].apply(matrix),
+                                   results['A'].apply(matrix))
+        warm = furness.balance_all({'A': matrix}, origins=origins,
+                                   destinations=destinations,
+                                   warm_start=factors)
+        assert warm['A'].iterations == 1
+
+    def test_declared_attributes(self, matrix, tmp_path):
+        """the factors are declared as zone attributes of the activities"""
+        activities = Activity()
+        activities.add(code='W', name='Wohnen', rank=0, ishomeactivity=1,
+                       rsa=0, calcdestmode=0)
+        activities.add(code='A', name='Arbeit', rank=1, ishomeactivity=0,
+                       rsa=1, calcdestmode=1)
+        userdef = UserDefinedAttribute()
+        activities.add_balancing_output_matrices(Matrix(), UserDefinedGroup(),
+                                                 userdef)
+        furness = Furness()
+        results = furness.balance_all({'A': matrix},
+                                      origins={'A': np.arange(1., 7)},
+                                      destinations={'A': np.ones(6)})
+        vt = VisumTransfer.new_transfer()
+        vt.add_table(userdef)
+        furness.add_to_transfer(vt, results, [1, 2, 3, 4, 5, 7])
+        table = vt.tables['Bilanzfaktoren']
+        assert table.df.columns.tolist() == ['BF_A', 'BFQ_A']
+        zone_attributes = userdef.df.loc['ZONE'].index
+        assert set(table.df.columns) <= set(zone_attributes)
+
+        fn = str(tmp_path / 'bilanzfaktoren.tra')
+        vt.write(fn)
+        with open(fn, encoding='cp1252') as f:
+            text = f.read()
+        assert text.index('ZONE;BFQ_A;') < text.index('$*ZONE:NO;BF_A;BFQ_A')
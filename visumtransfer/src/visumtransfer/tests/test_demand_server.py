@@ -0,0 +1,54 @@
+import os
+import json
+import threading
+import urllib.request
+import pytest
+import pandas as pd
+from visumtransfer.visum_demand_server import (VisemDemandService,
+                                               VisemDemandServer,
+                                               request_modification)
+
+
+@pytest.fixture
+def server(tmp_path, model_params_excel_fp) -> VisemDemandServer:
+    """a server on a free port, serving in a thread"""
+    service = VisemDemandService(str(tmp_path / 'Modifications'),
+                                 model_params_excel_fp)
+    server = VisemDemandServer(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+class TestVisemDemandServer:
+    def test_modification(self, server):
+        port = server.server_address[1]
+        time_series = server.service.params.time_series.copy()
+        time_series['Ganglinie_OVFern'] = [.2, .2, .6]
+        result = request_modification(3, {'time_series': time_series},
+                                      port=port)
+        assert os.path.basename(result['filename']) == 'M000003.tra'
+        assert os.path.exists(result['filename'])
+        assert result['timings']
+        #  the overrides are used only for this build
+        assert server.service.params.time_series[
+            'Ganglinie_OVFern'].tolist() == [.1, .3, .6]
+
+        url = f'http://127.0.0.1:{port}/status'
+        with urllib.request.urlopen(url) as response:
+            status = json.loads(response.read())
+        assert status['params']['time_series'] == 3
+
+    def test_unknown_table(self, server):
+        port = server.server_address[1]
+        with pytest.raises(RuntimeError, match='no params-tables'):
+            request_modification(4, {'unknown': pd.DataFrame({'a': [1]})},
+                                 port=port)
+        with pytest.raises(RuntimeError, match='transfer unknown'):
+            request_modification(4, transfer='unknown', port=port)
+        assert not os.path.exists(
+            os.path.join(server.service.demand_model.modifications,
+                         'M000004.tra'))
@@ -0,0 +1,142 @@
+import pytest
+import numpy as np
+from visumtransfer.visum_tables import Matrix, UserDefinedAttribute
+from visumtransfer.formula_eval import (FormulaEvaluator,
+                                        FormulaCompiler,
+                                        FormulaSyntaxError)
+
+
+class CountingArray:
+    """an array counting the reads"""
+
+    def __init__(self, array: np.ndarray):
+        self.array = array
+        self.shape = array.shape
+        self.reads = 0
+
+    def __getitem__(self, key):
+        self.reads += 1
+        return self.array[key]
+
+
+@pytest.fixture
+def matrices() -> Matrix:
+    matrices = Matrix()
+    matrices.set_category('IV_Skims')
+    matrices.add_data_matrix('KM')
+    matrices.add_data_matrix('PJT', fromtime='06:00:00', totime='10:00:00')
+    matrices.add_data_matrix('PJT', fromtime='10:00:00', totime='24:00:00')
+    matrices.add_formula_matrix(
+        'DistanzKorrektur',
+        formula='(Matrix([CODE] = "KM") < [DistanceKorrBisKm]) * '
+        '[DistanceKorrFaktor] * ([DistanceKorrBisKm] - Matrix([CODE] = "KM"))')
+    pjt = ('Matrix([CODE] = "PJT" & [FROMTIME]=21600 & [TOTIME]=36000) + '
+           '0.8 * POW(Matrix([CODE] = "KM"), 0.8)')
+    matrices.add_formula_matrix(
+        'PJT_All', formula=f'(({pjt}) + TRANSPOSE({pjt})) * 0.5')
+    matrices.add_formula_matrix(
+        'Aussen2Aussen',
+        formula='-999999 * (FROM[MODELLIERUNGSRAUM] = 0) * '
+        '(TO[MODELLIERUNGSRAUM] = 0)')
+    matrices.add_formula_matrix(
+        'Anteil', formula='Matrix([CODE] = "DistanzKorrektur") / '
+        'MATRIXSUM(Matrix([CODE] = "KM"))')
+    return matrices
+
+
+@pytest.fixture
+def userdef() -> UserDefinedAttribute:
+    userdef = UserDefinedAttribute()
+    userdef.add_data_attribute('Network', 'DistanceKorrBisKm', defaultvalue=3)
+    userdef.add_data_attribute('Network', 'DistanceKorrFaktor',
+                               defaultvalue=-1.5)
+    return userdef
+
+
+@pytest.fixture
+def data(tmp_path) -> dict:
+    rng = np.random.default_rng(0)
+    km = rng.random((7, 7)) * 6
+    fn = str(tmp_path / 'km.npy')
+    np.save(fn, km)
+    return {'KM': fn,
+            109: rng.random((7, 7)) * 50,
+            110: rng.random((7, 7)) * 50}
+
+
+class TestFormulaEvaluator:
+    def test_compile(self):
+        compiler = FormulaCompiler(resolve=lambda cond: ('matrix', cond))
+        assert compiler.compile('-2 * (FROM[A] <> 1) | [B] >= .5') == (
+            'op', '|',
+            ('op', '*', ('num', -2.), ('op', '<>', ('from', 'A'),
+                                       ('num', 1.))),
+            ('op', '>=', ('network', 'B'), ('num', .5)))
+        assert compiler.compile('IF(Matrix([NO]=3) > 1: 1: 0)') == (
+            'func', 'IF', ('op', '>', ('matrix', '[NO]=3'), ('num', 1.)),
+            ('num', 1.), ('num', 0.))
+        for formula in ('1 +', 'POW(2)', 'UNKNOWN(1)', '(1 + 2', '1 ? 2'):
+            with pytest.raises(FormulaSyntaxError):
+                compiler.compile(formula)
+
+    @pytest.mark.parametrize('chunksize', [2, 1000])
+    def test_evaluate(self, matrices, userdef, data, chunksize):
+        evaluator = FormulaEvaluator(
+            matrices, data,
+            zone_attributes={'Modellierungsraum': [0, 1, 0, 1, 1, 0, 0]},
+            userdefined=[userdef],
+            chunksize=chunksize)
+        km = np.load(data['KM'])
+        no = matrices.df.index[matrices.df['CODE'] == 'DistanzKorrektur'][0]
+        korrektur = (km < 3) * -1.5 * (3 - km)
+        np.testing.assert_allclose(evaluator.evaluate(no), korrektur)
+
+        pjt = data[109] + 0.8 * km ** 0.8
+        np.testing.assert_allclose(evaluator.evaluate(no + 1),
+                                   (pjt + pjt.T) * 0.5)
+
+        aussen = evaluator.evaluate(no + 2)
+        assert (aussen == -999999).sum() == 16
+
+        np.testing.assert_allclose(evaluator.evaluate(no + 3),
+                                   korrektur / km.sum())
+
+        #  the network attributes overwrite the defaults
+        evaluator = FormulaEvaluator(
+            matrices, data,
+            network_attributes={'DistanceKorrBisKm': 10},
+            userdefined=[userdef])
+        out = np.zeros((7, 7))
+        evaluator.evaluate(no, out=out)
+        np.testing.assert_allclose(out, -1.5 * (10 - km))
+
+    def test_common_subexpressions(self, matrices, data):
+        km = CountingArray(np.load(data['KM']))
+        data['KM'] = km
+        evaluator = FormulaEvaluator(matrices, data, chunksize=3)
+        evaluator.evaluate('Matrix([CODE] = "KM") * 2 + '
+                           'EXP(Matrix([CODE] = "KM") * 2)')
+        #  KM is read once for each of the 3 chunks
+        assert km.reads == 3
+
+    def test_repeated_matrix(self, matrices, data):
+        km = CountingArray(np.load(data['KM']))
+        data['KM'] = km
+        evaluator = FormulaEvaluator(matrices, data, chunksize=3)
+        result = evaluator.evaluate('Matrix([CODE] = "KM") + '
+                                    'EXP(Matrix([CODE] = "KM"))')
+        np.testing.assert_allclose(result, km.array + np.exp(km.array))
+        #  the matrix leaf is read once for each of the 3 chunks
+        assert km.reads == 3
+
+    def test_errors(self, matrices, data):
+        evaluator = FormulaEvaluator(matrices, data)
+        with pytest.raises(ValueError, match='2 matrices'):
+            evaluator.evaluate('Matrix([CODE] = "PJT")')
+        with pytest.raises(KeyError):
+            evaluator.evaluate('FROM[ZP_A]')
+        matrices.add_formula_matrix('A', formula='Matrix([CODE] = "B")')
+        matrices.add_formula_matrix('B', formula='Matrix([CODE] = "A")')
+        evaluator = FormulaEvaluator(matrices, data)
+        with pytest.raises(ValueError, match='cyclic'):
+            evaluator.evaluate('Matrix([CODE] = "A")')
@@ -0,0 +1,95 @@
+import pytest
+from visumtransfer.visum_tables import Matrix, UserDefinedAttribute
+from visumtransfer.formula_graph import FormulaGraph, FormulaParser
+
+
+@pytest.fixture
+def matrices() -> Matrix:
+    matrices = Matrix()
+    matrices.set_category('IV_Skims')
+    matrices.add_data_matrix('KM')
+    matrices.add_data_matrix('DIS', dsegcode='P')
+    matrices.add_data_matrix('DIS', dsegcode='R')
+    matrices.set_category('Other_Demand')
+    matrices.add_data_matrix('Activity_W')
+    matrices.add_data_matrix('Activity_A', dstratset='W_A')
+    matrices.add_formula_matrix(
+        'DistanzKorrektur',
+        formula='(Matrix([CODE] = "KM") < [DistanceKorrBisKm]) * '
+        '[DistanceKorrFaktor] * FROM[Modellierungsraum]')
+    matrices.add_formula_matrix(
+        'DIS_P', formula='Matrix([CODE] = "DIS" & [DSEGCODE] = "P")')
+    return matrices
+
+
+@pytest.fixture
+def userdef() -> UserDefinedAttribute:
+    userdef = UserDefinedAttribute()
+    userdef.add_data_attribute('Network', 'DistanceKorrBisKm')
+    userdef.add_data_attribute('Zone', 'Modellierungsraum')
+    userdef.add_formula_attribute(
+        'Zone', 'KM_Quelle', formula='[MATROWSUM(108)] * [NUMPERSONS(ST)]')
+    userdef.add_formula_attribute(
+        'Activity', 'TotalTrips',
+        formula='TableLookup(MATRIX Mat: Mat[CODE]="Activity_"+[CODE]: '
+        'Mat[SUM])')
+    return userdef
+
+
+class TestFormulaGraph:
+    def test_parse(self):
+        parser = FormulaParser()
+        refs = parser.parse('TableLookup(ZONE Z: Z[OBB]=[NO]: Z[MR]) + '
+                            'Matrix([NO]=3) - TO[AREA] * [Faktor]',
+                            zone_objid='Mainzone')
+        assert [(r.kind, r.key) for r in refs] == [
+            ('number', 3),
+            ('attribute', ('MAINZONE', 'AREA')),
+            ('attribute', ('ZONE', 'OBB')),
+            ('attribute', ('ZONE', 'MR')),
+            ('attribute', ('NETWORK', 'NO')),
+            ('attribute', ('NETWORK', 'FAKTOR')),
+        ]
+        assert parser.parse_condition('[CODE]="KM" & [FROMTIME]=3600') == {
+            'CODE': 'KM', 'FROMTIME': 3600}
+
+    def test_graph(self, matrices, userdef):
+        graph = FormulaGraph([matrices], [userdef])
+        assert graph.edges[('MATRIX', 32)] == {
+            ('MATRIX', 108),
+            ('NETWORK', 'DISTANCEKORRBISKM'),
+            ('ZONE', 'MODELLIERUNGSRAUM')}
+        assert graph.edges[('MATRIX', 33)] == {('MATRIX', 109)}
+        assert graph.edges[('ACTIVITY', 'TOTALTRIPS')] == {
+            ('MATRIX', 30), ('MATRIX', 31)}
+        assert graph.readers[('MATRIX', 108)] == {
+            ('MATRIX', 32), ('ZONE', 'KM_QUELLE')}
+        order = graph.order()
+        assert order.index(('MATRIX', 108)) < order.index(('MATRIX', 32))
+        assert graph.cycles() == []
+
+        report = graph.report(read_codes=['DIS'])
+        assert report.empty
+        report = graph.report()
+        assert report['code'].tolist() == ['DIS']
+        assert report['problem'].tolist() == ['unused']
+
+        #  the persongroups are only checked, if given
+        graph = FormulaGraph([matrices], [userdef], persongroups=[])
+        assert graph.report(['DIS'])['reference'].tolist() == [
+            '[NUMPERSONS(ST)]']
+
+    def test_dangling_and_cycles(self, matrices, userdef):
+        matrices.add_formula_matrix('A', formula='Matrix([CODE]="B") + 1')
+        matrices.add_formula_matrix('B', formula='Matrix([CODE]="A") * '
+                                    'Matrix([CODE]="Missing")')
+        userdef.add_formula_attribute('Zone', 'Self', formula='[Self] + 1')
+        userdef.add_formula_attribute('Zone', 'Row',
+                                      formula='[MATROWSUM(999)]')
+        graph = FormulaGraph([matrices], [userdef])
+        report = graph.report(read_codes=['DIS'])
+        problems = report.groupby('problem')['code'].apply(list).to_dict()
+        assert problems == {'dangling': ['B', 'ZONE\\ROW'],
+                            'cycle': ['A', 'B', 'ZONE\\SELF']}
+        with pytest.raises(ValueError):
+            graph.order()
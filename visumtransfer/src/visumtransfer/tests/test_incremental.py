@@ -0,0 +1,64 @@
+import os
+import pytest
+import pandas as pd
+from visumtransfer.params import Params
+from visumtransfer.visum_table import TextBlock
+from visumtransfer.visum_demand import VisemDemandModel
+from visumtransfer.transfer_cache import TransferCache
+
+
+def change_sheet(excel_fp: str, sheet_name: str, df: pd.DataFrame):
+    with pd.ExcelWriter(excel_fp, mode='a',
+                        if_sheet_exists='replace') as excel:
+        df.to_excel(excel, sheet_name=sheet_name, index=False)
+
+
+def read_text(fn: str) -> str:
+    with open(fn, encoding='cp1252') as f:
+        return f.read()
+
+
+class TestIncrementalTransfer:
+    def test_incremental(self, tmp_path, model_params_excel_fp):
+        dm = VisemDemandModel(str(tmp_path / 'Modifications'),
+                              model_params_excel_fp)
+        vt = dm.create_transfer_incremental(Params(model_params_excel_fp), 1)
+        assert not any(isinstance(table, TextBlock)
+                       for table in vt.tables.values())
+
+        #  change the time series of an activitypair
+        df = pd.read_excel(model_params_excel_fp, 'activitypair_time_series')
+        df[10] = df[10] * 2
+        change_sheet(model_params_excel_fp, 'activitypair_time_series', df)
+        vt = dm.create_transfer_incremental(Params(model_params_excel_fp), 1)
+        rebuilt = {name for name, table in vt.tables.items()
+                   if not isinstance(table, TextBlock)}
+        assert rebuilt == {'Version', 'Ganglinie', 'Ganglinienelement',
+                           'VisemGanglinien'}
+
+        #  the output equals the full rebuild
+        full = dm.create_transfer(Params(model_params_excel_fp), 2)
+        assert read_text(vt.filename) == read_text(full.filename)
+
+    def test_cache_key(self, tmp_path, model_params_excel_fp):
+        dm = VisemDemandModel(str(tmp_path / 'Modifications'),
+                              model_params_excel_fp)
+        dm.create_transfer_incremental(Params(model_params_excel_fp), 1)
+        folder = os.path.join(dm.modifications, 'transfer_cache')
+        assert TransferCache(folder, key=dm.get_cache_key()).load()
+        #  the cache is not used for other dsegcodes
+        dm.dsegcodes = ['O', 'AboA']
+        assert not TransferCache(folder, key=dm.get_cache_key()).load()
+
+    def test_errors_propagate(self, tmp_path, model_params_excel_fp,
+                              monkeypatch):
+        dm = VisemDemandModel(str(tmp_path / 'Modifications'),
+                              model_params_excel_fp)
+        dm.create_transfer_incremental(Params(model_params_excel_fp), 1)
+
+        def refresh_transfer(*args):
+            raise KeyError('a bug')
+
+        monkeypatch.setattr(dm, 'refresh_transfer', refresh_transfer)
+        with pytest.raises(KeyError, match='a bug'):
+            dm.create_transfer_incremental(Params(model_params_excel_fp), 1)
@@ -0,0 +1,98 @@
+import pytest
+import numpy as np
+import xarray as xr
+from visumtransfer.visum_table import VisumTransfer
+from visumtransfer.visum_tables import (PersonGroupPerZone,
+                                        StructuralPropValues,
+                                        Zone)
+
+
+class CountingArray:
+    """an array counting the reads"""
+
+    def __init__(self, array: np.ndarray):
+        self.array = array
+        self.ndim = array.ndim
+        self.shape = array.shape
+        self.reads = 0
+
+    def __getitem__(self, key):
+        self.reads += 1
+        return self.array[key]
+
+
+@pytest.fixture
+def persons() -> xr.DataArray:
+    return xr.DataArray(np.array([[10., 0., 2.5],
+                                  [0., 0., 0.],
+                                  [np.nan, 4., 1.]]),
+                        coords={'zone': [1, 2, 5],
+                                'persongroup': ['AR', 'RE', 'SC']},
+                        dims=['zone', 'persongroup'])
+
+
+class TestLongFormat:
+    def test_from_array(self, persons):
+        pgz = PersonGroupPerZone.from_array(persons.values,
+                                            index=[1, 2, 5],
+                                            columns=['AR', 'RE', 'SC'],
+                                            chunksize=2)
+        assert pgz.df.empty
+        assert sum(len(chunk) for chunk in pgz.iter_long_chunks()) == 4
+        assert pgz.get_block().splitlines()[3:] == [
+            '$PERSONGROUPPERZONE:ZONENO;PERSONGROUPCODE;NUMPERSONS',
+            '1;AR;10.0',
+            '1;SC;2.5',
+            '5;RE;4.0',
+            '5;SC;1.0',
+            '']
+
+        with_zeros = PersonGroupPerZone.from_array(persons.values,
+                                                   index=[1, 2, 5],
+                                                   columns=['AR', 'RE', 'SC'],
+                                                   drop_zeros=False)
+        assert sum(len(chunk) for chunk in with_zeros.iter_long_chunks()) \
+            == 8
+
+    def test_no_reads(self, persons, tmp_path):
+        """bool and repr do not read the array, writing reads it once"""
+        array = CountingArray(persons.values)
+        pgz = PersonGroupPerZone.from_array(array,
+                                            index=[1, 2, 5],
+                                            columns=['AR', 'RE', 'SC'],
+                                            chunksize=2)
+        assert pgz
+        assert len(pgz) == 0
+        assert repr(pgz).endswith('(0 + array 3x3)')
+        assert array.reads == 0
+        vt = VisumTransfer.new_transfer()
+        vt.add_table(pgz)
+        vt.write(str(tmp_path / 'long.tra'))
+        #  2 chunks of rows
+        assert array.reads == 2
+
+    def test_from_xarray(self, persons, tmp_path):
+        values = StructuralPropValues.from_xarray(
+            persons.T, dims=['zone', 'persongroup'], chunksize=1)
+        chunks = list(values.iter_long_chunks())
+        assert [len(chunk) for chunk in chunks] == [2, 0, 2]
+        assert chunks[2]['STRUCTURALPROPCODE'].tolist() == ['RE', 'SC']
+
+        vt = VisumTransfer.new_transfer()
+        vt.add_table(values)
+        vt.add_table(PersonGroupPerZone.from_xarray(persons * 0))
+        fn = str(tmp_path / 'long.tra')
+        vt.write(fn)
+        with open(fn, encoding='cp1252') as f:
+            text = f.read()
+        assert '$STRUCTURALPROPVALUES:ZONENO;STRUCTURALPROPCODE;VALUE\n' \
+            '1;AR;10.0\n' in text
+        #  tables without values are not written
+        assert 'PERSONGROUPPERZONE' not in text
+
+    def test_errors(self, persons):
+        with pytest.raises(TypeError):
+            Zone.from_xarray(persons)
+        with pytest.raises(ValueError):
+            PersonGroupPerZone.from_array(persons.values, index=[1, 2],
+                                          columns=['AR', 'RE', 'SC'])
@@ -0,0 +1,65 @@
+import pytest
+import numpy as np
+import pandas as pd
+from visumtransfer.visum_tables import Matrix
+from visumtransfer.mainzone import MainzoneAggregation
+
+
+@pytest.fixture
+def aggregation() -> MainzoneAggregation:
+    #  zone 4 has no mainzone
+    zones = pd.DataFrame({'NO': [1, 2, 3, 4, 5],
+                          'MAINZONENO': [20, 10, 20, 0, 10]})
+    return MainzoneAggregation.from_zones(zones, chunksize=2)
+
+
+@pytest.fixture
+def array() -> np.ndarray:
+    return np.arange(25.).reshape(5, 5)
+
+
+class TestMainzoneAggregation:
+    def test_aggregate(self, aggregation, array):
+        np.testing.assert_array_equal(aggregation.mainzones, [10, 20])
+        expected = np.array([[array[np.ix_(r, c)].sum()
+                              for c in ([1, 4], [0, 2])]
+                             for r in ([1, 4], [0, 2])])
+        np.testing.assert_allclose(aggregation.aggregate(array), expected)
+        sp = pytest.importorskip('scipy.sparse')
+        result = aggregation.aggregate(sp.coo_matrix(array))
+        assert sp.issparse(result)
+        np.testing.assert_allclose(result.toarray(), expected)
+
+    def test_disaggregate(self, aggregation):
+        obb = np.array([[1., 2.], [3., 4.]])
+        zone = aggregation.disaggregate(obb)
+        assert zone[1, 0] == 2 and zone[0, 2] == 4
+        assert (zone[3] == 0).all() and (zone[:, 3] == 0).all()
+
+        weights = [1, 3, 3, 5, 1]
+        zone = aggregation.disaggregate(obb, weights=weights)
+        np.testing.assert_allclose(aggregation.aggregate(zone), obb)
+        assert zone[1, 0] == pytest.approx(2 * .75 * .25)
+
+    def test_matrices(self, aggregation, array):
+        matrices = Matrix()
+        matrices.set_category('Visem_Demand')
+        matrices.add_data_matrix('Visem_Gesamt',
+                                 obb_matrix_ref='[CODE]="Visem_OBB_Gesamt"')
+        matrices.add_data_matrix('Visem_OBB_Gesamt',
+                                 objecttyperef='Mainzone')
+        no, obb_no = matrices.df.index
+        assert aggregation.get_pairs(matrices) == {no: obb_no}
+        results = aggregation.aggregate_matrices(
+            matrices, {'Visem_Gesamt': array})
+        assert list(results) == [obb_no]
+        assert results[obb_no].sum() == array.sum() - array[3].sum() - \
+            array[:, 3].sum() + array[3, 3]
+        results = aggregation.disaggregate_matrices(
+            matrices, {obb_no: results[obb_no]})
+        assert results[no].shape == (5, 5)
+
+        matrices.add_data_matrix('Visem_Gesamt2',
+                                 obb_matrix_ref='[CODE]="Missing"')
+        with pytest.raises(KeyError):
+            aggregation.get_pairs(matrices)
@@ -0,0 +1,155 @@
+import pytest
+import numpy as np
+import pandas as pd
+from visumtransfer.visum_table import VisumTransfer
+from visumtransfer.visum_tables import Matrix, UserDefinedAttribute
+from visumtransfer.visum_tables.matrices import (MatrixCategories,
+                                                 NumberIntervals)
+
+
+@pytest.fixture
+def matrices() -> Matrix:
+    matrices = Matrix()
+    matrices.set_category('General')
+    matrices.add_data_matrix('Diagonal')
+    matrices.set_category('OV_Demand')
+    matrices.add_data_matrix('O_0006')
+    matrices.add_data_matrix('O_0624')
+    matrices.set_category('IV_Skims')
+    matrices.add_data_matrix('DIS')
+    return matrices
+
+
+class TestMatrix:
+    def test_replace_categories(self, matrices):
+        ov_matrices = Matrix()
+        ov_matrices.set_category('OV_Demand')
+        for code in ['O_0006', 'O_0610', 'O_1024']:
+            ov_matrices.add_data_matrix(code)
+        matrices.replace_categories(ov_matrices, [['OV_Demand']])
+        assert matrices.df['CODE'].tolist() == [
+            'Diagonal', 'O_0006', 'O_0610', 'O_1024', 'DIS']
+        assert matrices.df.index.tolist() == [1, 70, 71, 72, 108]
+
+    def test_replace_categories_fails(self, matrices):
+        ov_matrices = Matrix()
+        # numbers outside of the block of the category
+        ov_matrices.set_category('General')
+        ov_matrices.add_data_matrix('O_0006', category='OV_Demand')
+        with pytest.raises(ValueError):
+            matrices.replace_categories(ov_matrices, [['OV_Demand']])
+
+        # matrices of a group, that are not in one piece
+        matrices.set_category('OV_Demand')
+        matrices.add_data_matrix('O_2400')
+        with pytest.raises(ValueError):
+            matrices.replace_categories(Matrix(), [['OV_Demand']])
+
+    def test_add_matrices(self):
+        """add_matrices defines the same matrices as the single calls"""
+        single = Matrix()
+        single.set_category('OV_Demand')
+        single.add_data_matrix('O_0006', day=1, modecode='O')
+        single.add_formula_matrix('O_0006 incl', formula='2 * 3',
+                                  name='mit Fernverkehr', dsegcode='O')
+        single.add_data_matrix('O_0624', filename='O_Tag', loadmatrix=1)
+
+        bulk = Matrix()
+        bulk.set_category('OV_Demand')
+        numbers = bulk.add_matrices(pd.DataFrame({
+            'code': ['O_0006', 'O_0006 incl', 'O_0624'],
+            'name': ['', 'mit Fernverkehr', ''],
+            'filename': ['', '', 'O_Tag'],
+            'formula': ['', '2 * 3', ''],
+            'day': [1, np.nan, np.nan],
+            'modecode': ['O', '', ''],
+            'dsegcode': ['', 'O', ''],
+            'loadmatrix': [0, 0, 1],
+        }))
+        assert numbers == [70, 71, 72]
+        pd.testing.assert_frame_equal(bulk.df, single.df)
+        assert bulk.next_number() == single.next_number() == 73
+
+    def test_number_intervals(self):
+        intervals = NumberIntervals(range(10, 20))
+        assert intervals.discard(12) and intervals.discard(13)
+        assert not intervals.discard(12)
+        assert not intervals.discard(25)
+        assert intervals.intervals == [range(10, 12), range(14, 20)]
+        assert intervals.take_contiguous(3) == range(14, 17)
+        assert intervals.take(3) == [10, 11, 17]
+        assert intervals.take_contiguous(3) is None
+        intervals.add(12)
+        intervals.add(11)
+        intervals.add(30)
+        assert intervals.intervals == [range(11, 13), range(18, 20)]
+        assert len(intervals) == 4
+
+    def test_allocator(self):
+        with pytest.raises(ValueError, match='A and B'):
+            MatrixCategories({'A': range(1, 10), 'B': range(5, 20)})
+        allocator = MatrixCategories({'A': range(1, 5),
+                                      'B': range(5, 10),
+                                      '_fallback': range(10, 100)})
+        assert allocator.mark_used([2, 7, 2, 200]) == [2, 200]
+        assert allocator.category_of(7) == 'B'
+        assert allocator.category_of(200) == ''
+        assert allocator.next_numbers('A', 4) == [1, 3, 4, 10]
+        #  no gap of 3 left in B
+        assert allocator.reserve('B', 3) == range(11, 14)
+        assert allocator.reserve('B', 2) == range(5, 7)
+        allocator.release([3, 4])
+        assert allocator.reserve('A', 2) == range(3, 5)
+
+    def test_seed_and_compact(self, tmp_path):
+        fn = str(tmp_path / 'M000001.tra')
+        other = Matrix()
+        other.set_category('OV_Demand')
+        other.add_data_matrix('O_Fern')
+        other.add_data_matrix('O_Alt')
+        vt = VisumTransfer.new_transfer()
+        vt.add_table(other)
+        deleted = Matrix(mode='-')
+        deleted.add(no=71)
+        vt.add_table(deleted, name='MATRIX_deleted')
+        vt.write(fn)
+
+        matrices = Matrix()
+        assert matrices.seed_numbers(fn) == [70]
+        matrices.set_category('OV_Demand')
+        matrices.add_data_matrix('O_0006')
+        no_0624 = matrices.add_data_matrix('O_0624')
+        assert matrices.df.index.tolist() == [71, 72]
+        #  without the deletion, 71 is used twice
+        vt.tables.pop('MATRIX_deleted')
+        vt.write(fn)
+        with pytest.raises(ValueError):
+            matrices.seed_numbers(fn)
+
+        #  a block with gaps is compacted
+        matrices.add_formula_matrix('O_Tag', formula=f'Matrix([NO]={no_0624})')
+        matrices.df = matrices.df.drop(71)
+        matrices.set_category('General')
+        for i in range(5):
+            matrices.add_data_matrix(f'G{i}')
+        userdef = UserDefinedAttribute()
+        userdef.add_formula_attribute(
+            'Zone', 'O_0624_Quelle', formula=f'[MATROWSUM({no_0624})]')
+        #  [NO] of the zone is not a matrix number
+        userdef.add_formula_attribute(
+            'Zone', 'Zone72', formula='IF([NO]=72, 1, 0)')
+        userdef.add_formula_attribute(
+            'Zone', 'O_0624_72',
+            formula=f'[NO]=72 * [MATROWSUM(Matrix([CODE]="O(1)" | '
+            f'[NO]={no_0624}))]')
+        plan = matrices.compaction_plan()
+        #  the fallback-matrix G4 does not fit in the block
+        assert plan == {72: 71, 73: 72}
+        matrices.renumber(plan, userdef)
+        assert matrices.df['CODE'][71] == 'O_0624'
+        assert matrices.df['FORMULA'][72] == 'Matrix([NO]=71)'
+        assert userdef.df['FORMULA'].tolist() == [
+            '[MATROWSUM(71)]',
+            'IF([NO]=72, 1, 0)',
+            '[NO]=72 * [MATROWSUM(Matrix([CODE]="O(1)" | [NO]=71))]']
+        assert matrices.next_numbers(1, category='OV_Demand') == [73]
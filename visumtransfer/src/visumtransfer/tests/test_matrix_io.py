@@ -0,0 +1,185 @@
+import os
+import pytest
+import numpy as np
+import xarray as xr
+from visumtransfer.visum_table import VisumTransfer
+from visumtransfer.visum_tables import Matrix
+from visumtransfer.formula_eval import FormulaEvaluator
+from visumtransfer.matrix_io import (MatrixFile,
+                                     MatrixReader,
+                                     get_matrix_filename,
+                                     read_matrix,
+                                     write_matrices)
+
+
+@pytest.fixture
+def array() -> np.ndarray:
+    array = np.arange(9.).reshape(3, 3)
+    array[0, 1] = 0
+    return array
+
+
+class TestMatrixWriter:
+    def test_write_v(self, tmp_path, array):
+        fn = str(tmp_path / 'v.mtx')
+        MatrixFile('V', decimals=1, from_hour=6.5, to_hour=10,
+                   chunksize=2).write(fn, array, zones=[10, 20, 30])
+        with open(fn) as f:
+            lines = f.read().splitlines()
+        assert lines[:9] == ['$V', '* Von  Bis', '6.30 10.00',
+                             '* Faktor', '1.0',
+                             '* Anzahl Netzobjekte', '3',
+                             '* Netzobjekt-Nummern', '10 20 30']
+        assert lines[9:] == ['* Obj 10 Summe = 2.0', '0.0 0.0 2.0',
+                             '* Obj 20 Summe = 12.0', '3.0 4.0 5.0',
+                             '* Obj 30 Summe = 21.0', '6.0 7.0 8.0']
+
+    @pytest.mark.parametrize('sparse', [False, True])
+    def test_write_o(self, tmp_path, array, sparse):
+        fn = str(tmp_path / 'o.mtx')
+        da = xr.DataArray(array,
+                          coords={'origin': [1, 2, 5],
+                                  'destination': [1, 2, 5]},
+                          dims=['origin', 'destination'])
+        MatrixFile('O', sparse=sparse, chunksize=2).write(fn, da)
+        with open(fn) as f:
+            lines = f.read().splitlines()
+        assert lines[:5] == ['$O', '* Von  Bis', '0.00 24.00',
+                             '* Faktor', '1.00']
+        cells = [line.split() for line in lines[5:]]
+        assert len(cells) == (7 if sparse else 9)
+        assert cells[-1] == ['5', '5', '8.00']
+        assert (['1', '2', '0.00'] in cells) != sparse
+
+    def test_errors(self, array):
+        with pytest.raises(ValueError):
+            MatrixFile('X')
+        with pytest.raises(ValueError):
+            MatrixFile('V', sparse=True)
+        with pytest.raises(ValueError):
+            MatrixFile('V').write('x.mtx', array, zones=[1, 2])
+
+    def test_write_matrices(self, tmp_path, array):
+        matrices = Matrix()
+        matrices.set_category('IV_Skims')
+        matrices.add_data_matrix('KM', numdecplaces=1, matrixfolder='Skims')
+        matrices.add_data_matrix('DIS', filename='Distanz')
+        matrices.add_data_matrix('DIS', dsegcode='R')
+        folder = str(tmp_path)
+        assert get_matrix_filename(matrices.df.loc[108], folder) == \
+            os.path.join(folder, 'Skims', 'KM.mtx')
+
+        filenames = write_matrices(matrices, {'KM': array, 109: array * 2},
+                                   folder, fmt='O', max_workers=2)
+        assert filenames == {108: os.path.join(folder, 'Skims', 'KM.mtx'),
+                             109: os.path.join(folder, 'Distanz.mtx')}
+        with open(filenames[108]) as f:
+            assert f.read().splitlines()[-1] == '3 3 8.0'
+        with pytest.raises(KeyError):
+            write_matrices(matrices, {'DIS': array}, folder)
+        with pytest.raises(ValueError):
+            write_matrices(matrices, {108: array, 'KM': array}, folder)
+
+
+class TestMatrixReader:
+    @pytest.mark.parametrize('fmt', ['V', 'O'])
+    def test_read(self, tmp_path, fmt):
+        fn = str(tmp_path / 'm.mtx')
+        rng = np.random.default_rng(0)
+        array = np.round(rng.random((5, 5)) * 10, 2)
+        zones = [3, 7, 9, 12, 20]
+        MatrixFile(fmt, from_hour=6.5).write(fn, array, zones)
+        reader = MatrixReader(fn, chunksize=2)
+        np.testing.assert_array_equal(reader.zones, zones)
+        assert reader.from_hour == 6.5
+        np.testing.assert_allclose(reader.read(), array)
+        np.testing.assert_allclose(reader.read([20, 7]),
+                                   array[np.ix_([4, 1], [4, 1])])
+        with pytest.raises(KeyError):
+            reader.read([4])
+
+        da = read_matrix(fn, zones=[3, 9], as_xarray=True)
+        assert da.sel(origin=9, destination=3) == array[2, 0]
+
+        cached = read_matrix(fn, cache=True)
+        assert isinstance(cached, np.memmap)
+        np.testing.assert_allclose(cached, array)
+        np.testing.assert_allclose(read_matrix(fn, zones=[9], cache=True),
+                                   array[2:3, 2:3])
+
+    def test_read_wrapped_lines(self, tmp_path):
+        """the values of a row may span several lines"""
+        fn = str(tmp_path / 'v.mtx')
+        with open(fn, 'w') as f:
+            f.write('$V;D3\n* Verkehrsmittelkennung\n1\n* Von  Bis\n'
+                    '0.00 24.00\n* Faktor\n2.00\n* Anzahl\n3\n'
+                    '* Nummern\n1 2\n3\n'
+                    '1 2\n3\n4 5 6\n* Obj 3\n7\n8 9\n')
+        np.testing.assert_allclose(read_matrix(fn),
+                                   np.arange(1, 10).reshape(3, 3) * 2)
+
+    def test_sparse_zones(self, tmp_path, array):
+        fn = str(tmp_path / 'o.mtx')
+        array[:, 1] = 0
+        array[1] = 0
+        MatrixFile('O', sparse=True).write(fn, array)
+        np.testing.assert_array_equal(MatrixReader(fn).zones, [1, 3])
+        np.testing.assert_allclose(read_matrix(fn, network_zones=[1, 2, 3]),
+                                   array)
+
+    def test_read_from_modification(self, tmp_path, array):
+        matrices = Matrix()
+        matrices.set_category('IV_Skims')
+        matrices.add_data_matrix('KM', matrixfolder='Skims')
+        write_matrices(matrices, {'KM': array}, str(tmp_path))
+        vt = VisumTransfer.new_transfer()
+        vt.add_table(matrices)
+        fn = str(tmp_path / 'M000001.tra')
+        vt.write(fn)
+
+        vt = VisumTransfer.new_transfer()
+        vt.read_from_modification(fn, sections_to_read=['MATRIX'])
+        matrices = vt.tables['MATRIX']
+        np.testing.assert_allclose(matrices.read_data(108, str(tmp_path)),
+                                   array)
+        da = matrices.read_data('KM', str(tmp_path), as_xarray=True)
+        assert da.dims == ('origin', 'destination')
+
+
+class TestSparseMatrix:
+    @pytest.fixture(autouse=True)
+    def scipy_sparse(self):
+        return pytest.importorskip('scipy.sparse')
+
+    @pytest.mark.parametrize('fmt', ['V', 'O'])
+    def test_roundtrip(self, tmp_path, array, scipy_sparse, fmt):
+        fn = str(tmp_path / 'sparse.mtx')
+        coo = scipy_sparse.coo_matrix(array)
+        MatrixFile(fmt, sparse=fmt == 'O', chunksize=2).write(fn, coo)
+        dense_fn = str(tmp_path / 'dense.mtx')
+        MatrixFile(fmt, sparse=fmt == 'O').write(dense_fn, array)
+        with open(fn) as f, open(dense_fn) as f_dense:
+            assert f.read() == f_dense.read()
+
+        matrix = read_matrix(fn, sparse=True, network_zones=[1, 2, 3])
+        assert scipy_sparse.issparse(matrix)
+        assert matrix.nnz == 7
+        np.testing.assert_allclose(matrix.toarray(), array)
+        np.testing.assert_allclose(
+            read_matrix(fn, zones=[3, 1], sparse=True).toarray(),
+            array[np.ix_([2, 0], [2, 0])])
+        with pytest.raises(ValueError):
+            read_matrix(fn, sparse=True, cache=True)
+
+    def test_evaluate(self, array, scipy_sparse):
+        matrices = Matrix()
+        matrices.set_category('IV_Skims')
+        matrices.add_data_matrix('KM')
+        evaluator = FormulaEvaluator(
+            matrices, {'KM': scipy_sparse.coo_matrix(array)}, chunksize=2)
+        formula = 'Matrix([CODE] = "KM") * 2 + TRANSPOSE(Matrix([NO]=108))'
+        np.testing.assert_allclose(evaluator.evaluate(formula),
+                                   array * 2 + array.T)
+        result = evaluator.evaluate(formula, sparse=True)
+        assert scipy_sparse.issparse(result)
+        np.testing.assert_allclose(result.toarray(), array * 2 + array.T)
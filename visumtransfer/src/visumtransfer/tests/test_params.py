@@ -0,0 +1,144 @@
+import os
+import pytest
+import pandas as pd
+from visumtransfer.params import Params
+
+
+@pytest.fixture
+def params_excel_fp(tmp_path) -> str:
+    """a params-excelfile with a small sheet for each params-table"""
+    excel_fp = str(tmp_path / 'params.xlsx')
+    modes = pd.DataFrame({'code': ['F', 'O', 'P'],
+                          'name': ['Fuss', 'OV', 'Pkw'],
+                          'rank': [1, '', 3], })
+    time_series = pd.DataFrame({'code': [1, 2],
+                                'from_hour': [0, 6],
+                                'to_hour': [6, 24], })
+    hours = pd.DataFrame([[0.5, 0.5], [0.2, 0.8]], columns=[0, 1])
+    with pd.ExcelWriter(excel_fp) as excel:
+        for tablename in Params.attr2tablename.values():
+            if tablename == 'modes':
+                df = modes
+            elif tablename == 'time_series':
+                df = time_series
+            elif tablename == 'activitypair_time_series':
+                df = hours
+            else:
+                df = pd.DataFrame({'code': ['A', 'B'], 'value': [1, 2]})
+            df.to_excel(excel, sheet_name=tablename[:30], index=False)
+    return excel_fp
+
+
+class TestParams:
+    def test_read_params(self, params_excel_fp):
+        params = Params(params_excel_fp)
+        assert params.mode_set == 'F,O,P'
+        assert params.time_series['to_hour'].tolist() == [6, 24]
+        assert set(params.dataframes) == set(Params.attr2tablename)
+
+    @pytest.mark.parametrize('use_hash', [False, True])
+    def test_cache(self, params_excel_fp, use_hash):
+        params = Params(params_excel_fp)
+        cached = Params(params_excel_fp, cache=True, use_hash=use_hash,
+                        prefetch=Params.attr2tablename)
+        cache_folder = Params.get_cache_folder(params_excel_fp)
+        assert len(os.listdir(cache_folder)) == len(Params.attr2tablename)
+
+        # read only from the cache
+        from_cache = Params(params_excel_fp, cache=True, use_hash=use_hash)
+        for k in Params.attr2tablename:
+            pd.testing.assert_frame_equal(params.dataframes[k],
+                                          cached.dataframes[k])
+            pd.testing.assert_frame_equal(params.dataframes[k],
+                                          from_cache.dataframes[k])
+
+        # change the excel-file, the cache should be renewed
+        time_series = params.time_series.copy()
+        time_series['to_hour'] = [10, 24]
+        with pd.ExcelWriter(params_excel_fp, mode='a',
+                            if_sheet_exists='replace') as excel:
+            time_series.to_excel(excel, sheet_name='time_series', index=False)
+        changed = Params(params_excel_fp, cache=True, use_hash=use_hash)
+        assert changed.time_series['to_hour'].tolist() == [10, 24]
+        changed.prefetch()
+        assert len(os.listdir(cache_folder)) == len(Params.attr2tablename)
+
+    def test_cache_same_prefix(self, params_excel_fp):
+        params = Params(params_excel_fp, cache=True)
+        df = pd.DataFrame({'code': ['A'], 'value': [1]})
+        params.write_cache('trip_chain_rates_rsa', df)
+        params.write_cache('trip_chain_rates', df)
+        cache_folder = Params.get_cache_folder(params_excel_fp)
+        assert len(os.listdir(cache_folder)) == 2
+        #  an outdated file of the table itself is removed
+        params.cache_key = 'abc123'
+        params.write_cache('trip_chain_rates', df)
+        assert sorted(os.listdir(cache_folder)) == [
+            'trip_chain_rates_abc123.parquet',
+            f'trip_chain_rates_rsa_{Params.get_cache_key(params_excel_fp)}'
+            '.parquet']
+
+    def test_lazy(self, params_excel_fp):
+        params = Params(params_excel_fp, cache=True)
+        assert params.dataframes.loaded == []
+        assert params.mode_set == 'F,O,P'
+        assert params.dataframes.loaded == ['modes']
+        cache_folder = Params.get_cache_folder(params_excel_fp)
+        assert len(os.listdir(cache_folder)) == 1
+        assert params.dataframes['modes'] is params.modes
+
+        params.prefetch(['time_series', 'activitypair_time_series'],
+                        max_workers=2)
+        assert set(params.dataframes.loaded) == {
+            'modes', 'time_series', 'activitypair_time_series'}
+        with pytest.raises(KeyError):
+            params.prefetch(['unknown'])
+        with pytest.raises(AttributeError):
+            params.unknown
+
+        # set a table as attribute
+        params.modes = pd.DataFrame({'code': ['M']})
+        assert params.dataframes['modes'] is params.modes
+        assert len(dict(params.dataframes)) == len(Params.attr2tablename)
+
+    def test_schema(self, params_excel_fp):
+        activitypairs = pd.DataFrame({'code': [1, 2],
+                                      'qa': ['W', 'A'],
+                                      'za': ['A', 'W'], })
+        time_series = pd.DataFrame({'code': [1, 2],
+                                    'from_hour': [0, 6],
+                                    'to_hour': [6.5, ''], })
+        with pd.ExcelWriter(params_excel_fp, mode='a',
+                            if_sheet_exists='replace') as excel:
+            activitypairs.to_excel(excel, sheet_name='activitypairs',
+                                   index=False)
+            time_series.to_excel(excel, sheet_name='time_series', index=False)
+        params = Params(params_excel_fp)
+        # codes, that look like numbers, stay text
+        assert params.activitypairs['code'].tolist() == ['1', '2']
+        assert isinstance(params.modes['code'].dtype, pd.CategoricalDtype)
+        assert params.mode_set == 'F,O,P'
+        # undeclared columns are kept as parsed
+        assert params.modes['rank'].tolist() == [1, '', 3]
+        # declared int-columns are converted
+        assert params.time_series['code'].dtype == 'int64'
+        assert params.time_series['from_hour'].dtype == 'int64'
+
+        report = params.validation_report(['time_series', 'activitypairs'])
+        problems = report.set_index('column')['problem'].to_dict()
+        assert problems == {'name_long': 'missing',
+                            'to_hour': 'wrong type',
+                            'Ganglinie_OVFern': 'missing', }
+        # float values in int-columns are not truncated
+        assert params.time_series['to_hour'][0] == 6.5
+
+    def test_copy(self, params_excel_fp):
+        params = Params(params_excel_fp)
+        modes = pd.DataFrame({'code': ['M']})
+        params_copy = params.copy(overrides={'modes': modes})
+        assert params_copy.mode_set == 'M'
+        assert params.mode_set == 'F,O,P'
+        params_copy.time_series.loc[0, 'code'] = 99
+        assert params.time_series.loc[0, 'code'] == 1
+        with pytest.raises(KeyError):
+            params.copy(overrides={'unknown': modes})
@@ -0,0 +1,131 @@
+import pytest
+import pandas as pd
+from visumtransfer.visum_tables import (PersonGroup,
+                                        Activity,
+                                        Activitychain,
+                                        DemandStratum)
+
+
+@pytest.fixture
+def persongroups() -> PersonGroup:
+    pg = PersonGroup()
+    pg.add_cols(['CATEGORY', 'CODEPART', 'NAMEPART',
+                 'GROUPS_CONSTANTS', 'GROUPS_OUTPUT', 'GROUP_GENERATION',
+                 'MAIN_ACT', 'TARIFMATRIX'])
+    pg.add(code='AR', name='Arbeiter', category='occupation',
+           codepart='AR', namepart='Arbeiter')
+    pg.add(code='RE', name='Rentner', category='occupation',
+           codepart='RE', namepart='Rentner', tarifmatrix='SENIOR')
+    pg.add(code='M', name='mit Pkw', category='car', codepart='M',
+           namepart='mit Pkw')
+    gd = pg.get_groups_destmode(['occupation', 'car'],
+                                new_category='Erzeugung')
+    pg.add_df(gd)
+    return pg
+
+
+@pytest.fixture
+def activities() -> Activity:
+    acts = Activity()
+    acts.add(code='W', rank=0, ishomeactivity=1)
+    acts.add(code='A', rank=1, ishomeactivity=0)
+    acts.add(code='E', rank=2, ishomeactivity=0)
+    return acts
+
+
+class TestPersonGroup:
+    def test_get_groups_destmode(self, persongroups):
+        persongroups.add(code='O', name='ohne Pkw', category='car',
+                         codepart='O', namepart='')
+        gd = persongroups.get_groups_destmode(['occupation', 'car'],
+                                              new_category='Erzeugung')
+        assert gd['CODE'].tolist() == ['ARM', 'ARO', 'REM', 'REO']
+        assert gd['NAME'].tolist() == ['Arbeiter, mit Pkw', 'Arbeiter',
+                                       'Rentner, mit Pkw', 'Rentner']
+        assert gd['GROUPS_CONSTANTS'].tolist() == ['AR,M', 'AR,O',
+                                                   'RE,M', 'RE,O']
+
+        def no_retired_without_car(combinations: pd.DataFrame):
+            if 'car' not in combinations:
+                return combinations['occupation'] != 'XX'
+            return ~((combinations['occupation'] == 'RE') &
+                     (combinations['car'] == 'O'))
+
+        gd = persongroups.get_groups_destmode(['occupation', 'car'],
+                                              new_category='Erzeugung',
+                                              prune=no_retired_without_car)
+        assert gd['CODE'].tolist() == ['ARM', 'ARO', 'REM']
+        assert (gd['CATEGORY'] == 'Erzeugung').all()
+
+    def test_create_demand_strata(self, persongroups, activities):
+        trip_chain_rates = pd.DataFrame({
+            'code_tc': ['WAW', 'WEW', 'WAEW', 'WEW'],
+            'Sequence': ['W,A,W', 'W,E,W', 'W,A,E,W', 'W,E,W'],
+            'group_generation': ['AR', 'AR', 'AR', 'RE'],
+            'rate': [1.2, 0.5, 0.2, 0.8]})
+        dstrats = DemandStratum()
+        persongroups.create_demand_strata(
+            pd.DataFrame(), trip_chain_rates, activities, Activitychain(),
+            dstrats, 'VisemT', tc_categories=['occupation'],
+            category='ZielVMWahl', category_generation='Erzeugung',
+            output_categories=['occupation'])
+        assert 'gr_tc' not in trip_chain_rates
+
+        assert dstrats.df.index.tolist() == [
+            'ARM:WAW', 'ARM:WEW', 'ARM:WAEW', 'REM:WEW']
+        assert dstrats.df['PERSONGROUPCODES'].tolist() == [
+            'ARM_A', 'ARM_E', 'ARM_A', 'REM_E']
+        assert dstrats.df.loc['ARM:WAEW', 'NAME'] == \
+            'Arbeiter, mit Pkw, Wegekette WAEW'
+        assert persongroups.gd_codes['ARM_A'] == [('WAW', 1.2),
+                                                  ('WAEW', 0.2)]
+
+        persongroups.create_df_from_group_list()
+        groups = persongroups.df.loc[['ARM_A', 'ARM_E', 'REM_E']]
+        assert groups['GROUPS_OUTPUT'].tolist() == ['AR', 'AR', 'RE']
+        assert groups['TARIFMATRIX'].tolist() == ['', '', 'SENIOR']
+        assert groups['NAME'].tolist()[-1] == \
+            'Rentner, mit Pkw mit Hauptaktivität E'
+
+
+class TestActivity:
+    def test_get_main_activities(self, activities):
+        sequences = pd.Series(['W,A,E,W', 'W,E,W', 'W', 'W,E,A,W'],
+                              index=[3, 5, 7, 9])
+        hierarchy = activities.get_hierarchy()
+        expected = [activities.get_main_activity(hierarchy, s)
+                    for s in sequences]
+        main_activities = activities.get_main_activities(sequences)
+        assert main_activities.tolist() == expected == ['A', 'E', 'W', 'A']
+        assert main_activities.index.tolist() == [3, 5, 7, 9]
+        assert len(activities._main_activities) == 4
+
+        #  another hierarchy is not answered from the cache
+        hierarchy = {'E': 0, 'A': 1, 'W': 2}
+        assert activities.get_main_activities(
+            sequences, hierarchy).tolist() == ['E', 'E', 'W', 'E']
+        with pytest.raises(KeyError):
+            activities.get_main_activities(pd.Series(['W,X,W']))
+
+    def test_cached_properties(self, activities):
+        activities.df['CALCDESTMODE'] = [0, 1, 1]
+        activities.df['COMPOSITE_ACTIVITIES'] = ['', 'S', 'S']
+        assert activities._homeactivity == 'W'
+        assert activities.all_non_composite_activites == 'A,E,W'
+        assert activities.get_hierarchy() == {'A': 0, 'E': 1, 'W': 2}
+
+        #  in-place edits invalidate the cache
+        activities.df.loc['E', 'RANK'] = 0
+        assert activities.get_hierarchy() == {'E': 0, 'A': 1, 'W': 2}
+        activities.df.loc['E', 'RANK'] = 2
+
+        #  adding rows invalidates the cache
+        activities.add(code='B', rank=0, ishomeactivity=0, calcdestmode=1,
+                       composite_activities='S')
+        activities.add(code='S', rank=3, ishomeactivity=0, calcdestmode=0)
+        assert activities.all_non_composite_activites == 'A,B,E,W'
+        assert list(activities.get_hierarchy()) == ['B', 'A', 'E', 'S', 'W']
+
+        activities.set_activityset()
+        assert activities.df['ACTIVITYSET'].tolist() == [
+            'W', 'A', 'E', 'B', 'A,B,E']
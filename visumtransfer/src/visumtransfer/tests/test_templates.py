@@ -0,0 +1,84 @@
+import pytest
+import pandas as pd
+from visumtransfer.visum_tables import (Matrix,
+                                        UserDefinedAttribute,
+                                        MatrixTemplate,
+                                        AttributeTemplate,
+                                        TemplateEngine)
+from visumtransfer.visum_tables.matrices import MatrixCategories
+
+
+@pytest.fixture
+def frame() -> pd.DataFrame:
+    return pd.DataFrame({'code': ['W', 'A', 'E'],
+                         'name': ['Wohnen', 'Arbeit', 'Einkauf'],
+                         'is_not_home': [False, True, True]},
+                        index=['W', 'A', 'E'])
+
+
+class TestTemplateEngine:
+    def test_allocate(self):
+        blocks = {'A': range(1, 3), 'B': range(3, 10),
+                  '_fallback': range(10, 100)}
+        categories = ['A', 'B', 'A', 'A', 'B', 'A']
+        sequential = MatrixCategories(blocks)
+        expected = [sequential.next_numbers(c, 1)[0] for c in categories]
+        assert expected == [1, 3, 2, 10, 4, 11]
+        assert MatrixCategories(blocks).allocate(categories) == expected
+
+    def test_expand(self, frame):
+        matrices = Matrix()
+        userdef = UserDefinedAttribute()
+        with TemplateEngine(matrices, userdef) as engine:
+            numbers = engine.expand(
+                frame,
+                MatrixTemplate('trips', 'Activities',
+                               code='Activity_{code}',
+                               name='Wege zu Aktivität {name}',
+                               activitycode='{code}'),
+                MatrixTemplate('mr', 'Activities_Modellierungsraum',
+                               code='MR_Activity_{code}',
+                               formula='Matrix([CODE] = "Activity_{code}")',
+                               where='is_not_home'),
+                AttributeTemplate('ZONE',
+                                  name='Trips_{code}',
+                                  formula='[MATROWSUM({no[mr|trips]:d})]',
+                                  userdefinedgroupname='Wege'),
+                AttributeTemplate('ACTIVITY',
+                                  name='Target_{code}',
+                                  defaultvalue=1,
+                                  where=lambda df: df['code'] != 'E'),
+            )
+            #  the rows are appended when leaving the context
+            assert not len(matrices.df)
+
+        assert numbers['trips'].tolist() == [700, 701, 702]
+        assert numbers['mr'].isna().tolist() == [True, False, False]
+        df = matrices.df
+        assert df['CODE'].tolist() == ['Activity_W', 'Activity_A',
+                                       'MR_Activity_A', 'Activity_E',
+                                       'MR_Activity_E']
+        assert df.loc[700, 'NAME'] == 'Wege zu Aktivität Wohnen'
+        assert df.loc[1300, 'DATASOURCETYPE'] == 'FORMULA'
+        assert df.loc[1300, 'NAME'] == 'MR_Activity_A'
+        assert df.loc[1300, 'CATEGORY'] == 'Activities_Modellierungsraum'
+        assert df.loc[701, 'LOADMATRIX'] == 0
+
+        attrs = userdef.df
+        assert attrs.loc[('ZONE', 'Trips_W'), 'FORMULA'] == \
+            '[MATROWSUM(700)]'
+        assert attrs.loc[('ZONE', 'Trips_A'), 'FORMULA'] == \
+            '[MATROWSUM(1300)]'
+        assert attrs.loc[('ACTIVITY', 'Target_A'), 'DATASOURCETYPE'] == 'DATA'
+        assert attrs.loc[('ACTIVITY', 'Target_A'), 'CODE'] == 'Target_A'
+        assert ('ACTIVITY', 'Target_E') not in attrs.index
+
+    def test_errors(self, frame):
+        template = MatrixTemplate('trips', 'Activities', code='{code}')
+        with pytest.raises(ValueError):
+            TemplateEngine().expand(frame, template)
+        broken = AttributeTemplate('ZONE', name='X_{code}',
+                                   formula='[MATROWSUM({no[vl]:d})]')
+        with pytest.raises(KeyError):
+            TemplateEngine(Matrix(), UserDefinedAttribute()).expand(
+                frame, template, broken)
@@ -0,0 +1,174 @@
+import pytest
+import numpy as np
+import pandas as pd
+import xarray as xr
+from visumtransfer.visum_tables import (PersonGroup,
+                                        DemandDescription,
+                                        DemandSegment,
+                                        TimeSeries,
+                                        TimeSeriesItem,
+                                        DemandTimeSeries,
+                                        VisemTimeSeries)
+
+
+@pytest.fixture
+def activitypairs() -> pd.DataFrame:
+    return pd.DataFrame({'code': ['WA', 'AW', 'WE'],
+                         'idx': [0, 1, 2]})
+
+
+@pytest.fixture
+def ap_timeseries() -> pd.DataFrame:
+    df = pd.DataFrame(np.array([[0, .2, .3, .5],
+                                [0, 0, .4, .6],
+                                [0, .2, .3, .5]]))
+    df.insert(0, 'activitypair', ['WA', 'AW', 'WE'])
+    return df
+
+
+@pytest.fixture
+def time_series() -> pd.DataFrame:
+    return pd.DataFrame({'code': [1, 2],
+                         'from_hour': [0, 2],
+                         'to_hour': [2, 4]})
+
+
+@pytest.fixture
+def persongroups() -> PersonGroup:
+    pg = PersonGroup()
+    pg.add(code='AR', name='Arbeiter', demandmodelcode='VisemT')
+    pg.add(code='SC', name='Schüler', demandmodelcode='VisemT')
+    return pg
+
+
+class TestTimeSeries:
+    def test_create_tables(self, activitypairs, ap_timeseries,
+                           time_series, persongroups):
+        ts = TimeSeries()
+        items = TimeSeriesItem()
+        demand_ts = DemandTimeSeries()
+        visem_ts = VisemTimeSeries()
+        ts.create_tables(activitypairs, time_series, ap_timeseries,
+                         items, demand_ts, visem_ts, persongroups)
+
+        assert ts.df.index.tolist() == [100, 101, 102]
+        assert ts.df['NAME'].tolist() == ['WA', 'AW', 'WE']
+        assert demand_ts.df['TIMESERIESNO'].tolist() == [100, 101, 102]
+
+        #  intervals without trips get no item
+        weights = items.df['WEIGHT']
+        assert weights.index.tolist() == [(100, 0, 7200),
+                                          (100, 7200, 14400),
+                                          (101, 7200, 14400),
+                                          (102, 0, 7200),
+                                          (102, 7200, 14400)]
+        np.testing.assert_allclose(weights, [.2, .8, 1, .2, .8])
+
+        assert visem_ts.df.index.tolist()[:3] == [('WA', 'AR'), ('WA', 'SC'),
+                                                  ('AW', 'AR')]
+        assert visem_ts.df['TIMESERIESNO'].tolist() == [100, 100, 101, 101,
+                                                        102, 102]
+
+    def test_deduplicate(self, activitypairs, ap_timeseries,
+                         time_series, persongroups):
+        #  the profile of AW is the profile of WA scaled
+        ap_timeseries.iloc[1, 1:] = ap_timeseries.iloc[0, 1:] * 2
+        ts = TimeSeries()
+        items = TimeSeriesItem()
+        demand_ts = DemandTimeSeries()
+        visem_ts = VisemTimeSeries()
+        ts.create_tables(activitypairs, time_series, ap_timeseries,
+                         items, demand_ts, visem_ts, persongroups,
+                         deduplicate=True)
+        assert ts.df.index.tolist() == [100]
+        assert ts.df['NAME'].tolist() == ['WA,AW,WE']
+        assert items.df.index.get_level_values(0).unique().tolist() == [100]
+        assert demand_ts.df.index.tolist() == [100, 101, 102]
+        assert (demand_ts.df['TIMESERIESNO'] == 100).all()
+        assert (visem_ts.df['TIMESERIESNO'] == 100).all()
+
+    def test_deduplicate_nan(self, activitypairs, ap_timeseries,
+                             time_series, persongroups):
+        #  WA and WE share the profile with a missing share,
+        #  which is skipped in the sum of the interval
+        ap_timeseries.iloc[[0, 2], 3] = np.nan
+        ts = TimeSeries()
+        items = TimeSeriesItem()
+        ts.create_tables(activitypairs, time_series, ap_timeseries,
+                         items, DemandTimeSeries(), VisemTimeSeries(),
+                         persongroups, deduplicate=True)
+        assert ts.df.index.tolist() == [100, 101]
+        assert items.df.index.get_level_values(0).unique().tolist() == [
+            100, 101]
+        assert items.df.loc[100, 'WEIGHT'].tolist() == [.2, .5]
+
+    def test_get_shared_numbers(self):
+        weights = np.array([[1, 3], [2, 6], [3, 1], [0, 0], [0, 0]])
+        numbers = np.array([10, 11, 12, 13, 14])
+        np.testing.assert_array_equal(
+            TimeSeries.get_shared_numbers(weights, numbers),
+            [10, 10, 12, 13, 13])
+
+
+class TestDemandSegment:
+    @pytest.fixture
+    def ds_timeseries(self) -> xr.Dataset:
+        ganglinie = np.zeros((3, 24))
+        ganglinie[0, 6:9] = [1, 2, 1]
+        ganglinie[1, 6:9] = [2, 4, 2]
+        ganglinie[2, 16:18] = [1, 1]
+        return xr.Dataset(
+            {'ganglinie': (('hap', 'stunde'), ganglinie)},
+            coords={'hap': [1, 2, 3],
+                    'stunde': np.arange(24),
+                    'lab_hap': ('hap', ['Arbeit', 'Schule', 'Einkauf'])})
+
+    @pytest.mark.parametrize('deduplicate', [False, True])
+    def test_add_ov_ganglinien(self, ds_timeseries, deduplicate):
+        dsegs = DemandSegment()
+        ts = TimeSeries()
+        items = TimeSeriesItem()
+        demand_ts = DemandTimeSeries()
+        demand_description = DemandDescription()
+        dsegs.add_ov_ganglinien(ds_timeseries, ts, items, demand_ts,
+                                demand_description, deduplicate=deduplicate)
+
+        assert dsegs.df.index.tolist() == ['OV_Arbeit', 'OV_Schule',
+                                           'OV_Einkauf']
+        assert demand_ts.df.index.tolist() == [81, 82, 83]
+        if deduplicate:
+            assert ts.df.index.tolist() == [81, 83]
+            assert ts.df['NAME'].tolist() == ['OV_Arbeit,OV_Schule',
+                                              'OV_Einkauf']
+            assert demand_ts.df['TIMESERIESNO'].tolist() == [81, 81, 83]
+            assert len(items.df) == 5
+        else:
+            assert ts.df.index.tolist() == [81, 82, 83]
+            assert demand_ts.df['TIMESERIESNO'].tolist() == [81, 82, 83]
+            assert len(items.df) == 8
+        weights = items.df.loc[81, 'WEIGHT'].astype(float)
+        np.testing.assert_allclose(weights, [.25, .5, .25])
+        assert items.df.loc[81].index.tolist() == [(21600, 25200),
+                                                   (25200, 28800),
+                                                   (28800, 32400)]
+
+    def test_hap_without_trips(self, ds_timeseries):
+        ds_timeseries['ganglinie'][2] = 0
+        items = TimeSeriesItem()
+        DemandSegment().add_ov_ganglinien(ds_timeseries, TimeSeries(), items,
+                                          DemandTimeSeries(),
+                                          DemandDescription())
+        assert items.df.index.get_level_values(0).unique().tolist() == \
+            [81, 82]
+
+    def test_dask(self, ds_timeseries):
+        pytest.importorskip('dask')
+        items = TimeSeriesItem()
+        demand_description = DemandDescription()
+        DemandSegment().add_ov_ganglinien(ds_timeseries.chunk({'hap': 1}),
+                                          TimeSeries(), items,
+                                          DemandTimeSeries(),
+                                          demand_description)
+        assert len(items.df) == 8
+        assert demand_description.df['MATRIXREF'].tolist()[0] == \
+            'MATRIX([CODE]="Visem_OV_Arbeit")'
@@ -6,7 +6,8 @@ import pandas as pd
 from visumtransfer.visum_table import (VisumTable,
                                        VisumTables,
                                        VisumTransfer,
-                                       Version)
+                                       Version,
+                                       TextBlock)
 from visumtransfer.visum_attributes import VisumAttributes
 from visumtransfer.visum_tables import (create_userdefined_table,
                                         TableDefinition,
@@ -197,3 +198,26 @@ class TestVisumTransfer:
             network.add_row(network.Row(a=7, b=9))
         assert network.df.loc[0, 'A'] == 4
         assert network.df.loc[0, 'B'] == 7
+
+    def test_text_blocks(self, dataframe):
+        """write the blocks kept from a transfer again"""
+        dummy = DummyTable(mode='*')
+        dummy.add_df(dataframe)
+        vt = VisumTransfer.new_transfer()
+        vt.tables['Dummy'] = dummy
+        vt.tables['Empty'] = Bezirke()
+        folder = tempfile.mkdtemp()
+        fn = os.path.join(folder, 'a.tra')
+        vt.write(fn, keep_blocks=True)
+        assert list(vt.blocks) == ['Version', 'Dummy']
+
+        vt2 = VisumTransfer.new_transfer()
+        for name, block in vt.blocks.items():
+            vt2.tables[name] = TextBlock(block)
+        assert vt2.tables['Dummy'].code == 'DUMMY'
+        assert vt2.tables['Dummy']._mode == '*'
+        fn2 = os.path.join(folder, 'b.tra')
+        vt2.write(fn2)
+        with open(fn, encoding='cp1252') as f, \
+                open(fn2, encoding='cp1252') as f2:
+            assert f.read() == f2.read()
@@ -0,0 +1,78 @@
+import io
+import pytest
+import pandas as pd
+from visumtransfer.visum_table import WriteLine
+from visumtransfer.visum_tables import Zone
+
+
+@pytest.fixture
+def pgr_file(tmp_path) -> str:
+    fn = tmp_path / 'pgr.csv'
+    fn.write_text('vz_id,name,AR_M,ST\n'
+                  '1,a,10,\n'
+                  '2, b, 3.5, 4\n'
+                  '7,c,,2\n')
+    return str(fn)
+
+
+@pytest.fixture
+def strukturdaten_file(tmp_path) -> str:
+    fn = tmp_path / 'strukturdaten.csv'
+    fn.write_text('vz_id,name,ValStructuralPropEW,ValStructuralProp(AP),'
+                  'Flaeche\n'
+                  '1,a,10,1,2\n'
+                  '2,b,3,4,5\n')
+    return str(fn)
+
+
+class TestZoneImport:
+
+    @pytest.mark.parametrize('chunksize', [None, 2])
+    def test_read_pgr(self, pgr_file, chunksize):
+        zones = Zone()
+        zones.read_pgr(pgr_file, chunksize=chunksize)
+        assert zones._mode == '*'
+        assert zones.cols == ['NO', 'NumPersons(AR_M)', 'NumPersons(ST)']
+        expected = pd.DataFrame({'NumPersons(AR_M)': [10, 3.5, 0],
+                                 'NumPersons(ST)': [0, 4, 2]},
+                                index=pd.Index([1, 2, 7], name='NO'))
+        pd.testing.assert_frame_equal(zones.df, expected)
+
+    @pytest.mark.parametrize('chunksize', [None, 1, 2])
+    def test_read_missing_values(self, strukturdaten_file, chunksize):
+        with open(strukturdaten_file, 'a') as f:
+            f.write('3,c,,5,\n')
+        zones = Zone()
+        zones.read_strukturdaten(strukturdaten_file, chunksize=chunksize)
+        #  missing values are 0 and the integral columns stay int
+        assert zones.df['ValStructuralProp(EW)'].tolist() == [10, 3, 0]
+        assert zones.df['Flaeche'].tolist() == [2, 5, 0]
+        assert (zones.df.dtypes == 'int64').all()
+        f = io.StringIO()
+        zones.write_block(WriteLine(f))
+        assert '3;0;5;0' in f.getvalue().splitlines()
+
+    def test_read_pgr_pyarrow(self, pgr_file):
+        pytest.importorskip('pyarrow')
+        zones = Zone()
+        zones.read_pgr(pgr_file, engine='pyarrow')
+        expected = Zone()
+        expected.read_pgr(pgr_file)
+        pd.testing.assert_frame_equal(zones.df, expected.df)
+        with pytest.raises(ValueError, match='chunksize'):
+            Zone().read_pgr(pgr_file, engine='pyarrow', chunksize=2)
+
+    def test_read_strukturdaten(self, strukturdaten_file):
+        zones = Zone()
+        zones.read_strukturdaten(strukturdaten_file)
+        assert zones.cols == ['NO', 'ValStructuralProp(EW)',
+                              'ValStructuralProp(AP)', 'Flaeche']
+        assert zones.df.loc[2, 'ValStructuralProp(AP)'] == 4
+        assert zones.df['Flaeche'].tolist() == [2, 5]
+
+    def test_add_df_case_insensitive(self):
+        zones = Zone(mode='*')
+        zones._cols = 'NO;NumPersons(AR)'
+        zones.add_df(pd.DataFrame({'no': [1, 2],
+                                   'NUMPERSONS(AR)': [3., 4.]}))
+        assert zones.df['NumPersons(AR)'].tolist() == [3., 4.]
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+from collections import OrderedDict
+from typing import Dict, List
+
+import pandas as pd
+
+from visumtransfer.visum_table import VisumTable, VisumTransfer
+
+
+class TransferCacheError(Exception):
+    """the cached transfer cannot be used, the transfer has to be rebuilt"""
+
+
+class TransferCache:
+    """
+    The text blocks of the tables of a transfer file and the hashes
+    of the params-sheets they were created from.
+    Some dataframes are stored, too, to rebuild other tables from them.
+    """
+    #  the tables whose dataframes are stored
+    dataframe_tables = ['PersonGroups', 'Matrizen']
+
+    def __init__(self, folder: str, key: str = ''):
+        """
+        Parameters
+        ----------
+        folder : str
+            the folder of the cache
+        key : str, optional
+            the key of the code creating the transfer,
+            a cache stored with another key is not used
+        """
+        self.folder = folder
+        self.key = key
+        self.sheet_hashes = {}  # type: Dict[str, str]
+        self.blocks = OrderedDict()  # type: Dict[str, str]
+        self.dataframes = {}  # type: Dict[str, pd.DataFrame]
+
+    @property
+    def tables(self) -> List[str]:
+        """the names of the tables in the order of the transfer file"""
+        return list(self.blocks)
+
+    @property
+    def index_fn(self) -> str:
+        return os.path.join(self.folder, 'index.json')
+
+    def _block_fn(self, name: str) -> str:
+        return os.path.join(self.folder, f'{name}.txt')
+
+    def _dataframe_fn(self, name: str) -> str:
+        return os.path.join(self.folder, f'{name}.pkl')
+
+    def load(self) -> bool:
+        """load the cache, return False, if there is no complete cache"""
+        if not os.path.exists(self.index_fn):
+            return False
+        with open(self.index_fn, encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('key', '') != self.key:
+            return False
+        blocks = OrderedDict()
+        dataframes = {}
+        try:
+            for name in index['tables']:
+                #  keep the line endings as they are
+                with open(self._block_fn(name), encoding='cp1252',
+                          newline='') as f:
+                    blocks[name] = f.read()
+            for name in self.dataframe_tables:
+                dataframes[name] = pd.read_pickle(self._dataframe_fn(name))
+        except (FileNotFoundError, KeyError):
+            return False
+        self.sheet_hashes = index['sheet_hashes']
+        self.blocks = blocks
+        self.dataframes = dataframes
+        return True
+
+    def changed_sheets(self, sheet_hashes: Dict[str, str]) -> List[str]:
+        """return the sheets whose hashes differ from the cached hashes"""
+        return [k for k, h in sheet_hashes.items()
+                if self.sheet_hashes.get(k) != h]
+
+    def store(self, vt: VisumTransfer, sheet_hashes: Dict[str, str]):
+        """
+        store the blocks written by `vt.write(fn, keep_blocks=True)`
+        tables, which are not VisumTables, are taken from the cache already
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        blocks = OrderedDict()
+        for name, table in vt.tables.items():
+            block = vt.blocks.get(name, '')
+            blocks[name] = block
+            if not isinstance(table, VisumTable) \
+               and self.blocks.get(name) == block:
+                continue
+            with open(self._block_fn(name), 'w', encoding='cp1252',
+                      newline='') as f:
+                f.write(block)
+        for name in self.dataframe_tables:
+            table = vt.tables.get(name)
+            if isinstance(table, VisumTable):
+                self.dataframes[name] = table.df
+                table.df.to_pickle(self._dataframe_fn(name))
+        self.blocks = blocks
+        self.sheet_hashes = dict(sheet_hashes)
+        #  write the index last, so that an incomplete cache is not used
+        with open(self.index_fn, 'w', encoding='utf-8') as f:
+            json.dump(dict(key=self.key,
+                           sheet_hashes=self.sheet_hashes,
+                           tables=self.tables), f, indent=2)
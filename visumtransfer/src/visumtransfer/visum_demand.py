@@ -2,15 +2,17 @@
 
 
 import os
+import json
 import pandas as pd
 from argparse import ArgumentParser
 from typing import List
 
 from visumtransfer.visum_table import (
-    VisumTransfer)
+    VisumTransfer, TextBlock)
 
 from visumtransfer.visum_tables import (
     Matrix,
+    MatrixBlockError,
     UserDefinedGroup,
     UserDefinedAttribute,
     Demandmodel,
@@ -30,21 +32,106 @@ from visumtransfer.visum_tables import (
     create_userdefined_table,
 )
 
+from visumtransfer._version import __version__
 from visumtransfer.params import Params
+from visumtransfer.transfer_cache import TransferCache, TransferCacheError
 
 
 class VisemDemandModel:
     """create a transfer file for a VisemModel"""
+    model_code = 'VisemGGR'
+    model_name = 'Visem Ziel- und Verkehrsmittelwahlmodell'
+    dsegcodes = ['O'] # , 'AboA', 'AboJ', 'AboS']
+
+    #  the tables of the transfer file created from each params-sheet
+    sheet_dependencies = dict(
+        group_definitions=['BenutzerdefinierteAttribute1',
+                           'CarAvailabiliity',
+                           'PersongroupCategories',
+                           'PersonGroups',
+                           'DemandStratum',
+                           'Matrizen',
+                           'BenutzerdefinierteAttribute2',
+                           'VisemGanglinien'],
+        groups_generation=[],
+        activities=['Strukturgr',
+                    'Aktivitaet',
+                    'BenutzerdefinierteAttribute1',
+                    'PersonGroups',
+                    'DemandStratum',
+                    'Matrizen',
+                    'BenutzerdefinierteAttribute2',
+                    'VisemGanglinien'],
+        activity_parking=[],
+        activitypairs=['Activitypair',
+                       'Ganglinie',
+                       'Ganglinienelement',
+                       'VisemGanglinien'],
+        activitypair_time_series=['Ganglinie',
+                                  'Ganglinienelement',
+                                  'VisemGanglinien'],
+        time_series=['DemandSegments',
+                     'Matrizen',
+                     'Ganglinie',
+                     'Ganglinienelement',
+                     'VisemGanglinien'],
+        trip_chain_rates=['Activitychain',
+                          'BenutzerdefinierteAttribute1',
+                          'PersonGroups',
+                          'DemandStratum',
+                          'Matrizen',
+                          'BenutzerdefinierteAttribute2',
+                          'VisemGanglinien'],
+        validation_activities=[],
+        validation_activities_hauptweg=[],
+        modes=['Nachfragemodell',
+               'BenutzerdefinierteAttribute1',
+               'Aktivitaet',
+               'PersonGroups',
+               'Matrizen',
+               'BenutzerdefinierteAttribute2'],
+        trip_chain_rates_rsa=['BenutzerdefinierteAttribute1',
+                              'PersonGroups',
+                              'DemandStratum',
+                              'Matrizen',
+                              'BenutzerdefinierteAttribute2',
+                              'VisemGanglinien'],
+        accessibilities=['Matrizen',
+                         'BenutzerdefinierteAttribute2'],
+        dseg_matrices=['Matrizen'],
+    )
+    #  the sheets, whose tables can be rebuilt without a full rebuild
+    refreshable_sheets = ['activitypairs',
+                          'activitypair_time_series',
+                          'time_series']
+    #  the groups of matrix categories created from the time series,
+    #  each group is added in one go by add_ov_kg_matrices and add_ov_demand
+    time_series_categories = [['OV_TimeSeries_Skims',
+                               'OV_TimeSeries_Skims_Formula',
+                               'OV_Skims_Fare'],
+                              ['OV_Demand']]
 
     def __init__(self,
                  modifications: str,
-                 param_excel_fp: str):
+                 param_excel_fp: str,
+                 cache_params: bool = False):
         self.modifications = modifications
         self.params_excel_fp = param_excel_fp
+        self.cache_params = cache_params
 
-    def create_transfer(self, params: Params, modification_number: int):
+    def create_transfer(self,
+                        params: Params,
+                        modification_number: int) -> VisumTransfer:
+        """build the transfer and write it as modification"""
+        vt = self.build_transfer(params)
+        fn = vt.get_modification(modification_number, self.modifications)
+        vt.write(fn=fn)
+        return vt
+
+    def build_transfer(self, params: Params) -> VisumTransfer:
+        """build all tables of the transfer from the params"""
 
-        dsegcodes = ['O'] # , 'AboA', 'AboJ', 'AboS']
+        dsegcodes = self.dsegcodes
 
         vt = VisumTransfer.new_transfer()
 
@@ -61,8 +148,8 @@ class VisemDemandModel:
         tbl_pgrcat = self.add_pgr_categories(vt, tabledef, userdef1)
         vt.tables['PersongroupCategories'] = tbl_pgrcat
 
-        model_code = 'VisemGGR'
-        model_name = 'Visem Ziel- und Verkehrsmittelwahlmodell'
+        model_code = self.model_code
+        model_name = self.model_name
         self.add_demand_model(model_code, model_name, params.mode_set, vt)
 
         self.add_modes(vt, userdef1)
@@ -76,6 +163,7 @@ class VisemDemandModel:
         tbl_model, tbl_ca = self.add_params_persongrupmodel(
             tabledef,
             userdef1,
+            params,
             pgr_summe=pgr_summe)
         vt.tables['ParamfilePersongroupmodel'] = tbl_model
         vt.tables['CarAvailabiliity'] = tbl_ca
@@ -169,9 +257,123 @@ class VisemDemandModel:
             self.add_logsum_matrices(activitychains, dstrats, vt)
 
         self.add_ganglinien(pg, params, vt)
+        return vt
 
+    def create_transfer_incremental(self,
+                                    params: Params,
+                                    modification_number: int,
+                                    cache_folder: str = None,
+                                    ) -> VisumTransfer:
+        """
+        create the transfer like create_transfer, but rebuild only the tables
+        depending on the params-sheets changed since the last run.
+        The other tables are taken from the TransferCache.
+        If tables have to be rebuilt, which cannot be refreshed,
+        the whole transfer is rebuilt.
+
+        Parameters
+        ----------
+        params : Params
+            the params
+        modification_number : int
+            the number of the modification
+        cache_folder : str, optional
+            the folder of the TransferCache,
+            default: transfer_cache in the modification-folder
+        """
+        cache = TransferCache(cache_folder or
+                              os.path.join(self.modifications,
+                                           'transfer_cache'),
+                              key=self.get_cache_key())
+        #  hash the sheets before they are modified by the build
+        sheet_hashes = params.sheet_hashes()
+        vt = None
+        if cache.load():
+            changed_sheets = cache.changed_sheets(sheet_hashes)
+            try:
+                vt = self.refresh_transfer(params, cache, changed_sheets)
+            except TransferCacheError:
+                vt = None
+        if vt is None:
+            vt = self.build_transfer(params)
         fn = vt.get_modification(modification_number, self.modifications)
-        vt.write(fn=fn)
+        vt.write(fn=fn, keep_blocks=True)
+        cache.store(vt, sheet_hashes)
+        return vt
+
+    def get_cache_key(self) -> str:
+        """
+        return the key of the TransferCache, which changes
+        with the version of visumtransfer, the model and the dsegcodes
+        """
+        return json.dumps(dict(version=__version__,
+                               model_code=self.model_code,
+                               dsegcodes=list(self.dsegcodes)),
+                          sort_keys=True)
+
+    def refresh_transfer(self,
+                         params: Params,
+                         cache: TransferCache,
+                         changed_sheets: List[str]) -> VisumTransfer:
+        """
+        rebuild the tables depending on the `changed_sheets`,
+        take the other tables as text from the `cache`
+
+        Raises
+        ------
+        TransferCacheError
+            if a changed sheet is used by tables which cannot be refreshed
+            or if the refreshed matrices do not fit into the cached matrices
+        """
+        tables = set()
+        for sheet in changed_sheets:
+            depending = self.sheet_dependencies.get(sheet)
+            if depending is None or (depending and
+                                     sheet not in self.refreshable_sheets):
+                raise TransferCacheError(f'tables depending on {sheet} '
+                                         'cannot be refreshed')
+            tables.update(depending)
+
+        refreshed = VisumTransfer.new_transfer()
+        if tables & {'Ganglinie', 'Ganglinienelement', 'VisemGanglinien'}:
+            pg = PersonGroup()
+            pg.df = cache.dataframes['PersonGroups']
+            self.add_ganglinien(pg, params, refreshed)
+
+        if 'Activitypair' in tables:
+            ap = Activitypair()
+            ap.create_tables(params.activitypairs, model=self.model_code)
+            refreshed.tables['Activitypair'] = ap
+
+        if tables & {'Matrizen', 'DemandSegments'}:
+            ov_matrices = Matrix()
+            dsegs = DemandSegment()
+            #  the userdefined attributes do not depend on the time series
+            ov_matrices.add_ov_kg_matrices(params,
+                                           UserDefinedAttribute(mode=''),
+                                           dsegcodes=self.dsegcodes)
+            ov_matrices.add_ov_demand(params, dsegs=dsegs, loadmatrix=0)
+            matrices = Matrix()
+            matrices.df = cache.dataframes['Matrizen']
+            try:
+                matrices.replace_categories(ov_matrices,
+                                            self.time_series_categories)
+            except MatrixBlockError as err:
+                raise TransferCacheError(str(err)) from err
+            refreshed.tables['Matrizen'] = matrices
+            refreshed.tables['DemandSegments'] = dsegs
+
+        vt = VisumTransfer.new_transfer()
+        for name, block in cache.blocks.items():
+            if name in refreshed.tables:
+                vt.tables[name] = refreshed.tables[name]
+            else:
+                vt.tables[name] = TextBlock(block)
+        new_tables = set(refreshed.tables) - set(vt.tables)
+        if new_tables:
+            raise TransferCacheError(f'tables {sorted(new_tables)} '
+                                     'not in cache')
+        return vt
 
     def add_coefficients(self, params, userdef1, gr_coeff):
         for m in params.mode_set.split(','):
@@ -777,6 +979,7 @@ class VisemDemandModel:
     def add_params_persongrupmodel(self,
                                    tabledef: TableDefinition,
                                    userdef1: UserDefinedAttribute,
+                                   params: Params,
                                    pgr_summe: str = 'ASumme'):
 
         userdef1.add_data_attribute('Zone', 'MODELLIERUNGSRAUM', valuetype='Int',
@@ -949,7 +1152,9 @@ class VisemDemandModel:
         fn = vt.get_modification(modification_no, self.modifications)
         vt.write(fn=fn)
 
-    def create_transfer_target_values(self, params: Params, modification_no: int):
+    def create_transfer_target_values(self,
+                                      params: Params,
+                                      modification_no: int) -> VisumTransfer:
 
         cols = [f'TARGET_MS_{mode.code}' for _, mode in params.modes.iterrows()]
         v = VisumTransfer.new_transfer()
@@ -975,8 +1180,11 @@ class VisemDemandModel:
 
         fn = v.get_modification(modification_no, self.modifications)
         v.write(fn=fn)
+        return v
 
-    def create_transfer_constants(self, params: Params, modification_no: int):
+    def create_transfer_constants(self,
+                                  params: Params,
+                                  modification_no: int) -> VisumTransfer:
         cols = [f'BASECONST_{mode.code}' for _, mode in params.modes.iterrows()]
 
         v = VisumTransfer.new_transfer()
@@ -1008,9 +1216,18 @@ class VisemDemandModel:
 
         fn = v.get_modification(modification_no, self.modifications)
         v.write(fn=fn)
+        return v
 
-    def get_params(self, param_excel_fp: str) -> Params:
-        return Params(param_excel_fp)
+    def get_params(self,
+                   param_excel_fp: str,
+                   prefetch: List[str] = None) -> Params:
+        """
+        return the params, the tables in `prefetch` are read in parallel,
+        the others on first access
+        """
+        return Params(param_excel_fp,
+                      cache=self.cache_params,
+                      prefetch=prefetch)
 
 
 if __name__ == '__main__':
@@ -1019,6 +1236,10 @@ if __name__ == '__main__':
     argpase.add_argument('--param_excel_fp', type=str, default='params_long_2023_NVV.xlsx')
     argpase.add_argument('--visum_folder', type=str, default=r'D:\GGR\KS\55 Nachfragemodell')
     argpase.add_argument('--mod_number', type=int, default=2)
+    argpase.add_argument('--cache_params', action='store_true',
+                         help='cache the params-sheets as parquet-files')
+    argpase.add_argument('--incremental', action='store_true',
+                         help='rebuild only the tables of changed sheets')
     options = argpase.parse_args()
 
     param_excel_fp = os.path.join(options.infolder, options.param_excel_fp)
@@ -1027,11 +1248,16 @@ if __name__ == '__main__':
 
     dm = VisemDemandModel(modifications,
                           param_excel_fp,
+                          cache_params=options.cache_params,
                           )
 
     params = dm.get_params(param_excel_fp)
     #dm.add_nsegs_userdefined(modification_no=5, dsegcodes_put=['O'])
-    dm.create_transfer(params, modification_number=options.mod_number)
+    if options.incremental:
+        dm.create_transfer_incremental(params,
+                                       modification_number=options.mod_number)
+    else:
+        dm.create_transfer(params, modification_number=options.mod_number)
     #dm.create_transfer_constants(params, modification_no=7)
     #dm.create_transfer_target_values(params, modification_no=8)
     #dm.write_modification_iv_matrices(modification_number=9)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import threading
+import traceback
+import urllib.error
+import urllib.request
+from argparse import ArgumentParser
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List
+
+import pandas as pd
+
+from visumtransfer.visum_table import VisumTables, VisumTransfer
+from visumtransfer.visum_demand import VisemDemandModel
+
+
+class VisemDemandService:
+    """
+    Keep the Params and the VisumTables loaded
+    and build modification files on request
+    """
+    transfers = {
+        'create_transfer': VisemDemandModel.create_transfer,
+        'create_transfer_incremental':
+        VisemDemandModel.create_transfer_incremental,
+        'create_transfer_constants': VisemDemandModel.create_transfer_constants,
+        'create_transfer_target_values':
+        VisemDemandModel.create_transfer_target_values,
+    }
+
+    def __init__(self,
+                 modifications: str,
+                 param_excel_fp: str,
+                 cache_params: bool = False):
+        self.demand_model = VisemDemandModel(modifications,
+                                             param_excel_fp,
+                                             cache_params=cache_params)
+        #  load the catalog of the Visum tables and attributes once
+        self.visum_tables = VisumTables()
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self) -> float:
+        """(re-)read the params from the excel-file, return the seconds needed"""
+        t0 = time.perf_counter()
+        params = self.demand_model.get_params(
+            self.demand_model.params_excel_fp)
+        #  keep all tables loaded
+        params.prefetch()
+        with self.lock:
+            self.params = params
+        return time.perf_counter() - t0
+
+    def build_modification(self,
+                           number: int,
+                           overrides: Dict[str, List[dict]] = None,
+                           transfer: str = 'create_transfer') -> dict:
+        """
+        build modification file with the given number
+
+        Parameters
+        ----------
+        number : int
+            the number of the modification
+        overrides : dict, optional
+            params-tables to replace for this build as list of records,
+            keyed by the attribute name of the params-table
+        transfer : str, optional
+            the method of VisemDemandModel that creates the transfer
+
+        Returns
+        -------
+        result : dict
+            with the filename written, the total seconds and
+            the seconds needed to write each table
+        """
+        try:
+            create = self.transfers[transfer]
+        except KeyError:
+            raise KeyError(f'transfer {transfer} not in {list(self.transfers)}')
+        overrides = {k: pd.DataFrame.from_records(v)
+                     for k, v in (overrides or {}).items()}
+        with self.lock:
+            t0 = time.perf_counter()
+            # the transfer-methods may modify the params-tables
+            params = self.params.copy(overrides)
+            vt: VisumTransfer = create(self.demand_model, params, number)
+            duration = time.perf_counter() - t0
+        return dict(filename=vt.filename,
+                    duration=duration,
+                    timings=dict(vt.timings))
+
+    def status(self) -> dict:
+        """return the loaded params-tables and their number of rows"""
+        tables = self.params.dataframes
+        return dict(params_excel_fp=self.demand_model.params_excel_fp,
+                    modifications=self.demand_model.modifications,
+                    params={k: len(tables[k]) for k in tables.loaded},
+                    visum_tables=len(self.visum_tables.tables))
+
+
+class VisemDemandRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handle the requests to the VisemDemandServer
+
+    GET /status
+    POST /reload
+    POST /modification with json {"number": 2, "overrides": {...}}
+    """
+    server: 'VisemDemandServer'
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/status':
+            self.send_json(self.server.service.status())
+        else:
+            self.send_json({'error': f'unknown path {self.path}'}, status=404)
+
+    def do_POST(self):
+        path = self.path.rstrip('/')
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if path == '/modification':
+                result = self.server.service.build_modification(
+                    number=body['number'],
+                    overrides=body.get('overrides'),
+                    transfer=body.get('transfer', 'create_transfer'))
+            elif path == '/reload':
+                result = {'duration': self.server.service.reload()}
+            else:
+                self.send_json({'error': f'unknown path {self.path}'},
+                               status=404)
+                return
+        except Exception as e:
+            self.send_json({'error': repr(e),
+                            'traceback': traceback.format_exc()},
+                           status=500)
+            return
+        self.send_json(result)
+
+    def send_json(self, data: dict, status: int = 200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class VisemDemandServer(HTTPServer):
+    """HTTP-Server on localhost serving a VisemDemandService"""
+
+    def __init__(self,
+                 service: VisemDemandService,
+                 port: int = 8765,
+                 host: str = '127.0.0.1'):
+        super().__init__((host, port), VisemDemandRequestHandler)
+        self.service = service
+
+
+def request_modification(number: int,
+                         overrides: Dict[str, pd.DataFrame] = None,
+                         transfer: str = 'create_transfer',
+                         port: int = 8765,
+                         host: str = '127.0.0.1') -> dict:
+    """
+    request a modification file from a running VisemDemandServer
+
+    Returns
+    -------
+    result : dict
+        with the filename written and the timings
+    """
+    overrides = {k: df.to_dict(orient='records')
+                 for k, df in (overrides or {}).items()}
+    data = json.dumps(dict(number=number,
+                           overrides=overrides,
+                           transfer=transfer)).encode('utf-8')
+    req = urllib.request.Request(f'http://{host}:{port}/modification',
+                                 data=data,
+                                 headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        error = json.loads(e.read())
+        raise RuntimeError(error.get('traceback', error['error'])) from None
+
+
+if __name__ == '__main__':
+    argpase = ArgumentParser()
+    argpase.add_argument('--infolder', type=str, default=r'D:\GGR\KS\55 Nachfragemodell')
+    argpase.add_argument('--param_excel_fp', type=str, default='params_long_2023_NVV.xlsx')
+    argpase.add_argument('--visum_folder', type=str, default=r'D:\GGR\KS\55 Nachfragemodell')
+    argpase.add_argument('--port', type=int, default=8765)
+    argpase.add_argument('--cache_params', action='store_true',
+                         help='cache the params-sheets as parquet-files')
+    options = argpase.parse_args()
+
+    param_excel_fp = os.path.join(options.infolder, options.param_excel_fp)
+    modifications = os.path.join(options.visum_folder, 'Modifications')
+
+    service = VisemDemandService(modifications,
+                                 param_excel_fp,
+                                 cache_params=options.cache_params)
+    server = VisemDemandServer(service, port=options.port)
+    print(f'serving on http://127.0.0.1:{options.port}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
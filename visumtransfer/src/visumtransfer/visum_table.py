@@ -2,9 +2,11 @@
 
 import datetime
 import csv
+import itertools
 import tempfile
+import time
 from collections import OrderedDict
-from typing import Dict, Iterable, List
+from typing import TYPE_CHECKING, Dict, Iterable, List
 from copy import copy
 import os
 import shutil
@@ -14,6 +16,9 @@ from recordclass import recordclass
 import pandas as pd
 from visumtransfer.visum_attributes import VisumAttributes
 
+if TYPE_CHECKING:
+    import xarray as xr
+
 
 class VisumTables:
     """Singleton to store all tables"""
@@ -73,6 +78,8 @@ class VisumTable(metaclass=MetaClass):
     _mode = '+'
     _defaults = {}
     _longformat = False
+    #  the (row, column)-array of a table in long format written in chunks
+    _long_data = None
 
     # map Umlaute to normal letters
     _intab = "-()äöüÄÖÜß"
@@ -203,10 +210,28 @@ class VisumTable(metaclass=MetaClass):
         columns: str, optional
             the columns to write
         """
+        long_chunks = self.iter_long_chunks()
+        if self.df.empty and self._long_data is not None:
+            #  the array is read only once,
+            #  a block without values is not written
+            long_chunks = (chunk for chunk in long_chunks if len(chunk))
+            first = next(long_chunks, None)
+            if first is None:
+                return
+            long_chunks = itertools.chain([first], long_chunks)
         self.write_block_header(fobj)
-        self.write_df(fobj, columns)
-
-    def write_df(self, fobj: WriteLine, columns: str = None):
+        self.write_df(fobj, columns, long_chunks=long_chunks)
+
+    def get_block(self, columns: str = None) -> str:
+        """return the block as text, like it is written by write_block"""
+        buf = io.StringIO()
+        self.write_block(WriteLine(buf), columns)
+        return buf.getvalue()
+
+    def write_df(self,
+                 fobj: WriteLine,
+                 columns: str = None,
+                 long_chunks: Iterable[pd.DataFrame] = None):
         """
         Write .df-Object to open file
         Parameters
@@ -215,6 +240,9 @@ class VisumTable(metaclass=MetaClass):
             holding the open file stream
         columns: str, optional
             the columns to write
+        long_chunks: iterable of pd.DataFrame, optional
+            the chunks of the long array written after the df,
+            default: the chunks of `iter_long_chunks`
         """
         if self.df.index.names == [None]:
             df = self.df
@@ -226,16 +254,24 @@ class VisumTable(metaclass=MetaClass):
 
         df = self.unconvert(df)
 
+        if self._long_data is not None and df.empty:
+            df = df.reindex(columns=self.cols)
         cols = columns or ';'.join(c for c in df.columns)
         fobj.writeln(f'${self._mode}{self.code}:{cols}')
 
-        df.to_csv(fobj.fobj,
-                  sep=';',
-                  quoting=csv.QUOTE_NONE,
-                  header=False,
-                  index=False,
-                  lineterminator='\n',
-                  encoding='cp1252')
+        if long_chunks is None:
+            long_chunks = self.iter_long_chunks()
+        chunks = itertools.chain([df], long_chunks)
+        for chunk in chunks:
+            if columns:
+                chunk = chunk[columns.split(';')]
+            chunk.to_csv(fobj.fobj,
+                         sep=';',
+                         quoting=csv.QUOTE_NONE,
+                         header=False,
+                         index=False,
+                         lineterminator='\n',
+                         encoding='cp1252')
         fobj.writeln('')
 
     @property
@@ -326,11 +362,38 @@ class VisumTable(metaclass=MetaClass):
             df2append.index = new_index
         self.df = pd.concat([self.df, df2append], verify_integrity=True)
 
+    def add_rows_with_defaults(self, df: pd.DataFrame):
+        """
+        add the rows of `df` with the columns of the table like `add`:
+        missing columns and missing values get the default values
+        """
+        df = df.reindex(columns=self.cols)
+        for colname in df.columns:
+            col = df[colname]
+            is_na = col.isna()
+            if not is_na.any():
+                continue
+            if col.dtype.kind == 'f' and \
+               (col[~is_na] == col[~is_na].round()).all():
+                #  integers got float by missing values
+                col = col.astype('Int64')
+            df[colname] = col.astype(object).where(
+                ~is_na, self._defaults.get(colname, ''))
+
+        #  add the rows like add, so that the dtypes are the same
+        self.add_rows(list(df.itertuples(index=False, name=None)))
+
     def add_df(self, df: pd.DataFrame):
-        """Add a pandas Dataframe"""
+        """
+        Add a pandas Dataframe.
+        The columns are matched with the columns of the table
+        case-insensitively
+        """
         if df.empty:
             return
-        df.columns = df.columns.str.upper()
+        cols = {c.upper(): c for c in self.cols}
+        df.columns = [cols.get(str(c).upper(), str(c).upper())
+                      for c in df.columns]
         df = df\
             .reset_index()\
             .reindex(self.cols, axis='columns')\
@@ -338,18 +401,130 @@ class VisumTable(metaclass=MetaClass):
             .fillna(self._defaults)
         self.df = pd.concat([self.df, df], verify_integrity=True)
 
+    @classmethod
+    def from_array(cls,
+                   array: np.ndarray,
+                   index: Iterable,
+                   columns: Iterable,
+                   mode: str = None,
+                   drop_zeros: bool = True,
+                   chunksize: int = 1000) -> 'VisumTable':
+        """
+        create a table in long format from a 2D-array, e.g. the persons
+        of the persongroups per zone
+
+        The array is not converted to a long DataFrame, but the long rows
+        of `chunksize` rows of the array at a time are written to the file.
+        Cells with NaN are skipped.
+
+        Parameters
+        ----------
+        array : np.ndarray
+            the (row, column)-array, e.g. zone x persongroup.
+            May be a memmap or another array, that can be sliced by rows
+        index : list
+            the labels of the rows, e.g. the zone numbers,
+            for the first column of the table
+        columns : list
+            the labels of the columns, e.g. the persongroup codes,
+            for the second column of the table
+        mode : str, optional
+            the mode of the table
+        drop_zeros : bool, optional
+            skip cells with a value of 0
+        chunksize : int, optional
+            the number of rows of the array written at once
+
+        Raises
+        ------
+        TypeError
+            if the table is not in long format
+        ValueError
+            if the labels do not fit to the array
+        """
+        if not cls._longformat:
+            raise TypeError(f'{cls.__name__} is not in long format')
+        index = np.asarray(index)
+        columns = np.asarray(columns)
+        if array.ndim != 2 or array.shape != (len(index), len(columns)):
+            raise ValueError(f'array of shape {array.shape} does not fit to '
+                             f'{len(index)} rows and {len(columns)} columns')
+        self = cls(mode=mode)
+        self._long_data = (array, index, columns, drop_zeros, chunksize)
+        return self
+
+    @classmethod
+    def from_xarray(cls,
+                    da: 'xr.DataArray',
+                    dims: Iterable[str] = None,
+                    mode: str = None,
+                    drop_zeros: bool = True,
+                    chunksize: int = 1000) -> 'VisumTable':
+        """
+        create a table in long format from a 2D-DataArray with the labels
+        of the rows and columns as coordinates, see `from_array`.
+        A dask-backed DataArray is computed chunk by chunk
+
+        Parameters
+        ----------
+        da : xr.DataArray
+            the (row, column)-array, e.g. with the dims (zone, persongroup)
+        dims : list of str, optional
+            the dims of the rows and the columns, default: the dims of `da`
+        """
+        if dims is not None:
+            da = da.transpose(*dims)
+        row_dim, col_dim = da.dims
+        return cls.from_array(da,
+                              index=da[row_dim].values,
+                              columns=da[col_dim].values,
+                              mode=mode,
+                              drop_zeros=drop_zeros,
+                              chunksize=chunksize)
+
+    def iter_long_chunks(self) -> Iterable[pd.DataFrame]:
+        """
+        yield the long rows of the array of `from_array` or `from_xarray`
+        as DataFrames with the columns of the table, chunk by chunk
+        """
+        if self._long_data is None:
+            return
+        array, index, columns, drop_zeros, chunksize = self._long_data
+        row_col, col_col, value_col = self.cols[:3]
+        for start in range(0, len(index), chunksize):
+            rows = slice(start, start + chunksize)
+            block = array[rows]
+            if hasattr(block, 'values'):
+                block = block.values
+            block = np.asarray(block)
+            mask = ~pd.isna(block)
+            if drop_zeros:
+                mask &= block != 0
+            row_pos, col_pos = np.nonzero(mask)
+            yield pd.DataFrame({row_col: index[rows][row_pos],
+                                col_col: columns[col_pos],
+                                value_col: block[row_pos, col_pos]})
+
     def add_cols(self, new_cols: list):
         """Add columns to the columns definition"""
         self._cols = ';'.join(np.concatenate([self.cols, new_cols]))
         self.define_row()
 
     def __len__(self) -> int:
+        """
+        the rows of the df. The rows of the long array of `from_array`
+        are not counted, this would read the whole array
+        """
         return len(self.df)
 
     def __bool__(self) -> bool:
-        return len(self.df) > 0
+        return len(self.df) > 0 or self._long_data is not None
 
     def __repr__(self):
+        if self._long_data is not None:
+            n_rows, n_cols = self._long_data[0].shape
+            return (f'{self.name} ({self._mode}{len(self)} '
+                    f'+ array {n_rows}x{n_cols})')
         return f'{self.name} ({self._mode}{len(self)})'
 
     def update_original_df(self, new_df: pd.DataFrame):
@@ -372,6 +547,40 @@ class VisumTable(metaclass=MetaClass):
         print(self, new_rows.shape, self.new_df.shape)
 
 
+class TextBlock:
+    """
+    A block of a transfer file, which has been written before,
+    can be written again instead of the VisumTable it was created from
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.code = ''
+        self._mode = ''
+        for line in text.splitlines():
+            if line.startswith('$'):
+                section = line.split(':')[0]
+                if section[1] in VisumTable._modes:
+                    self._mode = section[1]
+                    self.code = section[2:].upper()
+                else:
+                    self.code = section[1:].upper()
+                break
+
+    def write_block(self, fobj: WriteLine, columns: str = None):
+        """write the text to `fobj`"""
+        fobj.fobj.write(self.text)
+
+    def get_block(self, columns: str = None) -> str:
+        return self.text
+
+    def __bool__(self) -> bool:
+        return bool(self.text)
+
+    def __repr__(self):
+        return f'TextBlock {self.code} ({self._mode})'
+
+
 TablesDict = Dict[str, VisumTable]
 
 
@@ -413,6 +622,9 @@ class VisumTransfer:
         self.tables = OrderedDict()  # type: TablesDict
         self.decimal = '.'
         self.sep = sep
+        self.filename = None
+        self.timings = OrderedDict()  # type: Dict[str, float]
+        self.blocks = OrderedDict()  # type: Dict[str, str]
 
     def __repr__(self):
         return f'VisumTransfer with {len(self.tables)} tables'
@@ -463,20 +675,40 @@ class VisumTransfer:
         fn = self.get_modification(number, modification_folder)
         self.write(fn)
 
-    def write(self, fn: str):
-        """Write transfer file to file `fn`"""
+    def write(self, fn: str, keep_blocks: bool = False):
+        """
+        Write transfer file to file `fn`
+        the seconds needed to write each table are stored in self.timings
+
+        Parameters
+        ----------
+        fn : str
+            the file path
+        keep_blocks : bool, optional
+            if True, keep the text written for each table in self.blocks
+        """
         # create folder if not exists
         folder = os.path.split(fn)[0]
         if folder:
             os.makedirs(folder, exist_ok=True)
+        self.timings.clear()
+        self.blocks.clear()
         with open(fn, 'w', encoding='cp1252') as f:
             fobj = WriteLine(f)
             fobj.writeln('$VISION')
             fobj.writeln(f'* {self.user}')
             fobj.writeln(f'* {self.date}')
-            for table in self.tables.values():
+            for name, table in self.tables.items():
                 if table: # write only tables with rows
-                    table.write_block(fobj)
+                    t0 = time.perf_counter()
+                    if keep_blocks:
+                        block = table.get_block()
+                        f.write(block)
+                        self.blocks[name] = block
+                    else:
+                        table.write_block(fobj)
+                    self.timings[name] = time.perf_counter() - t0
+        self.filename = fn
 
     def prepend(self, fn: str):
         """Prepend tables after the VERSION-section to the existing transfer file `fn`"""
@@ -528,20 +760,21 @@ class VisumTransfer:
                                decimal: str = '.'):
         """read visum-demand from modification file"""
         position = 0
+        current_table = None
+        tables = []
         with open(filename, 'rb') as f:
             li = f.readline().decode('cp1252').strip()
             if not li == '$VISION':
                 raise ValueError(
                     f'file {filename} is no Visum-Modification file')
-            section = ''
             for line in f:
                 li = line.decode('cp1252').strip()
                 if not li or li.startswith('*'):
                     continue
                 if li.startswith('$'):
                     position = f.tell()
-                    if hasattr(self, 'current_table'):
-                        self.current_table._endpos = position - len(line)
+                    if current_table is not None:
+                        current_table._endpos = position - len(line)
                     full_section, cols, = li.split(':')
                     mode = ''
                     if full_section[1] in VisumTable._modes:
@@ -550,26 +783,27 @@ class VisumTransfer:
                     else:
                         mode = ''
                         section = full_section[1:].upper()
+                    if sections_to_read and section not in sections_to_read:
+                        current_table = None
+                        continue
 
                     i = 1
                     section_name = section
                     while section_name in self.tables:
                         section_name = f'{section}_{i}'
                         i += 1
-                    self.current_table = self.visum_tables[section](mode=mode)
-                    self.current_cols = cols.translate(
-                        self.current_table.trantab).split(self.sep)
-                    self.current_table._cols = ';'.join(cols.split(self.sep))
-                    self.current_table.define_row()
-                    self.current_table._startpos = position
-                    self.add_table(self.current_table, name=section_name)
-                elif sections_to_read and section not in sections_to_read:
-                    continue
+                    current_table = self.visum_tables[section](mode=mode)
+                    current_table._cols = ';'.join(cols.split(self.sep))
+                    current_table.define_row()
+                    current_table._startpos = position
+                    self.add_table(current_table, name=section_name)
+                    tables.append(current_table)
 
             position = f.tell()
-            self.current_table._endpos = position
+            if current_table is not None:
+                current_table._endpos = position
 
-            for tablename, table in self.tables.items():
+            for table in tables:
                 f.seek(table._startpos)
                 lines = f.read(table._endpos -
                                table._startpos).decode('cp1252')
@@ -45,7 +45,8 @@ from .base import (
 )
 
 from .matrices import (
-    Matrix
+    Matrix,
+    MatrixBlockError,
 )
 
 from .persongroups import (
@@ -83,3 +84,9 @@ from .usertables import (
     TableDefinition,
     create_userdefined_table,
 )
+
+from .templates import (
+    MatrixTemplate,
+    AttributeTemplate,
+    TemplateEngine,
+)
@@ -2,10 +2,10 @@
 
 import numpy as np
 import pandas as pd
-from typing import Dict
-from collections import defaultdict
+from typing import Dict, List
 from .base import UserDefinedAttribute, UserDefinedGroup
 from .matrices import Matrix
+from .templates import AttributeTemplate, MatrixTemplate, TemplateEngine
 from visumtransfer.visum_table import VisumTable
 
 
@@ -16,6 +16,49 @@ class Activity(VisumTable):
              'STRUCTURALPROPCODES;CONSTRAINTDEST;RSA;'
              'COMPOSITE_ACTIVITIES;AUTOCALIBRATE;CALCDESTMODE;ACTIVITYSET;BASE_LS'
              ';ZIELWAHL_FUNKTION;MATRIXCODE_PUT;MATRIXCODE_PARKING')
+    #  the balancing (RSA) is converged, if the correction factors
+    #  of all zones are within these thresholds
+    rsa_threshold_min = 0.95
+    rsa_threshold_max = 1.05
+
+    def __init__(self, mode: str = None, new_cols: List[str] = None):
+        super().__init__(mode=mode, new_cols=new_cols)
+        self.clear_cache()
+
+    @VisumTable.df.setter
+    def df(self, df: pd.DataFrame):
+        VisumTable.df.fset(self, df)
+        self.clear_cache()
+
+    def clear_cache(self):
+        """
+        clear the structures derived from the activities,
+        called when the DataFrame is replaced
+        """
+        self._cache = {}
+        self._cache_fingerprint: bytes = None
+        self._main_activities: Dict[str, str] = {}
+        self._main_activities_hierarchy: Dict[str, int] = None
+
+    def _get_cache(self) -> dict:
+        """
+        return the cache of the structures derived from the activities.
+        It is cleared, when the codes or the columns they are derived from
+        are changed, also by in-place edits of the DataFrame
+        """
+        df = self.df
+        fingerprint = pd.util.hash_pandas_object(
+            df[['RANK', 'ISHOMEACTIVITY', 'CALCDESTMODE']],
+            index=True).to_numpy().tobytes()
+        if fingerprint != self._cache_fingerprint:
+            self._cache = {}
+            self._cache_fingerprint = fingerprint
+        return self._cache
+
+    def upsert(self, **kwargs):
+        super().upsert(**kwargs)
+        #  existing rows are updated in place
+        self.clear_cache()
 
     def create_tables(self,
                       activities: pd.DataFrame,
@@ -45,30 +88,52 @@ class Activity(VisumTable):
     @property
     def _homeactivity(self) -> str:
         """get the home activity"""
-        return self.df.loc[self.df.ISHOMEACTIVITY == 1].index[0]
+        cache = self._get_cache()
+        try:
+            return cache['homeactivity']
+        except KeyError:
+            pass
+        home = self.df.index[self.df['ISHOMEACTIVITY'] == 1][0]
+        cache['homeactivity'] = home
+        return home
 
     @property
     def all_non_composite_activites(self) -> str:
         """returns all the activities that are not composed by others"""
+        cache = self._get_cache()
+        try:
+            return cache['non_composite']
+        except KeyError:
+            pass
         non_composite = (self.df['ISHOMEACTIVITY'] | self.df['CALCDESTMODE'])
         codes = self.df.index[non_composite.astype(bool)]
-        return ','.join(sorted(codes))
+        activities = ','.join(sorted(codes))
+        cache['non_composite'] = activities
+        return activities
 
     def set_activityset(self):
         """Sets the activityset for the composite activities"""
-        activitysets = defaultdict(set)
-        for code, act in self.df.iterrows():
-            # add the activity itself, if its no composite activity
-            if act['CALCDESTMODE'] or act['ISHOMEACTIVITY']:
-                activitysets[code].add(code)
-            # if an activity is part of a composite activity
-            for comp_act in act['COMPOSITE_ACTIVITIES'].split(','):
-                if not comp_act:
-                    continue
-                # add its code to the activityset of the composite activity
-                activitysets[comp_act].add(code)
-        for code, activityset in activitysets.items():
-            self.df.loc[code, 'ACTIVITYSET'] = ','.join(sorted(activityset))
+        df = self.df
+        # the activity itself, if its no composite activity
+        is_set = (df['CALCDESTMODE'].astype(bool) |
+                  df['ISHOMEACTIVITY'].astype(bool))
+        own = pd.DataFrame({'SET': df.index[is_set],
+                            'CODE': df.index[is_set]})
+        # if an activity is part of a composite activity,
+        # its code is added to the activityset of the composite activity
+        composite = df['COMPOSITE_ACTIVITIES'].str.split(',').explode()
+        composite = composite.loc[composite.notna() & (composite != '')]
+        parts = pd.DataFrame({'SET': composite.to_numpy(),
+                              'CODE': composite.index})
+        members = pd.concat([own, parts]).drop_duplicates()
+        missing = ~members['SET'].isin(df.index)
+        if missing.any():
+            raise KeyError(f'composite activities '
+                           f'{members.loc[missing, "SET"].unique()} '
+                           f'not defined')
+        activitysets = members.sort_values('CODE', kind='stable')\
+            .groupby('SET', sort=False)['CODE'].agg(','.join)
+        df.loc[activitysets.index, 'ACTIVITYSET'] = activitysets.to_numpy()
 
     def get_main_activity(self, hierarchy: Dict[str, int], ac_sequence: str) -> str:
         """get the code of the main activity from ac_code
@@ -89,6 +154,56 @@ class Activity(VisumTable):
                                           for a in ac]))]
         return main_act
 
+    def get_main_activities(self,
+                            sequences: pd.Series,
+                            hierarchy: Dict[str, int] = None) -> pd.Series:
+        """
+        get the codes of the main activities of all activity chains
+
+        The activities are encoded by their rank in the hierarchy, the
+        main activity of each sequence is the activity with the lowest rank.
+        The results are cached per distinct sequence.
+
+        Parameters
+        ----------
+        sequences : pd.Series
+            the Activity-Chain-Sequences like W,A,E,W
+        hierarchy : dict, optional
+            the hierarchy-dict produced by self.get_hierarchy()
+
+        Returns
+        -------
+        main_activities : pd.Series
+            the main activity of each sequence with the index of `sequences`
+        """
+        if hierarchy is None:
+            hierarchy = self.get_hierarchy()
+        if hierarchy != self._main_activities_hierarchy:
+            #  the cached main activities are valid for one hierarchy
+            self._main_activities = {}
+            self._main_activities_hierarchy = dict(hierarchy)
+        cache = self._main_activities
+        new = pd.Series([seq for seq in pd.unique(sequences)
+                         if seq not in cache], dtype=object)
+        if len(new):
+            # encode the activities by their position in the hierarchy
+            ordered = np.array(sorted(hierarchy, key=hierarchy.get),
+                               dtype=object)
+            activities = new.str.split(',').explode()
+            positions = activities.map(
+                {code: i for i, code in enumerate(ordered)})
+            if positions.isna().any():
+                raise KeyError(f'activities '
+                               f'{activities[positions.isna()].unique()} '
+                               f'not in the hierarchy')
+            #  the activities of each sequence follow each other
+            starts = np.flatnonzero(np.diff(activities.index, prepend=-1))
+            main_positions = np.minimum.reduceat(
+                positions.to_numpy(dtype='i8'), starts)
+            cache.update(zip(new, ordered[main_positions]))
+        return pd.Series([cache[seq] for seq in sequences],
+                         index=sequences.index, dtype=object)
+
     def get_hierarchy(self) -> Dict[str, int]:
         """
         Return a dict with the hierarchy of activities
@@ -97,12 +212,16 @@ class Activity(VisumTable):
         -------
         hierarchy : dict
         """
+        cache = self._get_cache()
+        try:
+            return dict(cache['hierarchy'])
+        except KeyError:
+            pass
         sorted_df = self.df.reset_index()\
             .sort_values(['ISHOMEACTIVITY', 'RANK', 'CODE'])
-        codes = sorted_df[['CODE']].copy()
-        codes['idx'] = range(len(codes))
-        hierarchy = codes.set_index('CODE').to_dict()['idx']
-        return hierarchy
+        hierarchy = dict(zip(sorted_df['CODE'], range(len(sorted_df))))
+        cache['hierarchy'] = hierarchy
+        return dict(hierarchy)
 
     def add_benutzerdefinierte_attribute(
             self,
@@ -180,130 +299,129 @@ class Activity(VisumTable):
                           description='Mittlere Wegelänge je Aktivität der Wohnbevölkerung')
         userdefgroups.add(name=gr_dist_act,
                           description='Mittlere Wegelänge je Aktivität der Nutzer am Zielort')
-        self.matrixnummern_activity = {}
-        for code, t in self.df.iterrows():
-            name = t.NAME
-
-            matrices.set_category('Activities')
-            no = matrices.add_data_matrix(
-                code=f'Activity_{code}',
-                name=f'Gesamtzahl der Wege zu Aktivität {name}',
-                activitycode=code,
-                origactivityset=self.all_non_composite_activites,
-                destactivityset=t.ACTIVITYSET,
-                obb_matrix_ref=f'[CODE]="Activity_OBB_{code}"',
-            )
-
-            matrices.set_category('VL_Activities')
-            nr_vl = matrices.add_formula_matrix(
-                code=f'VL_Activity_{code}',
-                name=f'Fahrleistung Aktivität {name}',
-                formula=f'Matrix([CODE] = "Activity_{code}") * '
-                'Matrix([CODE] = "KM")',
-                activitycode=code,
-                origactivityset=self.all_non_composite_activites,
-                destactivityset=t.ACTIVITYSET,
-                obb_matrix_ref=f'[CODE]="Activity_VL_OBB_{code}"',
-            )
-
-            if not t.ISHOMEACTIVITY:
-                matrices.set_category('Activities_Homebased')
-                no = matrices.add_data_matrix(
-                    code=f'HB_Activity_{code}',
-                    name=f'Gesamtzahl der Wege von der Wohnung zu Aktivität {name}',
-                    activitycode=code,
-                    origactivityset=self._homeactivity,
-                    destactivityset=t.ACTIVITYSET,
-                )
-
-                matrices.set_category('VL_Activities_Homebased')
-                nr_vl = matrices.add_formula_matrix(
-                    code=f'HB_VL_Activity_{code}',
-                    name=f'Fahrleistung Wohnung-Aktivität {name}',
-                    formula=f'Matrix([CODE] = "HB_Activity_{code}") * '
+        frame = self.get_template_frame()
+        frame['origactivityset'] = self.all_non_composite_activites
+        frame['homeactivity'] = self._homeactivity
+        frame['is_not_home'] = ~frame['is_home']
+        activity = dict(activitycode='{code}',
+                        origactivityset='{origactivityset}',
+                        destactivityset='{activityset}')
+        homebased = dict(activity,
+                         origactivityset='{homeactivity}',
+                         where='is_not_home')
+
+        with TemplateEngine(matrices, userdef) as engine:
+            numbers = engine.expand(
+                frame,
+                MatrixTemplate(
+                    'trips', 'Activities',
+                    code='Activity_{code}',
+                    name='Gesamtzahl der Wege zu Aktivität {name}',
+                    obb_matrix_ref='[CODE]="Activity_OBB_{code}"',
+                    **activity),
+                MatrixTemplate(
+                    'vl', 'VL_Activities',
+                    code='VL_Activity_{code}',
+                    name='Fahrleistung Aktivität {name}',
+                    formula='Matrix([CODE] = "Activity_{code}") * '
                     'Matrix([CODE] = "KM")',
-                    activitycode=code,
-                    origactivityset=self._homeactivity,
-                    destactivityset=t.ACTIVITYSET,
-                )
-
-                matrices.set_category('Activities_Modellierungsraum')
-                no = matrices.add_formula_matrix(
-                    code=f'MR_Activity_{code}',
-                    name=f'Gesamtzahl der Wege aus dem Modellierungsraum zur Aktivität {name}',
-                    formula=f'Matrix([CODE] = "HB_Activity_{code}") * '
+                    obb_matrix_ref='[CODE]="Activity_VL_OBB_{code}"',
+                    **activity),
+                MatrixTemplate(
+                    'hb', 'Activities_Homebased',
+                    code='HB_Activity_{code}',
+                    name='Gesamtzahl der Wege von der Wohnung '
+                    'zu Aktivität {name}',
+                    **homebased),
+                MatrixTemplate(
+                    'hb_vl', 'VL_Activities_Homebased',
+                    code='HB_VL_Activity_{code}',
+                    name='Fahrleistung Wohnung-Aktivität {name}',
+                    formula='Matrix([CODE] = "HB_Activity_{code}") * '
+                    'Matrix([CODE] = "KM")',
+                    **homebased),
+                MatrixTemplate(
+                    'mr', 'Activities_Modellierungsraum',
+                    code='MR_Activity_{code}',
+                    name='Gesamtzahl der Wege aus dem Modellierungsraum '
+                    'zur Aktivität {name}',
+                    formula='Matrix([CODE] = "HB_Activity_{code}") * '
                     'FROM[MODELLIERUNGSRAUM]',
-                    activitycode=code,
-                    origactivityset=self._homeactivity,
-                    destactivityset=t.ACTIVITYSET,
-                )
-
-                matrices.set_category('VL_Activities_Modellierungsraum')
-                nr_vl = matrices.add_formula_matrix(
-                    code=f'MR_VL_Activity_{code}',
-                    name=f'Fahrleistung Wohnung(im Modellierungsraum)-Aktivität {name}',
-                    formula=f'Matrix([CODE] = "HB_VL_Activity_{code}") * '
+                    **homebased),
+                MatrixTemplate(
+                    'mr_vl', 'VL_Activities_Modellierungsraum',
+                    code='MR_VL_Activity_{code}',
+                    name='Fahrleistung Wohnung(im Modellierungsraum)'
+                    '-Aktivität {name}',
+                    formula='Matrix([CODE] = "HB_VL_Activity_{code}") * '
                     'FROM[MODELLIERUNGSRAUM]',
-                    activitycode=code,
-                    origactivityset=self._homeactivity,
-                    destactivityset=t.ACTIVITYSET,
-                )
-
-            # Distanz nach Wohnort
-            userdef.add_formula_attribute(
-                'ZONE',
-                userdefinedgroupname=gr_dist_wo,
-                name=f'Distance_WohnOrt_{code}',
-                formula=f'[MATROWSUM({nr_vl:d})] / [MATROWSUM({no:d})]',
-            )
-            userdef.add_formula_attribute(
-                'ZONE',
-                userdefinedgroupname=gr_dist_act,
-                name=f'Distance_AktOrt_{code}',
-                formula=f'[MATCOLSUM({nr_vl:d})] / [MATCOLSUM({no:d})]',
-            )
-
-            #  Wege und Verkehrsleistung nach Oberbezirk
-            matrices.set_category('Activities_OBB')
-            obb_nr = matrices.add_data_matrix(
-                code=f'Activity_OBB_{code}',
-                name=f'Oberbezirks-Matrix Aktivität {name}',
-                activitycode=code,
-                objecttyperef='Mainzone',
-                origactivityset=self.all_non_composite_activites,
-                destactivityset=t.ACTIVITYSET,
-            )
-            matrices.set_category('VL_Activities_OBB')
-            vl_obb_nr = matrices.add_data_matrix(
-                code=f'Activity_VL_OBB_{code}',
-                name=f'Oberbezirks-Matrix VL Aktivität {name}',
-                activitycode=code,
-                objecttyperef='Mainzone',
-                origactivityset=self.all_non_composite_activites,
-                destactivityset=t.ACTIVITYSET,
-            )
-
-            userdef.add_formula_attribute(
-                'MAINZONE',
-                userdefinedgroupname=gr_dist_wo,
-                name=f'Distance_WohnOrt_{code}',
-                formula=f'[MATROWSUM({vl_obb_nr:d})] / '
-                f'[MATROWSUM({obb_nr:d})]',
-            )
-            userdef.add_formula_attribute(
-                'MAINZONE',
-                userdefinedgroupname=gr_dist_act,
-                name=f'Distance_AktOrt_{code}',
-                formula=f'[MATCOLSUM({vl_obb_nr:d})] / '
-                f'[MATCOLSUM({obb_nr:d})]',
+                    **homebased),
+                # Distanz nach Wohnort, im Modellierungsraum ohne Wohnen
+                AttributeTemplate(
+                    'ZONE',
+                    userdefinedgroupname=gr_dist_wo,
+                    name='Distance_WohnOrt_{code}',
+                    formula='[MATROWSUM({no[mr_vl|vl]:d})] / '
+                    '[MATROWSUM({no[mr|trips]:d})]'),
+                AttributeTemplate(
+                    'ZONE',
+                    userdefinedgroupname=gr_dist_act,
+                    name='Distance_AktOrt_{code}',
+                    formula='[MATCOLSUM({no[mr_vl|vl]:d})] / '
+                    '[MATCOLSUM({no[mr|trips]:d})]'),
+                #  Wege und Verkehrsleistung nach Oberbezirk
+                MatrixTemplate(
+                    'obb', 'Activities_OBB',
+                    code='Activity_OBB_{code}',
+                    name='Oberbezirks-Matrix Aktivität {name}',
+                    objecttyperef='Mainzone',
+                    **activity),
+                MatrixTemplate(
+                    'vl_obb', 'VL_Activities_OBB',
+                    code='Activity_VL_OBB_{code}',
+                    name='Oberbezirks-Matrix VL Aktivität {name}',
+                    objecttyperef='Mainzone',
+                    **activity),
+                AttributeTemplate(
+                    'MAINZONE',
+                    userdefinedgroupname=gr_dist_wo,
+                    name='Distance_WohnOrt_{code}',
+                    formula='[MATROWSUM({no[vl_obb]:d})] / '
+                    '[MATROWSUM({no[obb]:d})]'),
+                AttributeTemplate(
+                    'MAINZONE',
+                    userdefinedgroupname=gr_dist_act,
+                    name='Distance_AktOrt_{code}',
+                    formula='[MATCOLSUM({no[vl_obb]:d})] / '
+                    '[MATCOLSUM({no[obb]:d})]'),
             )
-            self.matrixnummern_activity[code] = no
 
-            if t.ISHOMEACTIVITY:
-                self.matrixnummer_activity_w = no
-                self.matrixnummer_activity_vl_w = nr_vl
-                self.obbmatrixnummer_activity_w = obb_nr
-                self.obbmatrixnummer_activity_vl_w = vl_obb_nr
+        #  the trips from the Modellierungsraum, for the home activity all trips
+        trips = numbers['mr'].fillna(numbers['trips']).astype(int)
+        self.matrixnummern_activity = trips.to_dict()
+        for code in frame.index[frame['is_home']]:
+            self.matrixnummer_activity_w = trips[code]
+            self.matrixnummer_activity_vl_w = int(numbers.at[code, 'vl'])
+            self.obbmatrixnummer_activity_w = int(numbers.at[code, 'obb'])
+            self.obbmatrixnummer_activity_vl_w = int(numbers.at[code,
+                                                                'vl_obb'])
+
+    def get_template_frame(self) -> pd.DataFrame:
+        """
+        return the code, name, activityset and the flags of the activities
+        as frame to expand templates against
+        """
+        df = self.df
+        return pd.DataFrame({'code': df.index,
+                             'name': df['NAME'].to_numpy(),
+                             'activityset': df['ACTIVITYSET'].to_numpy(),
+                             'is_home': df['ISHOMEACTIVITY'].astype(bool)
+                             .to_numpy(),
+                             'rsa': df['RSA'].astype(bool).to_numpy(),
+                             'calcdestmode': df['CALCDESTMODE'].astype(bool)
+                             .to_numpy(),
+                             },
+                            index=df.index)
 
     def add_balancing_output_matrices(self,
                                       matrices: Matrix,
@@ -317,110 +435,107 @@ class Activity(VisumTable):
         gr_rsa = 'Randsummenabgleich'
         userdefgroups.add(name=gr_rsa, description='Attribute für den Randsummenabgleichs')
 
-        converged_attributes = []
-        matrices.set_category('Activities_Balancing')
-        for code, t in self.df.iterrows():
-            name = t.NAME
-
-            if t.RSA:
-                matrices.set_category('Commuters')
-                no = matrices.add_data_matrix(
-                    code=f'Pendlermatrix_{code}',
-                    name=f'Gesamtzahl der PendlerGesamtwege zu Aktivität {name}',
-                    activitycode=code,
+        frame = self.get_template_frame()
+        frame['threshold_min'] = self.rsa_threshold_min
+        frame['threshold_max'] = self.rsa_threshold_max
+        rsa = dict(where='rsa', userdefinedgroupname=gr_rsa)
+        with TemplateEngine(matrices, userdef) as engine:
+            engine.expand(
+                frame,
+                MatrixTemplate(
+                    'commuters', 'Commuters',
+                    code='Pendlermatrix_{code}',
+                    name='Gesamtzahl der PendlerGesamtwege zu Aktivität {name}',
+                    activitycode='{code}',
                     savematrix=savematrix,
                     loadmatrix=loadmatrix,
-                    obb_matrix_ref=f'[CODE]="Pendlermatrix_OBB_{code}"',
+                    obb_matrix_ref='[CODE]="Pendlermatrix_OBB_{code}"',
                     matrixfolder='Pendler',
-                )
+                    where='rsa'),
                 # Add KF-Attribute
-                userdef.add_formula_attribute(
-                    objid='ZONE',
-                    attid=f'ZONE_ACTUAL_TRIPS_{code}',
-                    formula=f'[MATCOLSUM({no:d})]',
-                    code=f'Trips_actual_to {code}',
-                    name=f'Actual Trips to Zone for Activity {code}',
-                    userdefinedgroupname=gr_rsa,
-                )
-
-                userdef.add_data_attribute(
-                    objid='ZONE',
-                    name=f'BF_{code}',
-                    comment=f'Bilanzfaktor für Aktivität {code}',
+                AttributeTemplate(
+                    'ZONE',
+                    attid='ZONE_ACTUAL_TRIPS_{code}',
+                    formula='[MATCOLSUM({no[commuters]:d})]',
+                    code='Trips_actual_to {code}',
+                    name='Actual Trips to Zone for Activity {code}',
+                    **rsa),
+                AttributeTemplate(
+                    'ZONE',
+                    name='BF_{code}',
+                    comment='Bilanzfaktor für Aktivität {code}',
                     defaultvalue=1,
-                    userdefinedgroupname=gr_rsa,
-                )
-
+                    **rsa),
+                AttributeTemplate(
+                    'ZONE',
+                    name='BFQ_{code}',
+                    comment='Bilanzfaktor der Quellen für Aktivität {code}',
+                    defaultvalue=1,
+                    **rsa),
                 # Ziel-Wege je Bezirk
-                formula = fr'[ZP_{code}] / [NETWORK\SUM:ZONES\ZP_{code}] * '\
-                    fr'[NETWORK\SUM:ZONES\ZONE_ACTUAL_TRIPS_{code}]'
-                userdef.add_formula_attribute(
-                    objid='ZONE',
-                    attid=f'ZONE_TARGET_TRIPS_{code}',
-                    code=f'Target Trips to Zone for {code}',
-                    name=f'Target Trips to zone for Activity {code}',
-                    formula=formula,
-                    userdefinedgroupname=gr_rsa,
-                )
-
+                AttributeTemplate(
+                    'ZONE',
+                    attid='ZONE_TARGET_TRIPS_{code}',
+                    code='Target Trips to Zone for {code}',
+                    name='Target Trips to zone for Activity {code}',
+                    formula=r'[ZP_{code}] / [NETWORK\SUM:ZONES\ZP_{code}] * '
+                    r'[NETWORK\SUM:ZONES\ZONE_ACTUAL_TRIPS_{code}]',
+                    **rsa),
                 # Korrekturfaktor
-                formula = f'IF([ZONE_ACTUAL_TRIPS_{code}]>0, '\
-                    f'[ZONE_TARGET_TRIPS_{code}] / [ZONE_ACTUAL_TRIPS_{code}], 1)'
-                userdef.add_formula_attribute(
-                    objid='ZONE',
-                    attid=f'ZONE_KF_{code}',
-                    code=f'Zonal Korrekturfaktor {code}',
-                    name=f'Zonal Korrekturfaktor for Activity {code}',
-                    comment=f'Bilanzfaktor für Aktivität {code}',
-                    formula=formula,
-                    userdefinedgroupname=gr_rsa,
-                )
-
+                AttributeTemplate(
+                    'ZONE',
+                    attid='ZONE_KF_{code}',
+                    code='Zonal Korrekturfaktor {code}',
+                    name='Zonal Korrekturfaktor for Activity {code}',
+                    comment='Bilanzfaktor für Aktivität {code}',
+                    formula='IF([ZONE_ACTUAL_TRIPS_{code}]>0, '
+                    '[ZONE_TARGET_TRIPS_{code}] / [ZONE_ACTUAL_TRIPS_{code}], 1)',
+                    **rsa),
                 # converged
-                threshold_min = 0.95
-                threshold_max = 1.05
-                formula = fr'[MIN:ZONES\ZONE_KF_{code}] < {threshold_min} | '\
-                    fr'[MAX:ZONES\ZONE_KF_{code}] > {threshold_max}'
-                attid = f'NOT_CONVERGED_{code}'
-                userdef.add_formula_attribute(
-                    objid='NETWORK',
+                AttributeTemplate(
+                    'NETWORK',
                     valuetype='Bool',
-                    attid=attid,
-                    code=attid,
-                    name=f'Randsummenabgleich nicht konvergiert für Aktivität {code}',
-                    formula=formula,
-                    userdefinedgroupname=gr_rsa,
-                )
-                converged_attributes.append(attid)
-
-                matrices.add_data_matrix(
-                    code=f'Pendlermatrix_OBB_{code}',
-                    name=f'Oberbezirks-Matrix Pendleraktivität {name}',
-                    activitycode=code,
+                    attid='NOT_CONVERGED_{code}',
+                    code='NOT_CONVERGED_{code}',
+                    name='Randsummenabgleich nicht konvergiert '
+                    'für Aktivität {code}',
+                    formula=r'[MIN:ZONES\ZONE_KF_{code}] < {threshold_min} | '
+                    r'[MAX:ZONES\ZONE_KF_{code}] > {threshold_max}',
+                    **rsa),
+                MatrixTemplate(
+                    'commuters_obb', 'Commuters',
+                    code='Pendlermatrix_OBB_{code}',
+                    name='Oberbezirks-Matrix Pendleraktivität {name}',
+                    activitycode='{code}',
                     objecttyperef='Mainzone',
                     matrixfolder='Pendler',
-                )
-
-        formula = ' | '.join((f"[{c}]" for c in converged_attributes))
-        attid = 'NOT_CONVERGED_ANY_ACTIVITY'
-        userdef.add_formula_attribute(
-            objid='NETWORK',
-            valuetype='Bool',
-            attid=attid,
-            code=attid,
-            name='Randsummenabgleich nicht konvergiert für mindestens eine Aktivität',
-            formula=formula,
-            userdefinedgroupname=gr_rsa,
-        )
+                    where='rsa'),
+            )
 
-        userdef.add_data_attribute(
-            objid='NETWORK',
-            name='NOT_CONVERGED_MS_TRIPLENGTH',
-            valuetype='Bool',
-            defaultvalue=1,
-            comment='Modal Split und Wegelängen sind noch nicht konvergiert',
-            userdefinedgroupname=gr_rsa,
-        )
+            converged_attributes = 'NOT_CONVERGED_' + frame.index[frame['rsa']]
+            network = pd.DataFrame(
+                {'converged': [' | '.join(f'[{c}]'
+                                          for c in converged_attributes)]})
+            engine.expand(
+                network,
+                AttributeTemplate(
+                    'NETWORK',
+                    valuetype='Bool',
+                    attid='NOT_CONVERGED_ANY_ACTIVITY',
+                    code='NOT_CONVERGED_ANY_ACTIVITY',
+                    name='Randsummenabgleich nicht konvergiert '
+                    'für mindestens eine Aktivität',
+                    formula='{converged}',
+                    userdefinedgroupname=gr_rsa),
+                AttributeTemplate(
+                    'NETWORK',
+                    name='NOT_CONVERGED_MS_TRIPLENGTH',
+                    valuetype='Bool',
+                    defaultvalue=1,
+                    comment='Modal Split und Wegelängen sind noch nicht '
+                    'konvergiert',
+                    userdefinedgroupname=gr_rsa),
+            )
 
     def add_pjt_matrices(self,
                          matrices: Matrix,
@@ -428,18 +543,19 @@ class Activity(VisumTable):
         """
         Add Percieved Journey Time Matrices for Activities
         """
-        matrices.set_category('OV_Skims_PJT')
-        for code, t in self.df.iterrows():
-            if t.CALCDESTMODE:
-                name = t.NAME
-                matrices.add_data_matrix(
-                    code=f'PJT_{code}',
-                    name=f'Empfundene Reisezeit für Hauptaktivität {name}',
+        with TemplateEngine(matrices) as engine:
+            engine.expand(
+                self.get_template_frame(),
+                MatrixTemplate(
+                    'pjt', 'OV_Skims_PJT',
+                    code='PJT_{code}',
+                    name='Empfundene Reisezeit für Hauptaktivität {name}',
                     matrixtype='Skim',
-                    activitycode=code,
+                    activitycode='{code}',
                     loadmatrix=0,
                     savematrix=savematrix,
-                )
+                    where='calcdestmode'),
+            )
 
     def add_parkzone_attrs(self,
                            userdefgroups: UserDefinedGroup,
@@ -466,18 +582,19 @@ class Activity(VisumTable):
         """
         Add Parking Matrices for Activities
         """
-        matrices.set_category('IV_Skims_Parking')
-        for code, t in self.df.iterrows():
-            if t.CALCDESTMODE:
-                name = t.NAME
-                matrices.add_data_matrix(
-                    code=f'PARKING_{code}',
-                    name=f'Parkwiderstand für Hauptaktivität {name}',
-                    activitycode=code,
+        with TemplateEngine(matrices) as engine:
+            engine.expand(
+                self.get_template_frame(),
+                MatrixTemplate(
+                    'parking', 'IV_Skims_Parking',
+                    code='PARKING_{code}',
+                    name='Parkwiderstand für Hauptaktivität {name}',
+                    activitycode='{code}',
                     matrixtype='Skim',
                     loadmatrix=0,
                     savematrix=savematrix,
-                )
+                    where='calcdestmode'),
+            )
 
     def add_modal_split(self,
                         userdefgroups: UserDefinedGroup,
@@ -499,162 +616,149 @@ class Activity(VisumTable):
         userdefgroups.add(name=gr_coeff, description='Koeffizienten des Verkehrsmittelwahlmodells')
         userdefgroups.add(name=gr_trips, description='Anzahl der Wege')
 
-        for code, t in self.df.iterrows():
-            # not initmatrix at the moment...
-            init_matrix = 0
-            #init_matrix = 0 if t.ISHOMEACTIVITY else 1
-            for _, mode in modes.iterrows():
-                matrices.set_category('Modes_Demand_Activities')
-
-                mode_code = mode['code']
+        #  the activities combined with the modes
+        activities = self.get_template_frame()
+        activities['ges'] = activities.index.map(self.matrixnummern_activity)
+        frame = activities.merge(
+            pd.DataFrame({'mode': modes['code'].to_numpy()}), how='cross')
+        frame['obb_matrix_ref'] = ('[CODE]="OBB_Activity_' + frame['code'] +
+                                   '_' + frame['mode'] + '"')\
+            .where(frame['is_home'], '')
+        home = dict(where='is_home', activitycode='{code}', modecode='{mode}')
+        for attr in ('matrixnummer_activity_w', 'obbmatrixnummer_activity_w'):
+            frame[attr] = getattr(self, attr, None)
+
+        # not initmatrix at the moment...
+        init_matrix = 0
+        #init_matrix = 0 if t.ISHOMEACTIVITY else 1
+        with TemplateEngine(matrices, userdef) as engine:
+            engine.expand(
+                frame,
                 # add output matrix
-                str_name = f'Wege mit Verkehrsmittel {mode_code} der für Aktivität {code}'
-                obb_matrix_ref = f'[CODE]="OBB_Activity_{code}_{mode_code}"'\
-                    if t.ISHOMEACTIVITY else None
-                no = matrices.add_data_matrix(
-                    code=f'Activity_{code}_{mode_code}',
-                    name=str_name,
-                    modecode=mode_code,
-                    activitycode=code,
+                MatrixTemplate(
+                    'mode', 'Modes_Demand_Activities',
+                    code='Activity_{code}_{mode}',
+                    name='Wege mit Verkehrsmittel {mode} der für Aktivität {code}',
+                    modecode='{mode}',
+                    activitycode='{code}',
                     initmatrix=init_matrix,
-                    obb_matrix_ref=obb_matrix_ref,
-                )
-                ges = self.matrixnummern_activity[code]
-                userdef.add_formula_attribute(
+                    obb_matrix_ref='{obb_matrix_ref}'),
+                AttributeTemplate(
                     'ZONE',
                     userdefinedgroupname=gr_ms_act,
-                    name=f'MS_{mode_code}_Act_{code}',
-                    formula=f'[MATCOLSUM({no:d})] / '
-                    f'[MATCOLSUM({ges:d})]',
-                )
-
-                if t.ISHOMEACTIVITY:
-                    # add output Oberbezirks-Matrix
-                    str_name = f'OBB-Wege mit Verkehrsmittel {mode_code}'
-                    f'für Aktivität {code}'
-                    nr_obb = matrices.add_data_matrix(
-                        code=f'OBB_Activity_{code}_{mode_code}',
-                        name=str_name,
-                        modecode=mode_code,
-                        activitycode=code,
-                        objecttyperef='Mainzone',
-                        initmatrix=0,
-                    )
-
-                    ges = self.obbmatrixnummer_activity_w
-                    userdef.add_formula_attribute(
-                        'MAINZONE',
-                        userdefinedgroupname=gr_ms_home,
-                        name=f'MS_Home_Mode_{mode_code}',
-                        formula=f'[MATCOLSUM({nr_obb:d})] / '
-                        f'[MATCOLSUM({ges:d})]',
-                    )
-
-                    ges = self.matrixnummer_activity_w
-                    userdef.add_formula_attribute(
-                        'ZONE',
-                        userdefinedgroupname=gr_ms_home,
-                        name=f'MS_Home_Mode_{mode_code}',
-                        formula=f'[MATCOLSUM({no:d})] / '
-                        f'[MATCOLSUM({ges:d})]',
-                    )
-
-                    # add Verkehrsleistung
-                    matrices.set_category('VL_Activities')
-                    formula = f'Matrix([CODE]="Activity_{code}_{mode_code}") '\
-                        f'* Matrix([CODE] = "KM")'
-                    nr_vl = matrices.add_formula_matrix(
-                        code=f'VL_Activity_{code}_{mode_code}',
-                        name=f'Verkehrsleistung Aktivität {code} mit {mode_code}',
-                        modecode=mode_code,
-                        activitycode=code,
-                        formula=formula,
-                        objecttyperef='Zone',
-                        initmatrix=0,
-                    )
-                    matrices.set_category('VL_Activities_OBB')
-                    nr_obb_vl = matrices.add_data_matrix(
-                        code=f'OBB_VL_Activity_{code}_{mode_code}',
-                        name=f'OBB-Verkehrsleistung Aktivität {code} mit {mode_code}',
-                        modecode=mode_code,
-                        activitycode=code,
-                        objecttyperef='Mainzone',
-                        initmatrix=0,
-                    )
-                    userdef.add_formula_attribute(
-                        'MAINZONE',
-                        userdefinedgroupname=gr_dist,
-                        name=f'Distance_Home_{mode_code}',
-                        formula=f'[MATROWSUM({nr_obb_vl:d})] / '
-                        f'[MATROWSUM({nr_obb:d})]',
-                    )
-                    userdef.add_formula_attribute(
-                        'ZONE',
-                        userdefinedgroupname=gr_dist,
-                        name=f'Distance_Home_{mode_code}',
-                        formula=f'[MATROWSUM({nr_vl:d})] / '
-                        f'[MATROWSUM({no:d})]',
-                    )
-
-        # Add User Defined Attributes for the trips
-        formel_trips_mode = 'TableLookup(MATRIX Mat, Mat[CODE]="Activity_"+[CODE]+"_{m}", Mat[SUM])'
-        formel_trips = 'TableLookup(MATRIX Mat, Mat[CODE]="Activity_"+[CODE], Mat[SUM])'
-        formel_ms = '[TRIPS_{m}] / [TotalTrips_HB]'
-
-        userdef.add_formula_attribute(
-            'ACTIVITY',
-            userdefinedgroupname=gr_trips,
-            name='Trips',
-            formula=formel_trips.format(m=mode.code)
-        )
-        for _, mode in modes.iterrows():
-            userdef.add_data_attribute(
-                'ACTIVITY',
-                userdefinedgroupname=gr_ms,
-                name=f'Target_MS_{mode.code}',
-                comment=f'Modal Split (Zielwert) {mode.bezeichnung}',
-            )
-            userdef.add_data_attribute(
-                'ACTIVITY',
-                userdefinedgroupname=gr_coeff,
-                name=f'baseconst_{mode.code}',
-                comment=f'Verkehrsmittelspezifische Basis-Konstante {mode.bezeichnung}',
-                defaultvalue=0,
-            )
-            userdef.add_data_attribute(
-                'ACTIVITY',
-                userdefinedgroupname=gr_coeff,
-                name=f'KF_CONST_{mode.code}',
-                comment=f'Korrekturfaktor für Kalibrierung MS {mode.bezeichnung}',
-                defaultvalue=0,
-            )
-            userdef.add_formula_attribute(
-                'ACTIVITY',
-                userdefinedgroupname=gr_trips,
-                name=f'Trips_{mode.code}',
-                comment=f'Wege {mode.bezeichnung}',
-                formula=formel_trips_mode.format(m=mode.code)
-            )
-            userdef.add_formula_attribute(
-                'ACTIVITY',
-                userdefinedgroupname=gr_ms,
-                name=f'MS_{mode.code}',
-                comment=f'Modal Split modelliert {mode.bezeichnung}',
-                formula=formel_ms.format(m=mode.code)
+                    name='MS_{mode}_Act_{code}',
+                    formula='[MATCOLSUM({no[mode]:d})] / '
+                    '[MATCOLSUM({ges:d})]'),
+                # add output Oberbezirks-Matrix
+                MatrixTemplate(
+                    'obb', 'Modes_Demand_Activities',
+                    code='OBB_Activity_{code}_{mode}',
+                    name='OBB-Wege mit Verkehrsmittel {mode}',
+                    objecttyperef='Mainzone',
+                    initmatrix=0,
+                    **home),
+                AttributeTemplate(
+                    'MAINZONE',
+                    userdefinedgroupname=gr_ms_home,
+                    name='MS_Home_Mode_{mode}',
+                    formula='[MATCOLSUM({no[obb]:d})] / '
+                    '[MATCOLSUM({obbmatrixnummer_activity_w:d})]',
+                    where='is_home'),
+                AttributeTemplate(
+                    'ZONE',
+                    userdefinedgroupname=gr_ms_home,
+                    name='MS_Home_Mode_{mode}',
+                    formula='[MATCOLSUM({no[mode]:d})] / '
+                    '[MATCOLSUM({matrixnummer_activity_w:d})]',
+                    where='is_home'),
+                # add Verkehrsleistung
+                MatrixTemplate(
+                    'vl', 'VL_Activities',
+                    code='VL_Activity_{code}_{mode}',
+                    name='Verkehrsleistung Aktivität {code} mit {mode}',
+                    formula='Matrix([CODE]="Activity_{code}_{mode}") '
+                    '* Matrix([CODE] = "KM")',
+                    objecttyperef='Zone',
+                    initmatrix=0,
+                    **home),
+                MatrixTemplate(
+                    'obb_vl', 'VL_Activities_OBB',
+                    code='OBB_VL_Activity_{code}_{mode}',
+                    name='OBB-Verkehrsleistung Aktivität {code} mit {mode}',
+                    objecttyperef='Mainzone',
+                    initmatrix=0,
+                    **home),
+                AttributeTemplate(
+                    'MAINZONE',
+                    userdefinedgroupname=gr_dist,
+                    name='Distance_Home_{mode}',
+                    formula='[MATROWSUM({no[obb_vl]:d})] / '
+                    '[MATROWSUM({no[obb]:d})]',
+                    where='is_home'),
+                AttributeTemplate(
+                    'ZONE',
+                    userdefinedgroupname=gr_dist,
+                    name='Distance_Home_{mode}',
+                    formula='[MATROWSUM({no[vl]:d})] / '
+                    '[MATROWSUM({no[mode]:d})]',
+                    where='is_home'),
             )
-            userdef.add_data_attribute(
-                'ACTIVITY',
-                userdefinedgroupname=gr_coeff,
-                name=f'FACTOR_TIME_{mode.code}',
-                comment=f'Faktor Reisezeitkoeffizient {mode.bezeichnung}',
-                defaultvalue=1,
+
+            # Add User Defined Attributes for the trips
+            engine.expand(
+                pd.DataFrame(index=[0]),
+                AttributeTemplate(
+                    'ACTIVITY',
+                    userdefinedgroupname=gr_trips,
+                    name='Trips',
+                    formula='TableLookup(MATRIX Mat, '
+                    'Mat[CODE]="Activity_"+[CODE], Mat[SUM])'),
             )
-            userdef.add_data_attribute(
-                'ACTIVITY',
-                userdefinedgroupname=gr_coeff,
-                name=f'FACTOR_COST_{mode.code}',
-                comment=f'Faktor Kostenkoeffizient {mode.bezeichnung}',
-                defaultvalue=1,
+            engine.expand(
+                modes[['code', 'bezeichnung']],
+                AttributeTemplate(
+                    'ACTIVITY',
+                    userdefinedgroupname=gr_ms,
+                    name='Target_MS_{code}',
+                    comment='Modal Split (Zielwert) {bezeichnung}'),
+                AttributeTemplate(
+                    'ACTIVITY',
+                    userdefinedgroupname=gr_coeff,
+                    name='baseconst_{code}',
+                    comment='Verkehrsmittelspezifische Basis-Konstante '
+                    '{bezeichnung}',
+                    defaultvalue=0),
+                AttributeTemplate(
+                    'ACTIVITY',
+                    userdefinedgroupname=gr_coeff,
+                    name='KF_CONST_{code}',
+                    comment='Korrekturfaktor für Kalibrierung MS {bezeichnung}',
+                    defaultvalue=0),
+                AttributeTemplate(
+                    'ACTIVITY',
+                    userdefinedgroupname=gr_trips,
+                    name='Trips_{code}',
+                    comment='Wege {bezeichnung}',
+                    formula='TableLookup(MATRIX Mat, '
+                    'Mat[CODE]="Activity_"+[CODE]+"_{code}", Mat[SUM])'),
+                AttributeTemplate(
+                    'ACTIVITY',
+                    userdefinedgroupname=gr_ms,
+                    name='MS_{code}',
+                    comment='Modal Split modelliert {bezeichnung}',
+                    formula='[TRIPS_{code}] / [TotalTrips_HB]'),
+                AttributeTemplate(
+                    'ACTIVITY',
+                    userdefinedgroupname=gr_coeff,
+                    name='FACTOR_TIME_{code}',
+                    comment='Faktor Reisezeitkoeffizient {bezeichnung}',
+                    defaultvalue=1),
+                AttributeTemplate(
+                    'ACTIVITY',
+                    userdefinedgroupname=gr_coeff,
+                    name='FACTOR_COST_{code}',
+                    comment='Faktor Kostenkoeffizient {bezeichnung}',
+                    defaultvalue=1),
             )
 
     def add_kf_logsum(self,
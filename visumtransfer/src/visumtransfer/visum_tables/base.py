@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-import numpy as np
+from typing import Callable
 import pandas as pd
 from visumtransfer.visum_table import VisumTable
 
@@ -116,6 +116,29 @@ class UserDefinedAttribute(VisumTable):
                        **kwargs)
         self.add_row(row)
 
+    def add_attributes(self, attributes: pd.DataFrame):
+        """
+        add the attributes defined in the rows of `attributes` at once
+
+        Parameters
+        ----------
+        attributes : pd.DataFrame
+            with the columns OBJID, NAME, DATASOURCETYPE and other columns.
+            Like in add_formula_attribute and add_data_attribute,
+            empty codes are replaced by the name and empty attids by the code.
+            Missing columns are filled with the default values.
+        """
+        if not len(attributes):
+            return
+        df = attributes.rename(columns=str.upper).reset_index(drop=True)
+        for colname, default in (('CODE', 'NAME'), ('ATTID', 'CODE')):
+            if colname in df:
+                df[colname] = df[colname].where(
+                    df[colname].fillna('').astype(bool), df[default])
+            else:
+                df[colname] = df[default]
+        self.add_rows_with_defaults(df)
+
 
 class TSys(VisumTable):
     name = 'Transport Systems'
@@ -135,27 +158,100 @@ class Zone(VisumTable):
     code = 'ZONE'
     _cols = 'NO'
 
-    def read_pgr(self, fn):
-        r = np.recfromtxt(open(fn, mode='rb').readlines(), delimiter=',',
-                          names=True, filling_values=0)
-        names = r.dtype.names[2:]
-        attrs = [f'NumPersons({pg})' for pg in names]
-        self._cols = ';'.join(['NO'] + attrs)
-
-        values = r[['vz_id'] + list(names)]
-        self.add_rows(values.tolist())
-        self._mode = '*'
-
-    def read_strukturdaten(self, fn):
-        r = np.recfromtxt(open(fn, mode='rb').readlines(), delimiter=',',
-                          names=True, filling_values=0)
-        names = r.dtype.names[2:]
-        attrs = [f'ValStructuralProp({sg.lstrip("ValStructuralProp")})'
-                 if sg.startswith('ValStructuralProp')
-                 else sg
-                 for sg in names]
-        self._cols = ';'.join(['NO'] + list(attrs))
-
-        values = r[['vz_id'] + list(names)]
-        self.add_rows(values.tolist())
-        self._mode = '*'
+    def read_pgr(self,
+                 fn: str,
+                 chunksize: int = None,
+                 engine: str = 'c',
+                 encoding: str = 'latin1'):
+        """
+        read the persons per persongroup and zone from the csv-file `fn`
+        with the zone number in the column vz_id and the persongroups
+        from the third column on as attributes NumPersons(<persongroup>)
+
+        Parameters
+        ----------
+        chunksize : int, optional
+            read and add the file in chunks of `chunksize` zones,
+            only with the c-engine
+        engine : str, optional
+            the engine of pd.read_csv, e.g. 'c' or 'pyarrow'
+        encoding : str, optional
+            the encoding of the file
+        """
+        def get_attrs(names: pd.Index) -> pd.Index:
+            return 'NumPersons(' + names + ')'
+
+        self._read_zone_attributes(fn, get_attrs, chunksize=chunksize,
+                                   engine=engine, encoding=encoding)
+
+    def read_strukturdaten(self,
+                           fn: str,
+                           chunksize: int = None,
+                           engine: str = 'c',
+                           encoding: str = 'latin1'):
+        """
+        read the structural data of the zones from the csv-file `fn`
+        with the zone number in the column vz_id and the attributes
+        from the third column on. Columns ValStructuralProp<code> or
+        ValStructuralProp(<code>) are the attributes
+        ValStructuralProp(<code>)
+
+        Parameters
+        ----------
+        chunksize : int, optional
+            read and add the file in chunks of `chunksize` zones,
+            only with the c-engine
+        engine : str, optional
+            the engine of pd.read_csv, e.g. 'c' or 'pyarrow'
+        encoding : str, optional
+            the encoding of the file
+        """
+        def get_attrs(names: pd.Index) -> pd.Index:
+            return names.str.replace(r'^ValStructuralProp\(?(.*?)\)?$',
+                                     r'ValStructuralProp(\1)',
+                                     regex=True)
+
+        self._read_zone_attributes(fn, get_attrs, chunksize=chunksize,
+                                   engine=engine, encoding=encoding)
+
+    def _read_zone_attributes(self,
+                              fn: str,
+                              get_attrs: Callable[[pd.Index], pd.Index],
+                              chunksize: int = None,
+                              engine: str = 'c',
+                              encoding: str = 'latin1'):
+        """
+        read the attributes from the third column on of the csv-file `fn`
+        and add them with the zone numbers in the column vz_id.
+        Missing values are 0, integral columns are int.
+        With a `chunksize`, each chunk is added as it is read
+        """
+        if engine == 'pyarrow':
+            if chunksize is not None:
+                raise ValueError('chunksize is not supported '
+                                 'with the pyarrow engine')
+            #  pyarrow strips the whitespace of the values itself
+            kwargs = {}
+        else:
+            kwargs = dict(skipinitialspace=True, chunksize=chunksize)
+        reader = pd.read_csv(fn, sep=',', engine=engine, encoding=encoding,
+                             **kwargs)
+        chunks = [reader] if chunksize is None else reader
+        for i, chunk in enumerate(chunks):
+            chunk.columns = chunk.columns.str.strip()
+            names = chunk.columns[2:]
+            attrs = get_attrs(names)
+            frame = chunk[names].fillna(0)
+            #  columns with missing values are read as float,
+            #  write them as int again, if all values are integral
+            floats = frame.select_dtypes('float').columns
+            is_integral = frame[floats].mod(1).eq(0).all()
+            frame = frame.astype(
+                dict.fromkeys(floats[is_integral.to_numpy()], 'int64'))
+            frame.columns = attrs
+            frame.insert(0, 'NO', chunk['vz_id'].to_numpy())
+            if i == 0:
+                self._cols = ';'.join(['NO'] + list(attrs))
+                self.define_row()
+                self._mode = '*'
+            self.add_df(frame)
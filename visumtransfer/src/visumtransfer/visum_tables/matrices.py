@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import bisect
 import datetime
+import re
 from collections import defaultdict
+import numpy as np
+import pandas as pd
 import xarray as xr
 from visumtransfer.params import Params
-from typing import Mapping, List
+from typing import Dict, Iterable, Mapping, List, Tuple, Union
 from .base import UserDefinedAttribute
-from visumtransfer.visum_table import VisumTable
+from visumtransfer.visum_table import VisumTable, VisumTransfer
+from visumtransfer.matrix_io import (get_matrix_row,
+                                     get_matrix_filename,
+                                     read_matrix)
 
 
 class MatrixCategories(dict):
@@ -47,14 +54,271 @@ class MatrixCategories(dict):
         'Accessibilities': 20000,
     }
 
-    def __init__(self):
+    def __init__(self, blocks: Mapping[str, range] = None):
+        """
+        Parameters
+        ----------
+        blocks : Mapping[str, range], optional
+            the range of matrix numbers for each category,
+            default: MatrixCategories.get_blocks()
+
+        Raises
+        ------
+        ValueError
+            if the blocks overlap
+        """
+        blocks = dict(blocks or self.get_blocks())
+        overlaps = self.find_overlaps(blocks)
+        if overlaps:
+            msg = ', '.join(f'{a} and {b}' for a, b in overlaps)
+            raise ValueError(f'the blocks of {msg} overlap')
+        self.blocks = blocks
+        for category, block in blocks.items():
+            self[category] = NumberIntervals(block)
+        #  the non-empty blocks sorted by their start to find the category
+        starts = sorted((block.start, category)
+                        for category, block in blocks.items() if len(block))
+        self._starts = [start for start, category in starts]
+        self._categories = [category for start, category in starts]
+
+    @classmethod
+    def get_blocks(cls) -> Mapping[str, range]:
+        """return the range of matrix numbers for each category"""
+        blocks = {}
         start_idx = 1
         for category, end_idx in sorted(
-          self._end_block.items(), key=lambda x: x[1]):
-            self[category] = iter(range(start_idx, end_idx))
+          cls._end_block.items(), key=lambda x: x[1]):
+            blocks[category] = range(start_idx, end_idx)
             # next block starts where the last ends
             start_idx = end_idx
-        self['_fallback'] = iter(range(start_idx, 9999999))
+        blocks['_fallback'] = range(start_idx, 9999999)
+        return blocks
+
+    @staticmethod
+    def find_overlaps(blocks: Mapping[str, range]) -> List[Tuple[str, str]]:
+        """return the pairs of categories with overlapping blocks"""
+        overlaps = []
+        sorted_blocks = sorted((block.start, block.stop, category)
+                               for category, block in blocks.items()
+                               if len(block))
+        for i, (start, stop, category) in enumerate(sorted_blocks):
+            for other_start, other_stop, other in sorted_blocks[i + 1:]:
+                if other_start >= stop:
+                    break
+                overlaps.append((category, other))
+        return overlaps
+
+    def category_of(self, no: int) -> str:
+        """return the category of the block containing number `no`"""
+        i = bisect.bisect_right(self._starts, no) - 1
+        if i >= 0:
+            category = self._categories[i]
+            if no in self.blocks[category]:
+                return category
+        return ''
+
+    def next_numbers(self, category: str, n: int) -> List[int]:
+        """
+        return the lowest `n` free numbers in the block of `category`,
+        continue with the fallback-numbers, if the block is exhausted
+        """
+        numbers = self[category].take(n)
+        if len(numbers) < n:
+            numbers.extend(self['_fallback'].take(n - len(numbers)))
+        return numbers
+
+    def allocate(self, categories: Iterable[str]) -> List[int]:
+        """
+        return a number for each of the `categories`, the same numbers
+        as taking them one after another with next_numbers(category, 1).
+        The numbers of a category are taken at once, the numbers missing
+        in exhausted blocks from the fallback-block in the order given
+        """
+        positions = defaultdict(list)
+        for i, category in enumerate(categories):
+            positions[category].append(i)
+        numbers = [0] * sum(len(p) for p in positions.values())
+        overflow = []
+        for category, category_positions in positions.items():
+            taken = self[category].take(len(category_positions))
+            for i, no in zip(category_positions, taken):
+                numbers[i] = no
+            overflow.extend(category_positions[len(taken):])
+        overflow.sort()
+        for i, no in zip(overflow, self['_fallback'].take(len(overflow))):
+            numbers[i] = no
+        return numbers
+
+    def reserve(self, category: str, n: int) -> range:
+        """
+        reserve `n` consecutive numbers in the block of `category`
+        or in the fallback-block, if there is no gap large enough
+
+        Raises
+        ------
+        ValueError
+            if no gap in both blocks is large enough
+        """
+        for block in (category, '_fallback'):
+            numbers = self[block].take_contiguous(n)
+            if numbers is not None:
+                return numbers
+        raise ValueError(f'no {n} consecutive numbers free for {category}')
+
+    def mark_used(self, numbers: Iterable[int]) -> List[int]:
+        """
+        mark the `numbers` as used
+
+        Returns
+        -------
+        collisions : list of int
+            the numbers, that have already been used or are in no block
+        """
+        collisions = []
+        for no in numbers:
+            category = self.category_of(no)
+            if not category or not self[category].discard(no):
+                collisions.append(no)
+        return collisions
+
+    def release(self, numbers: Iterable[int]):
+        """mark the `numbers` as free again"""
+        for no in numbers:
+            category = self.category_of(no)
+            if category:
+                self[category].add(no)
+
+
+class NumberIntervals:
+    """
+    the free numbers of a block as sorted, disjoint intervals [start, stop)
+    """
+
+    def __init__(self, block: range):
+        self.block = block
+        self._starts = [block.start] if len(block) else []
+        self._stops = [block.stop] if len(block) else []
+
+    def __repr__(self) -> str:
+        return f'NumberIntervals({self.intervals})'
+
+    def __len__(self) -> int:
+        return sum(stop - start
+                   for start, stop in zip(self._starts, self._stops))
+
+    def __contains__(self, no: int) -> bool:
+        i = bisect.bisect_right(self._starts, no) - 1
+        return i >= 0 and no < self._stops[i]
+
+    @property
+    def intervals(self) -> List[range]:
+        """the free intervals"""
+        return [range(start, stop)
+                for start, stop in zip(self._starts, self._stops)]
+
+    def discard(self, no: int) -> bool:
+        """remove `no` from the free numbers, return False if not free"""
+        i = bisect.bisect_right(self._starts, no) - 1
+        if i < 0 or no >= self._stops[i]:
+            return False
+        start, stop = self._starts[i], self._stops[i]
+        if start == no and stop == no + 1:
+            del self._starts[i], self._stops[i]
+        elif start == no:
+            self._starts[i] = no + 1
+        elif stop == no + 1:
+            self._stops[i] = no
+        else:
+            #  split the interval
+            self._stops[i] = no
+            self._starts.insert(i + 1, no + 1)
+            self._stops.insert(i + 1, stop)
+        return True
+
+    def add(self, no: int):
+        """add `no` to the free numbers"""
+        if no not in self.block or no in self:
+            return
+        i = bisect.bisect_right(self._starts, no)
+        joins_left = i > 0 and self._stops[i - 1] == no
+        joins_right = i < len(self._starts) and self._starts[i] == no + 1
+        if joins_left and joins_right:
+            self._stops[i - 1] = self._stops[i]
+            del self._starts[i], self._stops[i]
+        elif joins_left:
+            self._stops[i - 1] = no + 1
+        elif joins_right:
+            self._starts[i] = no
+        else:
+            self._starts.insert(i, no)
+            self._stops.insert(i, no + 1)
+
+    def take(self, n: int) -> List[int]:
+        """take the lowest `n` free numbers (or less, if exhausted)"""
+        numbers = []
+        while len(numbers) < n and self._starts:
+            start, stop = self._starts[0], self._stops[0]
+            end = min(stop, start + n - len(numbers))
+            numbers.extend(range(start, end))
+            if end == stop:
+                del self._starts[0], self._stops[0]
+            else:
+                self._starts[0] = end
+        return numbers
+
+    def take_contiguous(self, n: int) -> range:
+        """
+        take the first `n` consecutive free numbers,
+        return None if there is no gap large enough
+        """
+        for i, (start, stop) in enumerate(zip(self._starts, self._stops)):
+            if stop - start >= n:
+                if stop - start == n:
+                    del self._starts[i], self._stops[i]
+                else:
+                    self._starts[i] = start + n
+                return range(start, start + n)
+        return None
+
+
+class MatrixBlockError(ValueError):
+    """the matrices do not fit into the blocks of their categories"""
+
+
+_matrix_sums = re.compile(
+    r'(?P<prefix>\b(?:MATROWSUM|MATCOLSUM)\(\s*)(?P<no>\d+)',
+    re.IGNORECASE)
+#  the condition of Matrix(...), with quoted strings like "A(1)"
+_matrix_conditions = re.compile(
+    r'(?P<prefix>\bMatrix\()(?P<condition>(?:"[^"]*"|[^()"])*)\)',
+    re.IGNORECASE)
+#  [NO] is a matrix number only inside a Matrix(...)-condition,
+#  otherwise it is the number of the zone, mainzone etc.
+_condition_numbers = re.compile(r'(?P<prefix>\[NO\]\s*=\s*)(?P<no>\d+)',
+                                re.IGNORECASE)
+
+
+def renumber_formulas(formulas: pd.Series,
+                      plan: Mapping[int, int]) -> pd.Series:
+    """
+    rewrite the numeric references to matrices in the `formulas`
+    like MATROWSUM(12), MATCOLSUM(12) or Matrix([NO]=12)
+    according to the renumbering `plan` {old_no: new_no}
+    """
+    def replace(match: re.Match) -> str:
+        no = int(match['no'])
+        return f'{match["prefix"]}{plan.get(no, no)}'
+
+    def replace_condition(match: re.Match) -> str:
+        condition = _condition_numbers.sub(replace, match['condition'])
+        return f'{match["prefix"]}{condition})'
+
+    def renumber(formula: str) -> str:
+        formula = _matrix_sums.sub(replace, formula)
+        return _matrix_conditions.sub(replace_condition, formula)
+
+    return formulas.map(lambda formula: renumber(formula)
+                        if isinstance(formula, str) else formula)
 
 
 class Matrix(VisumTable):
@@ -77,25 +341,188 @@ class Matrix(VisumTable):
                  'LOADMATRIX': 0,
                  }
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, mode: str = None, new_cols: List[str] = None):
+        super().__init__(mode=mode, new_cols=new_cols)
         self._number_block = MatrixCategories()
+        #  the numbers used in the Visum-Version or other modifications
+        self._seeded = set()
 
     def set_category(self, matrix_category: str):
         """Set set matrix_category"""
         self.matrix_category = matrix_category
 
     @property
-    def matrix_numbers(self) -> MatrixCategories:
+    def matrix_numbers(self) -> NumberIntervals:
         return self._number_block[self.matrix_category]
 
     def next_number(self) -> int:
         """Return next matrix number in range"""
-        try:
-            no = next(self.matrix_numbers)
-        except StopIteration:
-            no = next(self._number_block['_fallback'])
-        return no
+        return self._number_block.next_numbers(self.matrix_category, 1)[0]
+
+    def next_numbers(self, n: int, category: str = None) -> List[int]:
+        """
+        Return the next `n` matrix numbers in the range of `category`
+        (default: the current category), continue with the fallback-numbers,
+        if the range is exhausted
+        """
+        return self._number_block.next_numbers(
+            category or self.matrix_category, n)
+
+    def allocate_numbers(self, categories: Iterable[str]) -> List[int]:
+        """
+        Return a matrix number for each of the `categories`,
+        as if the matrices were added one after another
+        """
+        return self._number_block.allocate(categories)
+
+    def reserve(self, n: int, category: str = None) -> range:
+        """
+        Reserve `n` consecutive matrix numbers in the range of `category`
+        (default: the current category) or in the fallback-numbers
+        """
+        return self._number_block.reserve(category or self.matrix_category, n)
+
+    def seed_numbers(self, *filenames: str) -> List[int]:
+        """
+        Mark the matrix numbers used in the MATRIX-tables of other
+        transfer- or modification-files as used,
+        so that they are not given out again.
+        Matrices deleted in a file free their numbers again.
+
+        Returns
+        -------
+        numbers : list of int
+            the numbers used in the files
+
+        Raises
+        ------
+        ValueError
+            if matrices of this table already use some of the numbers
+        """
+        seeded = set(self._seeded)
+        for filename in filenames:
+            vt = VisumTransfer(user='')
+            vt.read_from_modification(filename, sections_to_read=[self.code])
+            for table in vt.tables.values():
+                numbers = table.df['NO'].astype(int).tolist()
+                if table._mode == '-':
+                    seeded.difference_update(numbers)
+                else:
+                    seeded.update(numbers)
+        collisions = seeded.intersection(self.df.index)
+        if collisions:
+            raise ValueError(f'matrix numbers {sorted(collisions)} '
+                             f'are already used in {filenames}')
+        self._number_block.release(self._seeded - seeded)
+        self._number_block.mark_used(seeded - self._seeded)
+        self._seeded = seeded
+        return sorted(self._seeded)
+
+    def compaction_plan(self) -> Dict[int, int]:
+        """
+        Plan to renumber the matrices, so that the matrices of each block
+        get the lowest numbers of the block, that are not seeded.
+        Matrices with fallback-numbers are moved back into the block
+        of their category, if there is room now.
+
+        Returns
+        -------
+        plan : dict
+            {old_no: new_no} of the matrices to renumber
+        """
+        allocator = MatrixCategories(self._number_block.blocks)
+        allocator.mark_used(self._seeded)
+        categories = self.df.get('CATEGORY', pd.Series('', index=self.df.index))
+        plan = {}
+        for no in sorted(self.df.index):
+            category = allocator.category_of(no)
+            if category == '_fallback' and categories[no] in allocator:
+                category = categories[no]
+            if not category:
+                continue
+            new_no = allocator.next_numbers(category, 1)[0]
+            if new_no != no:
+                plan[no] = new_no
+        return plan
+
+    def renumber(self, plan: Mapping[int, int], *tables: VisumTable):
+        """
+        renumber the matrices according to the `plan` {old_no: new_no}
+        and rewrite the references to the numbers in the formulas
+        of the matrices and of the given `tables`,
+        e.g. the UserDefinedAttributes
+
+        Raises
+        ------
+        ValueError
+            if the new numbers are not unique
+        """
+        df = self.df.rename(index=plan)
+        if not df.index.is_unique:
+            raise ValueError('the renumbered matrices have duplicate numbers')
+        self.df = df
+        for table in (self, ) + tables:
+            if 'FORMULA' in table.df:
+                table.df['FORMULA'] = renumber_formulas(table.df['FORMULA'],
+                                                        plan)
+        self._number_block.release(plan.keys())
+        self._number_block.mark_used(plan.values())
+
+    def add_matrices(self,
+                     matrices: pd.DataFrame,
+                     category: str = None) -> List[int]:
+        """
+        add the matrices defined in the rows of `matrices` at once
+
+        Parameters
+        ----------
+        matrices : pd.DataFrame
+            with the column CODE and other columns of the Matrix.
+            Like in add_data_matrix and add_formula_matrix,
+            empty names and filenames are replaced by the code.
+            Rows with a FORMULA are formula-matrices, the others data-matrices.
+            Missing columns are filled with the default values.
+            If the column NO is given, the numbers have to be allocated before,
+            e.g. with allocate_numbers()
+        category : str, optional
+            the matrix category to take the numbers from and the default
+            for the column CATEGORY. If not given,
+            use the category last set by set_category()
+
+        Returns
+        -------
+        numbers : list of int
+            the numbers of the matrices inserted
+        """
+        if not len(matrices):
+            return []
+        category = category or self.matrix_category
+        df = matrices.rename(columns=str.upper).reset_index(drop=True)
+        if 'NO' in df:
+            numbers = df['NO'].astype(int).tolist()
+        else:
+            numbers = self.next_numbers(len(df), category)
+            df['NO'] = numbers
+
+        if 'FORMULA' in df:
+            is_formula = df['FORMULA'].fillna('').astype(bool)
+        else:
+            is_formula = pd.Series(False, index=df.index)
+        if 'DATASOURCETYPE' not in df:
+            df['DATASOURCETYPE'] = np.where(is_formula, 'FORMULA', 'DATA')
+        #  formula-matrices are not loaded
+        loadmatrix = df.get('LOADMATRIX', pd.Series(0, index=df.index))
+        df['LOADMATRIX'] = loadmatrix.where(~is_formula, 0)
+        for colname, default in (('NAME', df['CODE']),
+                                 ('FILENAME', df['CODE']),
+                                 ('CATEGORY', category)):
+            if colname in df:
+                df[colname] = df[colname].where(
+                    df[colname].fillna('').astype(bool), default)
+            else:
+                df[colname] = default
+        self.add_rows_with_defaults(df)
+        return numbers
 
     def add_data_matrix(self,
                         code: str,
@@ -190,6 +617,95 @@ class Matrix(VisumTable):
                  **kwargs)
         return no
 
+    def read_data(self,
+                  key: Union[int, str],
+                  folder: str,
+                  zones: Iterable[int] = None,
+                  cache: bool = False,
+                  as_xarray: bool = False,
+                  sparse: bool = False) -> Union[np.ndarray, xr.DataArray]:
+        """
+        read the data of the matrix with the number or code `key`
+        from its matrix-file in the `folder`.
+        Works as well for a Matrix-table read from a modification-file
+
+        Parameters
+        ----------
+        key : int or str
+            the number or the code of the matrix
+        folder : str
+            the folder of the matrix-files
+        zones : list of int, optional
+            read only the submatrix of these zones
+        cache : bool, optional
+            cache the matrix as .npy-file and return a memory-map
+        as_xarray : bool, optional
+            return a DataArray with the zones as coords
+        sparse : bool, optional
+            return a scipy.sparse csr-matrix, requires scipy
+        """
+        no, row = get_matrix_row(self, key)
+        return read_matrix(get_matrix_filename(row, folder),
+                           zones=zones,
+                           cache=cache,
+                           as_xarray=as_xarray,
+                           sparse=sparse)
+
+    def replace_categories(self,
+                           other: 'Matrix',
+                           category_groups: List[List[str]]):
+        """
+        replace the matrices of each group of categories
+        with the matrices of `other` in these categories.
+        The new matrices are inserted where the old matrices have been.
+
+        Raises
+        ------
+        MatrixBlockError
+            if the old matrices of a group are not in one piece,
+            if a matrix number is not in the block of its category
+            or if the new matrix numbers collide with the remaining matrices
+        ValueError
+            if `other` has matrices in other categories
+            or if the category groups overlap
+        """
+        blocks = MatrixCategories.get_blocks()
+        df = self.df
+        new_df = other.df
+        runs = []
+        n_replaced = 0
+        for categories in category_groups:
+            pos = np.flatnonzero(df['CATEGORY'].isin(categories))
+            if not len(pos) or pos[-1] - pos[0] + 1 != len(pos):
+                raise MatrixBlockError(f'matrices of {categories} '
+                                       'not in one piece')
+            new_rows = new_df.loc[new_df['CATEGORY'].isin(categories)]
+            for rows in (df.iloc[pos], new_rows):
+                #  numbers outside the blocks were taken from the
+                #  _fallback-numbers, which depend on all other matrices
+                for no, category in rows['CATEGORY'].items():
+                    if no not in blocks.get(category, ()):
+                        raise MatrixBlockError(f'matrix {no} not in the block '
+                                               f'of category {category}')
+            runs.append((pos[0], pos[-1] + 1, new_rows))
+            n_replaced += len(new_rows)
+        if n_replaced != len(new_df):
+            raise ValueError('other has matrices in other categories')
+
+        parts = []
+        start = 0
+        for first, end, new_rows in sorted(runs, key=lambda r: r[0]):
+            if first < start:
+                raise ValueError('category groups overlap')
+            parts.extend([df.iloc[start:first], new_rows])
+            start = end
+        parts.append(df.iloc[start:])
+        new_df = pd.concat(parts)
+        if not new_df.index.is_unique:
+            raise MatrixBlockError('the new matrix numbers collide '
+                                   'with the remaining matrices')
+        self.df = new_df
+
     def get_timestring(self, hour: float) -> str:
         """
         convert hour into a time string in format HH:MM:SS
@@ -232,93 +748,46 @@ class Matrix(VisumTable):
         time_series = params.time_series
 
         self.set_category('OV_TimeSeries_Skims')
-        for idx, ts in time_series.iterrows():
-            ts_code = f'{ts.code:04d}'
-            ts_name = ts.name_long
-            fromtime = self.get_timestring(ts.from_hour)
-            totime = self.get_timestring(ts.to_hour)
-            desgcode_ts = f'O_{ts_code}'
-
-            for dsegcode in dsegcodes:
-                self.add_data_matrix(
-                    code='FAR',
-                    matrixtype='Skim',
-                    name=f'Fahrpreis {dsegcode} {ts_name}',
-                    filename=f'FAR_{ts_code}',
-                    dsegcode=dsegcode,
-                    day=1,
-                    fromtime=fromtime,
-                    totime=totime,
+        #  the skims of each time slice
+        ts = pd.DataFrame({
+            'ts_code': time_series['code'].map('{:04d}'.format),
+            'ts_name': time_series['name_long'],
+            'fromtime': time_series['from_hour'].map(self.get_timestring),
+            'totime': time_series['to_hour'].map(self.get_timestring),
+        })
+        dsegcode = 'O'
+        skims = pd.DataFrame(
+            [('FAR', f'Fahrpreis {d}', d, 1) for d in dsegcodes] +
+            [('XADT', f'Erweiterte Anpassungszeit {dsegcode}', '', ''),
+             ('PJT', f'Empfundene Reisezeit {dsegcode}', dsegcode, 1),
+             ('JRD', f'Reiseweite {dsegcode}', dsegcode, 1),
+             ('FFZ', f'Fahrzeugfolgezeit {dsegcode}', dsegcode, 1)],
+            columns=['code', 'name', 'dsegcode', 'day'])
+        df = ts.merge(skims, how='cross')
+        df['name'] = df['name'] + ' ' + df['ts_name']
+        df['filename'] = df['code'] + '_' + df['ts_code']
+        #  XADT has a demand segment for each time slice and no time
+        is_xadt = df['code'] == 'XADT'
+        df['dsegcode'] = df['dsegcode'].where(~is_xadt, 'O_' + df['ts_code'])
+        df['fromtime'] = df['fromtime'].where(~is_xadt, '')
+        df['totime'] = df['totime'].where(~is_xadt, '')
+        self.add_matrices(
+            df[['code', 'name', 'filename', 'dsegcode', 'day',
+                'fromtime', 'totime']]
+            .assign(matrixtype='Skim',
                     initmatrix=1,
-                    timeref='Departuretime',
-                    # modecode='O',
-                )
-
-            self.add_data_matrix(
-                code='XADT',
-                matrixtype='Skim',
-                name=f'Erweiterte Anpassungszeit {dsegcode} {ts_name}',
-                filename=f'XADT_{ts_code}',
-                dsegcode=desgcode_ts,
-                fromtime="",
-                totime="",
-                initmatrix=1,
-                timeref='Departuretime',
-            )
-
-            dsegcode = 'O'
-
-            self.add_data_matrix(
-                code='PJT',
-                matrixtype='Skim',
-                name=f'Empfundene Reisezeit {dsegcode} {ts_name}',
-                filename=f'PJT_{ts_code}',
-                dsegcode=dsegcode,
-                day=1,
-                fromtime=fromtime,
-                totime=totime,
-                timeref='Departuretime',
-                initmatrix=1,
-            )
-
-            self.add_data_matrix(
-                code='JRD',
-                matrixtype='Skim',
-                name=f'Reiseweite {dsegcode} {ts_name}',
-                filename=f'JRD_{ts_code}',
-                dsegcode=dsegcode,
-                day=1,
-                fromtime=fromtime,
-                totime=totime,
-                initmatrix=1,
-                timeref='Departuretime',
-                # modecode='O',
-            )
-            self.add_data_matrix(
-                code='FFZ',
-                matrixtype='Skim',
-                name=f'Fahrzeugfolgezeit {dsegcode} {ts_name}',
-                filename=f'FFZ_{ts_code}',
-                dsegcode=dsegcode,
-                day=1,
-                fromtime=fromtime,
-                totime=totime,
-                initmatrix=1,
-                timeref='Departuretime',
-                # modecode='O',
-            )
-
-        for dsegcode in dsegcodes:
-            self.add_data_matrix(
-                code='FAR',
-                matrixtype='Skim',
-                name=f'Fahrpreis {dsegcode}',
-                dsegcode=dsegcode,
-                fromtime='',
-                totime='',
-                timeref='Departuretime',
-                # modecode='O',
-            )
+                    timeref='Departuretime'))
+
+        self.add_matrices(pd.DataFrame([
+            dict(code='FAR',
+                 matrixtype='Skim',
+                 name=f'Fahrpreis {d}',
+                 dsegcode=d,
+                 fromtime='',
+                 totime='',
+                 timeref='Departuretime',
+                 )
+            for d in dsegcodes]))
 
         dsegcode = 'O'
 
@@ -594,39 +1063,44 @@ class Matrix(VisumTable):
         # ÖV-Time-Matrices
         modecode = 'O'
         dsegs.add_cols(['NSEG_ZEITSCHEIBE'])
-        for idx, ts in params.time_series.iterrows():
-            ts_name = ts.name_long
-            dsegcode = f'{modecode}_{ts.from_hour:02d}{ts.to_hour:02d}'
-            fromtime = self.get_timestring(ts.from_hour)
-            totime = self.get_timestring(ts.to_hour)
-
-            dsegs.add(code=dsegcode, name=ts_name, mode=modecode, nseg_zeitscheibe=1)
-
-            code_region = dsegcode
-            self.add_data_matrix(
-                code=code_region,
-                matrixtype='Demand',
-                name=f'ÖV-Nachfrage {ts_name}',
-                day=1,
-                fromtime=fromtime,
-                totime=totime,
-                timeref='Departuretime',
-                modecode='O',
-            )
-            formula = f'''Matrix([CODE]="{code_region}") + Matrix([CODE]="{code_fv}") * {ts.Ganglinie_OVFern}'''
-            code = f'{dsegcode} incl. Fernverkehr'
-            self.add_formula_matrix(
-                code=code,
-                formula=formula,
-                matrixtype='Demand',
-                name=f'ÖV-Nachfrage {ts_name} incl. Fernverkehr',
-                dsegcode=dsegcode,
-                day=1,
-                fromtime=fromtime,
-                totime=totime,
-                timeref='Departuretime',
-                modecode='O',
-            )
+        time_series = params.time_series
+        ts = pd.DataFrame({
+            'dsegcode': (f'{modecode}_' +
+                         time_series['from_hour'].map('{:02d}'.format) +
+                         time_series['to_hour'].map('{:02d}'.format)),
+            'ts_name': time_series['name_long'],
+            'fromtime': time_series['from_hour'].map(self.get_timestring),
+            'totime': time_series['to_hour'].map(self.get_timestring),
+            'factor_fv': time_series['Ganglinie_OVFern'].map(str),
+        })
+
+        dsegs.add_rows([dsegs.Row(code=t.dsegcode,
+                                  name=t.ts_name,
+                                  mode=modecode,
+                                  nseg_zeitscheibe=1)
+                        for t in ts.itertuples()])
+
+        #  the demand in the region and incl. the long distance demand
+        #  for each time slice
+        df = ts.merge(pd.DataFrame({'is_formula': [False, True]}),
+                      how='cross')
+        is_formula = df['is_formula']
+        code_region = df['dsegcode']
+        df['code'] = code_region.where(~is_formula,
+                                       code_region + ' incl. Fernverkehr')
+        df['name'] = ('ÖV-Nachfrage ' + df['ts_name']).where(
+            ~is_formula, 'ÖV-Nachfrage ' + df['ts_name'] + ' incl. Fernverkehr')
+        df['formula'] = ('Matrix([CODE]="' + code_region + '") + '
+                         f'Matrix([CODE]="{code_fv}") * ' + df['factor_fv']
+                         ).where(is_formula, '')
+        #  only the formula matrices have a demand segment
+        df['dsegcode'] = code_region.where(is_formula, '')
+        self.add_matrices(
+            df[['code', 'name', 'formula', 'dsegcode', 'fromtime', 'totime']]
+            .assign(matrixtype='Demand',
+                    day=1,
+                    timeref='Departuretime',
+                    modecode=modecode))
 
     def add_other_demand_matrices(self,
                                   params: Params,
@@ -651,36 +1125,33 @@ class Matrix(VisumTable):
                              matrixtype='Demand',
                              objecttyperef='Mainzone')
 
-        for m, mode in params.modes.iterrows():
-            code = mode['code']
-            mode_name = mode['name']
-            matname = f'Wege {mode_name}'
-            matcode = f'Visem_{code}'
-            if matcode in existing_codes:
-                continue
-            self.add_data_matrix(code=matcode,
-                                 name=matname,
-                                 loadmatrix=loadmatrix,
-                                 matrixtype='Demand',
-                                 modecode=code,
-                                 dsegcode=code,
-                                 savematrix=savematrix,
-                                 obb_matrix_ref=f'[CODE]="Visem_OBB_{code}"',
-                                 )
-
-        for m, mode in params.modes.iterrows():
-            code = mode['code']
-            matcode = f'Visem_OBB_{code}'
-            mode_name = mode['bezeichnung']
-            name = f'Wege {mode_name} Oberbezirk Region'
-            if matcode in existing_codes:
-                continue
-            self.add_data_matrix(code=matcode,
-                                 name=name,
-                                 loadmatrix=loadmatrix,
-                                 matrixtype='Demand',
-                                 modecode=code,
-                                 objecttyperef='Mainzone')
+        modes = params.modes
+        codes = modes['code'].astype(str)
+        matcodes = 'Visem_' + codes
+        self.add_matrices(pd.DataFrame({
+            'code': matcodes,
+            'name': 'Wege ' + modes['name'],
+            'loadmatrix': loadmatrix,
+            'matrixtype': 'Demand',
+            'modecode': codes,
+            'dsegcode': codes,
+            'savematrix': savematrix,
+            'obb_matrix_ref': '[CODE]="Visem_OBB_' + codes + '"',
+        }).loc[~matcodes.isin(existing_codes)])
+
+        matcodes = 'Visem_OBB_' + codes
+        names = 'Wege ' + modes['bezeichnung'] + ' Oberbezirk Region'
+        self.add_matrices(pd.DataFrame({
+            'code': matcodes,
+            'name': names,
+            'loadmatrix': loadmatrix,
+            'matrixtype': 'Demand',
+            'modecode': codes,
+            'objecttyperef': 'Mainzone',
+        }).loc[~matcodes.isin(existing_codes)])
+        #  the OBB-matrices of the Verkehrsleistung get the name
+        #  of the OBB-matrix of the last mode
+        name = names.iloc[-1]
 
         # ÖV-Fahrten Schüler für Standi
         code_sch = 'Visem_O_Schueler'
@@ -716,35 +1187,34 @@ class Matrix(VisumTable):
 
         # Verkehrsleistung
         self.set_category('Demand_Verkehrsleistung')
-        for m, mode in params.modes.iterrows():
-            distance_matrix = mode['distance_matrix']
-            code = mode['code']
-            matcode = f'VL_{code}'
-            mode_name = mode['name']
-            matname = f'Verkehrsleistung {mode_name}'
-            dsegcode = mode['default_nsegcode']
-            if dsegcode:
-                cond_nsegcode = f' & [DSEGCODE] = "{dsegcode}"'
-            else:
-                cond_nsegcode = ''
-            if matcode in existing_codes:
-                continue
-            formula = f'Matrix([CODE]="Visem_{code}") * '\
-                f'Matrix([CODE]="{distance_matrix}"{cond_nsegcode})'
-            matcode_obb = f'VL_OBB_{code}'
-            self.add_formula_matrix(code=matcode,
-                                    name=matname,
-                                    formula=formula,
-                                    matrixtype='Demand',
-                                    modecode=code,
-                                    obb_matrix_ref=f'[CODE]="{matcode_obb}"',
-                                    )
-            self.add_data_matrix(code=matcode_obb,
-                                 name=name,
-                                 loadmatrix=0,
-                                 matrixtype='Demand',
-                                 modecode=code,
-                                 objecttyperef='Mainzone')
+        matcodes = 'VL_' + codes
+        dsegcodes = modes['default_nsegcode'].astype(str)
+        cond_nsegcode = (' & [DSEGCODE] = "' + dsegcodes + '"').where(
+            dsegcodes.astype(bool), '')
+        vl = pd.DataFrame({
+            'code': matcodes,
+            'name': 'Verkehrsleistung ' + modes['name'],
+            'formula': ('Matrix([CODE]="Visem_' + codes + '") * '
+                        'Matrix([CODE]="' + modes['distance_matrix'] + '"' +
+                        cond_nsegcode + ')'),
+            'loadmatrix': 0,
+            'modecode': codes,
+            'objecttyperef': 'Zone',
+            'obb_matrix_ref': '[CODE]="VL_OBB_' + codes + '"',
+        }).loc[~matcodes.isin(existing_codes)]
+        vl_obb = pd.DataFrame({
+            'code': 'VL_OBB_' + vl['modecode'],
+            'name': name,
+            'formula': '',
+            'loadmatrix': 0,
+            'modecode': vl['modecode'],
+            'objecttyperef': 'Mainzone',
+            'obb_matrix_ref': '',
+        })
+        #  the formula matrix of each mode followed by its OBB-matrix
+        df = pd.concat([vl, vl_obb], keys=[0, 1]).sort_index(
+            level=1, kind='stable', sort_remaining=False)
+        self.add_matrices(df.assign(matrixtype='Demand'))
 
         # Verkehrsleistung Standi
         mode_code = 'O'
@@ -850,30 +1320,28 @@ class Matrix(VisumTable):
         """Add logsum matrices for each person group and main activity"""
 
         self.set_category(matrix_range)
-        ketten = {ac_code: act['ACTIVITYCODES'].split(',')[1: -1]
-                  for ac_code, act
-                  in actchains.df.iterrows()}  # type: Mapping[str, List[str]]
-        pgr_activities = defaultdict(set)  # type: Mapping[Tuple[str, str], set]
-        for ds_code, ds in demand_strata.df.iterrows():
-            pgr = ds['PERSONGROUPCODES']
-            demandmodelcode = ds['DEMANDMODELCODE']
-            if demandmodelcode in ('VisemGGR', 'Pendler'):
-                activities = pgr_activities[(demandmodelcode, pgr)]
-                new_activities = ketten[ds['ACTIVITYCHAINCODE']]
-                for activity in new_activities:
-                    activities.add(activity)
-        for (nmc, pgr), activities in pgr_activities.items():
-            for activity in activities:
-                code = 'LogsumMatrix'
-                name = f'Logsum {pgr} {activity}'
-                self.add_data_matrix(
-                    code,
-                    name,
-                    matrixtype='Skim',
-                    loadmatrix=0,
-                    savematrix=0,
-                    initmatrix=1,
-                    dmodelcode=nmc,
-                    persongroupcode=pgr,
-                    activitycode=activity,
-                )
+        #  the activities of the chains without the first and last activity
+        ketten = actchains.df['ACTIVITYCODES'].str.split(',').str[1:-1]\
+            .explode().dropna().rename('ACTIVITYCODE')
+        ds = demand_strata.df.loc[
+            demand_strata.df['DEMANDMODELCODE'].isin(('VisemGGR', 'Pendler')),
+            ['DEMANDMODELCODE', 'PERSONGROUPCODES', 'ACTIVITYCHAINCODE']]
+        #  each activity once for the persongroups of each demand model,
+        #  the persongroups in the order they appear in the demand strata
+        keys = ['DEMANDMODELCODE', 'PERSONGROUPCODES']
+        df = ds.merge(ketten, left_on='ACTIVITYCHAINCODE', right_index=True)\
+            .drop_duplicates(keys + ['ACTIVITYCODE'])
+        df = df.assign(group=df.groupby(keys, sort=False).ngroup())\
+            .sort_values('group', kind='stable')
+        self.add_matrices(pd.DataFrame({
+            'code': 'LogsumMatrix',
+            'name': ('Logsum ' + df['PERSONGROUPCODES'] + ' ' +
+                     df['ACTIVITYCODE']),
+            'matrixtype': 'Skim',
+            'loadmatrix': 0,
+            'savematrix': 0,
+            'initmatrix': 1,
+            'dmodelcode': df['DEMANDMODELCODE'],
+            'persongroupcode': df['PERSONGROUPCODES'],
+            'activitycode': df['ACTIVITYCODE'],
+        }))
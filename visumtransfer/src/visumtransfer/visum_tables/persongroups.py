@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 
-from typing import List
+from typing import Callable, List
+import numpy as np
 import pandas as pd
 from collections import defaultdict
 from .matrices import Matrix
 from .activities import Activity, Activitychain
 from .demandstratum import DemandStratum
+from .templates import MatrixTemplate, TemplateEngine
 from visumtransfer.visum_table import VisumTable
 
 
@@ -27,43 +29,95 @@ class PersonGroup(VisumTable):
 
     def get_groups_destmode(self,
                             categories: List[str],
-                            new_category: str) -> pd.DataFrame:
-        """Create Groups as combinations of the categories"""
+                            new_category: str,
+                            prune: Callable[[pd.DataFrame], np.ndarray] = None,
+                            ) -> pd.DataFrame:
+        """
+        Create Groups as combinations of the categories
+
+        The combinations are built as positions of the groups
+        of each category, the strings are composed only for the
+        combinations kept.
+
+        Parameters
+        ----------
+        categories : list of str
+            the categories to combine, the first one varies slowest
+        new_category : str
+            the category of the combined groups
+        prune : callable, optional
+            called after adding each category with a DataFrame of the
+            group codes of the combinations so far, one column per category.
+            Returns a boolean array, which combinations to keep
+
+        Returns
+        -------
+        df : pd.DataFrame
+            the CODE, NAME, GROUPS_CONSTANTS and CATEGORY of the combinations
+        """
         assert categories, f'you need at least one category'
 
-        # take the first category
-        category = categories[0]
         df = self.df.reset_index()
-        df = df.loc[df['CATEGORY'] == category,
-                    ['CODE', 'NAME', 'NAMEPART', 'GROUPS_CONSTANTS', 'CODEPART']]
-        df['GROUPS_CONSTANTS'] = df['CODE']
-        df['CODE'] = df['CODEPART']
-        df['NAME'] = df['NAMEPART']
-        df.drop(['CODEPART', 'NAMEPART'], axis=1, inplace=True)
-        assert len(df), f'no groups defined for category {category}'
-
-        # cross join with the other categories
-        for category in categories[1:]:
-            df_new = self.df.reset_index()
-            df_cat = df_new.loc[df_new['CATEGORY'] == category,
-                                ['CODE', 'NAMEPART', 'CODEPART']]\
-                .rename(columns={'CODE': 'CODE_new'})\
-                .assign(one=1)
+        parts = []
+        for category in categories:
+            df_cat = df.loc[df['CATEGORY'] == category,
+                            ['CODE', 'NAMEPART', 'CODEPART']]
             assert len(df_cat), f'no groups defined for category {category}'
+            parts.append(df_cat)
 
-            df = df.assign(one=1).merge(df_cat, on='one').drop('one', axis=1)
+        # the positions of the groups of each category in the combinations
+        positions = np.arange(len(parts[0]))[:, np.newaxis]
+        positions = self._prune_combinations(positions, parts, categories,
+                                             prune)
+        for part in parts[1:]:
+            n = len(positions)
+            positions = np.column_stack([
+                np.repeat(positions, len(part), axis=0),
+                np.tile(np.arange(len(part)), n)])
+            positions = self._prune_combinations(positions, parts,
+                                                 categories, prune)
 
-            # define code, name and groups_const for composite groups
-            df['CODE'] = df['CODE'] + df['CODEPART']
-            new_name = df['NAME'] + ', ' + df['NAMEPART']
-            df['NAME'] = new_name.str.strip(', ')
-            new_groups_constants = df['GROUPS_CONSTANTS'] + ',' + df['CODE_new']
-            df['GROUPS_CONSTANTS'] = new_groups_constants
-            df.drop(['CODE_new', 'CODEPART', 'NAMEPART'], axis=1, inplace=True)
+        # compose the strings of the combinations
+        first = parts[0].iloc[positions[:, 0]]
+        if len(parts) == 1:
+            index = first.index
+        else:
+            index = pd.RangeIndex(len(positions))
+        first = first.set_index(index)
+        codes = first['CODEPART']
+        names = first['NAMEPART']
+        groups_constants = first['CODE']
+        for part, pos in zip(parts[1:], positions[:, 1:].T):
+            part = part.iloc[pos].set_index(index)
+            codes = codes + part['CODEPART']
+            new_name = names + ', ' + part['NAMEPART']
+            names = new_name.str.strip(', ')
+            groups_constants = groups_constants + ',' + part['CODE']
 
+        df = pd.DataFrame({'CODE': codes,
+                           'NAME': names,
+                           'GROUPS_CONSTANTS': groups_constants})
         df['CATEGORY'] = new_category
         return df
 
+    @staticmethod
+    def _prune_combinations(positions: np.ndarray,
+                            parts: List[pd.DataFrame],
+                            categories: List[str],
+                            prune: Callable[[pd.DataFrame], np.ndarray] = None,
+                            ) -> np.ndarray:
+        """keep the combinations accepted by `prune`"""
+        if prune is None:
+            return positions
+        k = positions.shape[1]
+        combinations = pd.DataFrame({
+            category: pd.Categorical.from_codes(
+                pos, categories=part['CODE'].to_numpy())
+            for category, part, pos in zip(categories[:k], parts[:k],
+                                           positions.T)})
+        keep = np.asarray(prune(combinations), dtype=bool)
+        return positions[keep]
+
     def create_demand_strata(self,
                              groups_generation: pd.DataFrame,
                              trip_chain_rates: pd.DataFrame,
@@ -77,7 +131,15 @@ class PersonGroup(VisumTable):
                              output_categories: List[str] = [],
                              dsegset: str = 'O,F,M,P,R',
                              ):
-        """Create the Groups for the Destination and Model modelling"""
+        """
+        Create the Groups for the Destination and Model modelling
+
+        The persongroups of the generation are joined with the trip chain
+        rates on their sorted groups of the `tc_categories`.
+        Each combination of a generation group and a trip chain becomes a
+        demand stratum, each combination of a generation group and a
+        main activity a persongroup.
+        """
         pgr_in_categories = self.df.loc[self.df['CATEGORY'].isin(tc_categories)].index
         pgr_in_output_categories = self.df.loc[self.df['CATEGORY'].isin(
             output_categories)].index
@@ -85,90 +147,93 @@ class PersonGroup(VisumTable):
         pgr_generation = self.df.loc[self.df['CATEGORY'] == category_generation].copy()
 
         # create common column to merge Persongrups and TripChainRates
-        pgr_generation['gr_tc'] = ''
-        for pg_code, gr_const in pgr_generation['GROUPS_CONSTANTS'].items():
-            gr_split = gr_const.split(',')
-            gr_tc = ','.join(sorted([gr
-                                     for gr in gr_split
-                                     if gr in pgr_in_categories]))
-            pgr_generation.loc[pg_code, 'gr_tc'] = gr_tc
-
+        pgr_generation['gr_tc'] = self.join_sorted(
+            pgr_generation['GROUPS_CONSTANTS'], pgr_in_categories)
         pgr_generation.index.name = 'PGRCODES'
-
-        trip_chain_rates['gr_tc'] = ''
-        for idx, gr_const in trip_chain_rates['group_generation'].items():
-            gr_split = gr_const.split(',')
-            gr_tc = ','.join(sorted([gr for gr in gr_split]))
-            trip_chain_rates.loc[idx, 'gr_tc'] = gr_tc
+        #  the trip_chain_rates of the caller are not changed
+        trip_chain_rates = trip_chain_rates.assign(
+            gr_tc=self.join_sorted(trip_chain_rates['group_generation']))
 
         tcs = pgr_generation.reset_index().merge(trip_chain_rates, on='gr_tc')
         assert len(tcs), f'No matching tripchains found for categories {tc_categories}'
 
-        act_hierarchy = activities.get_hierarchy()
-
-        # loop over all tripchains in the groups
-        rows = []
-        for _, tc in tcs.iterrows():
-            gg_code = tc['PGRCODES']
-            gd_code = tc['PGRCODES']
-            act_chain_code = tc['code_tc']
-            act_sequence = tc['Sequence']
-            tc_name = tc['NAME']
-            mobilityrate = tc['rate']
-            mainact_code = activities.get_main_activity(act_hierarchy, act_sequence)
-            pgr_code = '_'.join((gd_code, mainact_code))
-            dstratcode = ':'.join((gd_code, act_chain_code))
-            pgr_name = f'{tc_name} mit Hauptaktivität {mainact_code}'
-            dstrat_name = f'{tc_name}, Wegekette {act_chain_code}'
-
-            # if the the group occurs the first time ...
-            if pgr_code not in self.gd_codes:
-                #  create it and add it to self.gd_codes
-                self.gd_codes[pgr_code] = [(act_chain_code, mobilityrate)]
-                groups_constants = tc['GROUPS_CONSTANTS']
-                gr_split = groups_constants.split(',')
-                groups_output = [gr
-                                 for gr in gr_split
-                                 if gr in pgr_in_output_categories]
-                grcodes_output = ','.join(sorted(groups_output))
-
-                # get the first Tarifmatrix for the PersonGroups
-                # (like Senionrenticket)
-                for group in gr_split:
-                    tarifmatrix_pgr = self.df.loc[group, 'TARIFMATRIX']
-                    if tarifmatrix_pgr:
-                        break
-
-                # use special activity-tarifmatrix, else the persongroup-matrix
-                tarifmatrix = tarifmatrix_pgr or ''
-
-                self.add_group(
-                    category=category,
-                    model_code=model_code,
-                    code=pgr_code,
-                    name=pgr_name,
-                    groups_constants=groups_constants,
-                    groups_output=grcodes_output,
-                    group_generation=gg_code,
-                    main_act=mainact_code,
-                    tarifmatrix=tarifmatrix,
-                )
-            else:
-                # otherwise just append the activity chain
-                # to the chains the persons makes
-                self.gd_codes[pgr_code].append((act_chain_code, mobilityrate))
-
-            row = dstrats.Row(code=dstratcode,
-                              name=dstrat_name,
-                              demandmodelcode=model_code,
-                              persongroupcodes=pgr_code,
-                              activitychaincode=act_chain_code,
-                              mainactcode=mainact_code,
-                              dsegset=dsegset,
-                              mobilityrate=mobilityrate,
-                              )
-            rows.append(row)
-        dstrats.add_rows(rows)
+        mainact_codes = activities.get_main_activities(tcs['Sequence'])
+        pgr_codes = tcs['PGRCODES'] + '_' + mainact_codes
+        tc_names = tcs['NAME'].astype(str)
+
+        # the groups occuring the first time are created
+        is_new = ~pgr_codes.duplicated() & ~pgr_codes.isin(list(self.gd_codes))
+        new_groups = tcs.loc[is_new, ['PGRCODES', 'GROUPS_CONSTANTS']]
+        groups = pd.DataFrame({
+            'category': category,
+            'model_code': model_code,
+            'code': pgr_codes[is_new],
+            'name': tc_names[is_new] + ' mit Hauptaktivität ' +
+            mainact_codes[is_new],
+            'groups_constants': new_groups['GROUPS_CONSTANTS'],
+            'groups_output': self.join_sorted(new_groups['GROUPS_CONSTANTS'],
+                                              pgr_in_output_categories),
+            'group_generation': new_groups['PGRCODES'],
+            'main_act': mainact_codes[is_new],
+            # use the first Tarifmatrix for the PersonGroups
+            # (like Senionrenticket)
+            'tarifmatrix': self.get_first_tarifmatrix(
+                new_groups['GROUPS_CONSTANTS']),
+        })
+        for kwargs in groups.to_dict('records'):
+            self.add_group(**kwargs)
+
+        # append the activity chains to the chains the persons make
+        for pgr_code, act_chain_code, mobilityrate in zip(
+                pgr_codes, tcs['code_tc'], tcs['rate']):
+            self.gd_codes[pgr_code].append((act_chain_code, mobilityrate))
+
+        strata = pd.DataFrame({
+            'CODE': tcs['PGRCODES'] + ':' + tcs['code_tc'],
+            'NAME': tc_names + ', Wegekette ' + tcs['code_tc'],
+            'DEMANDMODELCODE': model_code,
+            'ACTIVITYCHAINCODE': tcs['code_tc'],
+            'PERSONGROUPCODES': pgr_codes,
+            'DSEGSET': dsegset,
+            'MOBILITYRATE': tcs['rate'],
+            'MAINACTCODE': mainact_codes,
+        }).reindex(columns=dstrats.cols)
+        dstrats.add_rows(strata.itertuples(index=False, name=None))
+
+    @staticmethod
+    def join_sorted(codes: pd.Series,
+                    valid_codes: pd.Index = None) -> pd.Series:
+        """
+        split the comma-separated `codes` of each row, keep the `valid_codes`
+        and join them again in sorted order
+        """
+        exploded = pd.Series(codes.to_numpy()).str.split(',').explode()
+        if valid_codes is not None:
+            exploded = exploded.loc[exploded.isin(valid_codes)]
+        joined = exploded.sort_values(kind='stable')\
+            .groupby(level=0).agg(','.join)
+        return pd.Series(joined.reindex(range(len(codes)), fill_value='')
+                         .to_numpy(), index=codes.index)
+
+    def get_first_tarifmatrix(self, groups_constants: pd.Series) -> pd.Series:
+        """
+        return the first TARIFMATRIX set for the groups
+        in the comma-separated `groups_constants` of each row
+        """
+        exploded = pd.Series(groups_constants.to_numpy()).str.split(',')\
+            .explode()
+        missing = ~exploded.isin(self.df.index)
+        if missing.any():
+            raise KeyError(f'groups {exploded[missing].unique()} not defined')
+        tarifmatrices = pd.Series(
+            self.df['TARIFMATRIX'].loc[exploded].to_numpy(),
+            index=exploded.index)
+        is_set = tarifmatrices.map(bool)
+        tarifmatrices = tarifmatrices.loc[is_set]
+        first = tarifmatrices.loc[~tarifmatrices.index.duplicated()]
+        return pd.Series(first.reindex(range(len(groups_constants)),
+                                       fill_value='').to_numpy(),
+                         index=groups_constants.index)
 
     def create_df_from_group_list(self):
         df = self.df_from_array(self.groups)
@@ -190,58 +255,56 @@ class PersonGroup(VisumTable):
                                       'gr_id')
         df_out_long = df_out_long.loc[~df_out_long['group'].isnull()]
         df_out_long.set_index(df_out_long.index.droplevel(level=1), inplace=True)
-        prefix = 'Pgr_'
-
-        for group_output, detailed_groups in df_out_long.groupby(by='group'):
-            gr = self.df.loc[group_output]
-            str_name = f'Wege der {gr.CATEGORY}-Gruppe {gr.NAME}'
-            code = f'{prefix}{gr.name}'
-            pgrset = ','.join(sorted(detailed_groups.index))
-
-            matrices.set_category('Demand_Pgr')
-            matrices.add_data_matrix(
-                code=code,
-                name=str_name,
-                modeset=','.join(sorted(modes['code'])),
-                persongroupset=pgrset,
-                persongroupcode=group_output,
-            )
-            vl_code = f'VL_{code}'
-            formel_vl = f'Matrix([CODE]="{code}") * Matrix([CODE]="KM")'
-            vl_name = f'Verkehrsleistung der {gr.CATEGORY}-Gruppe {gr.NAME}'
-
-            matrices.add_formula_matrix(
-                code=vl_code,
-                formula=formel_vl,
-                name=vl_name,
-                modeset=','.join(sorted(modes['code'])),
-                persongroupset=pgrset,
-                persongroupcode=group_output,
-            )
+        pgrsets = df_out_long.reset_index()\
+            .groupby('group')['CODE']\
+            .agg(lambda groups: ','.join(sorted(groups)))
+        groups = self.df.loc[pgrsets.index, ['CATEGORY', 'NAME']]
+        #  the output groups combined with the modes
+        frame = pd.DataFrame({'group': pgrsets.index,
+                              'pgrset': pgrsets.to_numpy(),
+                              'category': groups['CATEGORY'].to_numpy(),
+                              'name': groups['NAME'].to_numpy()})\
+            .merge(pd.DataFrame({'mode': modes['code'].to_numpy(),
+                                 'mode_name': modes['name'].to_numpy()}),
+                   how='cross')
+        frame['first_mode'] = ~frame['group'].duplicated()
+        frame['modeset'] = ','.join(sorted(modes['code']))
+        group = dict(persongroupset='{pgrset}', persongroupcode='{group}')
 
-            for _, mode in modes.iterrows():
-                mode_name = mode['name']
+        with TemplateEngine(matrices) as engine:
+            engine.expand(
+                frame,
+                MatrixTemplate(
+                    'pgr', 'Demand_Pgr',
+                    code='Pgr_{group}',
+                    name='Wege der {category}-Gruppe {name}',
+                    modeset='{modeset}',
+                    where='first_mode',
+                    **group),
+                MatrixTemplate(
+                    'vl_pgr', 'Demand_Pgr',
+                    code='VL_Pgr_{group}',
+                    formula='Matrix([CODE]="Pgr_{group}") * Matrix([CODE]="KM")',
+                    name='Verkehrsleistung der {category}-Gruppe {name}',
+                    modeset='{modeset}',
+                    where='first_mode',
+                    **group),
                 # add output matrix
-                str_name = f'Wege mit Verkehrsmittel {mode_name} der {gr.CATEGORY}-Gruppe {gr.NAME}'
-                code = f'{prefix}{gr.name}_{mode.code}'
-                pgrset = ','.join(sorted(detailed_groups.index))
-                matrices.set_category('Modes_Demand_Pgr')
-                matrices.add_data_matrix(
-                    code=code,
-                    name=str_name,
-                    modecode=mode.code,
-                    modeset=mode.code,
-                    persongroupset=pgrset,
-                    persongroupcode=group_output,
-                )
-                vl_code = f'VL_{code}'
-                formel_vl = f'Matrix([CODE]="{code}") * Matrix([CODE]="KM")'
-                vl_name = f'Verkehrsleistung mit Verkehrsmittel {mode_name} der {gr.CATEGORY}-Gruppe {gr.NAME}'
-                matrices.add_formula_matrix(
-                    code=vl_code,
-                    formula=formel_vl,
-                    name=vl_name,
-                    modeset=','.join(sorted(modes['code'])),
-                    persongroupset=pgrset,
-                    persongroupcode=group_output,
-                )
+                MatrixTemplate(
+                    'mode', 'Modes_Demand_Pgr',
+                    code='Pgr_{group}_{mode}',
+                    name='Wege mit Verkehrsmittel {mode_name} '
+                    'der {category}-Gruppe {name}',
+                    modecode='{mode}',
+                    modeset='{mode}',
+                    **group),
+                MatrixTemplate(
+                    'vl_mode', 'Modes_Demand_Pgr',
+                    code='VL_Pgr_{group}_{mode}',
+                    formula='Matrix([CODE]="Pgr_{group}_{mode}") * '
+                    'Matrix([CODE]="KM")',
+                    name='Verkehrsleistung mit Verkehrsmittel {mode_name} '
+                    'der {category}-Gruppe {name}',
+                    modeset='{modeset}',
+                    **group),
+            )
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+from typing import Callable, List, Union
+
+import numpy as np
+import pandas as pd
+
+from .base import UserDefinedAttribute
+from .matrices import Matrix
+
+
+class MatrixNumbers(dict):
+    """
+    the numbers of the matrices expanded for one row by template key.
+    A key like 'mr|trips' returns the number of the first key present
+    """
+
+    def __missing__(self, key: str) -> int:
+        for alternative in key.split('|'):
+            if dict.__contains__(self, alternative):
+                return self[alternative]
+        raise KeyError(key)
+
+
+class Template:
+    """
+    a family of rows of a table, declared by a pattern for each column
+
+    String patterns are formatted with the columns of the row of the frame
+    the template is expanded against, and with `no`, the numbers of the
+    matrices expanded for that row by template key,
+    e.g. '[MATROWSUM({no[vl]:d})]'. Other values are taken as they are.
+    """
+
+    def __init__(self,
+                 where: Union[str, Callable[[pd.DataFrame], np.ndarray]] = None,
+                 **columns):
+        """
+        Parameters
+        ----------
+        where : str or callable, optional
+            the boolean column of the frame or a function returning
+            a boolean mask for the frame: only the selected rows are expanded
+        **columns
+            the patterns of the columns
+        """
+        self.where = where
+        self.columns = {colname.upper(): pattern
+                        for colname, pattern in columns.items()}
+
+    def select(self, frame: pd.DataFrame) -> np.ndarray:
+        """return the positions of the rows of `frame` to expand"""
+        if self.where is None:
+            return np.arange(len(frame))
+        if callable(self.where):
+            mask = self.where(frame)
+        else:
+            mask = frame[self.where]
+        return np.flatnonzero(np.asarray(mask, dtype=bool))
+
+    def format(self, contexts: List[dict]) -> pd.DataFrame:
+        """return the columns formatted with the `contexts` of the rows"""
+        data = {}
+        for colname, pattern in self.columns.items():
+            if isinstance(pattern, str):
+                data[colname] = [pattern.format(**context)
+                                 for context in contexts]
+            else:
+                data[colname] = [pattern] * len(contexts)
+        return pd.DataFrame(data, index=range(len(contexts)))
+
+
+class MatrixTemplate(Template):
+    """a family of matrices with the numbers taken from `category`"""
+
+    def __init__(self,
+                 key: str,
+                 category: str,
+                 code: str,
+                 name: str = '',
+                 formula: str = '',
+                 where: Union[str, Callable] = None,
+                 **columns):
+        """
+        Parameters
+        ----------
+        key : str
+            the key to refer to the numbers of the matrices
+        category : str
+            the matrix category, which is also the range of the numbers
+        code, name, formula : str
+            the patterns of the code, the name and the formula.
+            Matrices without formula are data-matrices
+        """
+        super().__init__(where=where, code=code, name=name, formula=formula,
+                         **columns)
+        self.key = key
+        self.category = category
+
+
+class AttributeTemplate(Template):
+    """a family of user defined attributes"""
+
+    def __init__(self,
+                 objid: str,
+                 name: str,
+                 formula: str = None,
+                 where: Union[str, Callable] = None,
+                 **columns):
+        """
+        Parameters
+        ----------
+        objid : str
+            the network type like NETWORK, ZONE, ACTIVITY etc.
+        name : str
+            the pattern of the name, which is used as code and attid, too,
+            if they are not given
+        formula : str, optional
+            the pattern of the formula. Without formula,
+            the attributes are data-attributes
+        """
+        datasourcetype = 'DATA' if formula is None else 'FORMULA'
+        if formula is not None:
+            columns['formula'] = formula
+        super().__init__(where=where, objid=objid, name=name,
+                         datasourcetype=datasourcetype, **columns)
+
+
+class TemplateEngine:
+    """
+    expand the templates of matrices and attributes against the rows
+    of the activity, mode or group frames.
+
+    For each row of a frame, the templates are expanded in the order given,
+    so that the matrices get the same numbers as if they were added one
+    by one. The rows are collected and appended to the Matrix- and the
+    UserDefinedAttribute-table at once by `flush`, which is called when
+    leaving the context:
+
+    >>> with TemplateEngine(matrices, userdef) as engine:
+    ...     numbers = engine.expand(frame, *templates)
+    """
+
+    def __init__(self,
+                 matrices: Matrix = None,
+                 userdef: UserDefinedAttribute = None):
+        self.matrices = matrices
+        self.userdef = userdef
+        self._matrix_rows: List[pd.DataFrame] = []
+        self._attribute_rows: List[pd.DataFrame] = []
+
+    def __enter__(self) -> 'TemplateEngine':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def expand(self,
+               frame: pd.DataFrame,
+               *templates: Template) -> pd.DataFrame:
+        """
+        expand the `templates` against the rows of `frame`,
+        allocate the numbers of the matrices and resolve the references
+        to them in the patterns
+
+        Returns
+        -------
+        numbers : pd.DataFrame
+            the numbers of the matrices with the index of the frame and
+            the keys of the matrix-templates as columns,
+            <NA> for the rows not selected by a template
+        """
+        records = frame.to_dict('records') if len(frame.columns) \
+            else [{} for _ in range(len(frame))]
+        selected = [template.select(frame) for template in templates]
+        keys = [template.key if isinstance(template, MatrixTemplate) else None
+                for template in templates]
+
+        #  allocate the numbers in the order the matrices are added one by one
+        all_rows = np.concatenate(selected + [np.array([], dtype=int)])
+        positions = np.repeat(np.arange(len(templates)),
+                              [len(r) for r in selected])
+        order = np.lexsort((positions, all_rows))
+        is_matrix = np.array([key is not None for key in keys] + [False])
+        order = order[is_matrix[positions[order]]]
+        if len(order) and self.matrices is None:
+            raise ValueError('no Matrix-table given to add the matrices')
+        allocated = np.zeros(len(all_rows), dtype=int)
+        if len(order):
+            allocated[order] = self.matrices.allocate_numbers(
+                [templates[p].category for p in positions[order]])
+
+        offsets = np.cumsum([0] + [len(r) for r in selected])
+        row_numbers = [MatrixNumbers() for _ in records]
+        numbers = pd.DataFrame(
+            {key: pd.Series(pd.NA, index=frame.index, dtype='Int64')
+             for key in dict.fromkeys(k for k in keys if k is not None)})
+        for position, key in enumerate(keys):
+            if key is None:
+                continue
+            template_numbers = allocated[offsets[position]:
+                                         offsets[position + 1]]
+            for row, no in zip(selected[position], template_numbers):
+                row_numbers[row][key] = int(no)
+            numbers.iloc[selected[position],
+                         numbers.columns.get_loc(key)] = template_numbers
+
+        matrix_frames, attribute_frames = [], []
+        for position, template in enumerate(templates):
+            rows = selected[position]
+            df = template.format([dict(records[row], no=row_numbers[row])
+                                  for row in rows])
+            df['_ROW'] = rows
+            df['_TEMPLATE'] = position
+            if isinstance(template, MatrixTemplate):
+                df['CATEGORY'] = template.category
+                df['NO'] = allocated[offsets[position]:offsets[position + 1]]
+                matrix_frames.append(df)
+            else:
+                if self.userdef is None:
+                    raise ValueError('no UserDefinedAttribute-table given '
+                                     'to add the attributes')
+                attribute_frames.append(df)
+
+        #  the rows of the frame one after another
+        for frames, queue in ((matrix_frames, self._matrix_rows),
+                              (attribute_frames, self._attribute_rows)):
+            if frames:
+                queue.append(pd.concat(frames, ignore_index=True)
+                             .sort_values(['_ROW', '_TEMPLATE'], kind='stable')
+                             .drop(columns=['_ROW', '_TEMPLATE']))
+        return numbers
+
+    def flush(self):
+        """append the rows expanded so far to the tables at once"""
+        if self._matrix_rows:
+            self.matrices.add_matrices(
+                pd.concat(self._matrix_rows, ignore_index=True))
+            self._matrix_rows = []
+        if self._attribute_rows:
+            self.userdef.add_attributes(
+                pd.concat(self._attribute_rows, ignore_index=True))
+            self._attribute_rows = []
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
 import xarray as xr
 import pandas as pd
 from .demand import DemandDescription
@@ -43,54 +44,110 @@ class TimeSeries(VisumTable):
                       visem_timeseries: VisemTimeSeries,
                       persongroups: PersonGroup,
                       start_idx=100,
+                      deduplicate: bool = False,
                       ):
-
-        rows = []
-        rows_ganglinienelement = []
-        rows_nachfrageganglinien = []
-        rows_visem_nachfrageganglinien = []
-        ap_timeseries = ap_timeseries\
+        """
+        create the time series of the activity pairs with their items
+        for the intervals of `time_series` and the VISEM-time series
+        of the activity pairs and persongroups
+
+        The weight of an interval is the sum of the hourly shares
+        in the interval, calculated for all activity pairs at once.
+
+        Parameters
+        ----------
+        deduplicate : bool, optional
+            if True, the activity pairs with the same profile of shares
+            share one time series, see `get_shared_numbers`
+        """
+        codes = activitypairs['code'].to_numpy()
+        idx = activitypairs['idx'].to_numpy()
+        numbers = idx + start_idx
+
+        # Ganglinie
+        shares = ap_timeseries\
             .reset_index()\
-            .set_index(['index', 'activitypair'])
-
-        for a, ap in activitypairs.iterrows():
-            ap_code = ap['code']
-            idx = ap['idx']
-            no = idx + start_idx
-            row = self.Row(no=no, name=ap_code)
-            rows.append(row)
-
-            # Nachfrageganglinie
-            row_nachfrageganglinie = demandtimeseries.Row(
-                no=no, code=ap_code, name=ap_code, timeseriesno=no)
-            rows_nachfrageganglinien.append(row_nachfrageganglinie)
-
-            # Ganglinie
-            ap_timeserie = ap_timeseries.iloc[idx]
-            for t, ts in time_series.iterrows():
-                from_hour = ts['from_hour']
-                to_hour = ts['to_hour']
-                anteil = ap_timeserie.iloc[from_hour:to_hour].sum()
-                if anteil:
-                    row_ganglinienelement = timeseriesitem.Row(
-                        timeseriesno=no,
-                        starttime=from_hour * 3600,
-                        endtime=to_hour * 3600,
-                        weight=anteil)
-                    rows_ganglinienelement.append(row_ganglinienelement)
-
-            # Personengruppen
-            for pg_code, pg in persongroups.df.iterrows():
-                row_visem_ganglinie = visem_timeseries.Row(
-                    persongroupcode=pg_code, timeseriesno=no)
-                if not pg['DEMANDMODELCODE'] == 'VisemGeneration':
-                    row_visem_ganglinie.activitypaircode = ap_code
-                rows_visem_nachfrageganglinien.append(row_visem_ganglinie)
-
-        self.add_rows(rows)
-        timeseriesitem.add_rows(rows_ganglinienelement)
-        demandtimeseries.add_rows(rows_nachfrageganglinien)
-        visem_timeseries.add_rows(rows_visem_nachfrageganglinien)
+            .set_index(['index', 'activitypair'])\
+            .to_numpy(dtype='f8')[idx]
+        from_hours = time_series['from_hour'].to_numpy()
+        to_hours = time_series['to_hour'].to_numpy()
+        #  sum the slices like Series.sum, skipping missing shares,
+        #  a difference of cumulated sums would add rounding errors
+        weights = np.column_stack(
+            [np.nansum(shares[:, from_hour:to_hour], axis=1)
+             for from_hour, to_hour in zip(from_hours, to_hours)])
+
+        timeseries_numbers = numbers
+        names = codes
+        if deduplicate:
+            timeseries_numbers = self.get_shared_numbers(weights, numbers)
+            names = self.get_shared_names(codes, timeseries_numbers)
+        is_own = timeseries_numbers == numbers
+
+        self.add_rows_with_defaults(pd.DataFrame({'NO': numbers[is_own],
+                                                  'NAME': names[is_own]}))
+        #  shared time series get no items
+        ap_pos, interval_pos = np.nonzero((weights != 0) &
+                                          is_own[:, np.newaxis])
+        timeseriesitem.add_rows_with_defaults(
+            pd.DataFrame({'TIMESERIESNO': numbers[ap_pos],
+                          'STARTTIME': from_hours[interval_pos] * 3600,
+                          'ENDTIME': to_hours[interval_pos] * 3600,
+                          'WEIGHT': weights[ap_pos, interval_pos]}))
+
+        # Nachfrageganglinie
+        demandtimeseries.add_rows_with_defaults(
+            pd.DataFrame({'NO': numbers, 'CODE': codes, 'NAME': codes,
+                          'TIMESERIESNO': timeseries_numbers}))
+
+        # Personengruppen
+        pg_codes = persongroups.df.index.to_numpy()
+        is_generation = (persongroups.df['DEMANDMODELCODE'] ==
+                         'VisemGeneration').to_numpy()
+        n_groups = len(pg_codes)
+        visem_timeseries.add_rows_with_defaults(
+            pd.DataFrame({
+                'ACTIVITYPAIRCODE': np.where(np.tile(is_generation,
+                                                     len(codes)),
+                                             '',
+                                             np.repeat(codes, n_groups)),
+                'PERSONGROUPCODE': np.tile(pg_codes, len(codes)),
+                'TIMESERIESNO': np.repeat(timeseries_numbers, n_groups),
+            }))
+
+    @staticmethod
+    def get_shared_numbers(weights: np.ndarray,
+                           numbers: np.ndarray,
+                           decimals: int = 9) -> np.ndarray:
+        """
+        return for each row of `weights` the number of the first row
+        with the same profile. The rows are normalized to a sum of 1
+        and rounded to `decimals`, and identified by their hash
+
+        Parameters
+        ----------
+        weights : np.ndarray
+            the weights of the time series items, one row per time series
+        numbers : np.ndarray
+            the numbers of the time series
+        """
+        weights = np.asarray(weights, dtype='f8')
+        totals = weights.sum(axis=1, keepdims=True)
+        normalized = np.divide(weights, totals,
+                               out=np.zeros_like(weights),
+                               where=totals != 0)
+        #  + 0. to hash -0. like 0.
+        keys = pd.util.hash_pandas_object(
+            pd.DataFrame(normalized.round(decimals) + 0.), index=False)
+        return pd.Series(numbers).groupby(keys.to_numpy())\
+            .transform('first').to_numpy()
+
+    @staticmethod
+    def get_shared_names(names: np.ndarray,
+                         shared_numbers: np.ndarray) -> np.ndarray:
+        """return the names of the rows sharing a time series joined"""
+        return pd.Series(names).groupby(shared_numbers)\
+            .transform(','.join).to_numpy()
 
 
 class DemandSegment(VisumTable):
@@ -106,61 +163,70 @@ class DemandSegment(VisumTable):
                           demandtimeseries: DemandTimeSeries,
                           demand_description: DemandDescription,
                           start_idx: int = 80,
+                          deduplicate: bool = False,
                           ):
-        """Add Ganglinien for OV"""
+        """
+        Add Ganglinien for OV
+
+        The hourly shares of all haps are calculated at once, the items
+        are the non-zero shares of the (hap, stunde)-array.
+
+        Parameters
+        ----------
+        ds_timeseries : xr.Dataset
+            with the ganglinie by hap and stunde and the labels lab_hap
+            of the haps. May be backed by dask-arrays
+        deduplicate : bool, optional
+            if True, the haps with the same hourly shares share one
+            time series, see `TimeSeries.get_shared_numbers`
+        """
         mode = 'O'
-        rows_nseg = []
-        rows_ganglinie = []
-        rows_ganglinienelement = []
-        rows_nachfrageganglinien = []
-        rows_nachfragebeschreibung = []
         gl = ds_timeseries.ganglinie
         ds_timeseries['anteile_stunde'] = gl / gl.sum('stunde')
-
-        for hap in ds_timeseries.hap:
-            hap_name = hap.lab_hap.values
-            mat_code = f'Visem_OV_{hap_name}'
-
-            nsg_code = f'OV_{hap_name}'
-            nseg_name = f'OV {hap_name}'
-
-            hap_id = hap.hap.values
-            nachfr_gl_nr = gl_nr = hap_id + start_idx
-            gl_name = f'OV_{hap_name}'
-            rows_ganglinie.append(timeseries.Row(no=gl_nr, name=gl_name))
-
-            row_nachfrageganglinie = demandtimeseries.Row(
-                no=nachfr_gl_nr, code=gl_name, name=gl_name,
-                timeseriesno=gl_nr)
-            rows_nachfrageganglinien.append(row_nachfrageganglinie)
-
-            gl_stunde = ds_timeseries.anteile_stunde.sel(hap=hap_id)
-
-            for stunde in gl_stunde:
-                # in sekunden, Intervalle von 60 sec.
-                starttime = stunde.stunde * 3600
-                endtime = starttime + 3600
-                if stunde:
-                    row_ganglinienelement = timeseriesitems.Row(
-                        timeseriesno=gl_nr,
-                        starttime=starttime,
-                        endtime=endtime,
-                        weight=stunde)
-                    rows_ganglinienelement.append(row_ganglinienelement)
-
-            matrix_descr = f'MATRIX([CODE]="{mat_code}")'
-            rows_nseg.append(self.Row(code=nsg_code,
-                                      name=nseg_name,
-                                      mode=mode))
-            rows_nachfragebeschreibung.append(demand_description.Row(
-                dsegcode=nsg_code,
-                demandtimeseriesno=nachfr_gl_nr,
-                matrixref=matrix_descr
-            ))
-
-        self.add_rows(rows_nseg)
-        timeseries.add_rows(rows_ganglinie)
-        demandtimeseries.add_rows(rows_nachfrageganglinien)
-        timeseriesitems.add_rows(rows_ganglinienelement)
-        demand_description.add_rows(rows_nachfragebeschreibung)
-
+        #  compute a dask-backed dataset once
+        anteile = ds_timeseries.anteile_stunde\
+            .transpose('hap', 'stunde')\
+            .compute()
+        shares = np.asarray(anteile.values)
+        hap_names = np.asarray(anteile.lab_hap.values).astype(str)
+        hours = np.asarray(anteile.stunde.values)
+
+        numbers = np.asarray(anteile.hap.values) + start_idx
+        gl_names = np.char.add('OV_', hap_names)
+        gl_numbers = numbers
+        ts_names = gl_names
+        if deduplicate:
+            gl_numbers = timeseries.get_shared_numbers(
+                np.nan_to_num(shares), numbers)
+            ts_names = timeseries.get_shared_names(gl_names, gl_numbers)
+        is_own = gl_numbers == numbers
+
+        self.add_rows_with_defaults(
+            pd.DataFrame({'CODE': gl_names,
+                          'NAME': np.char.add('OV ', hap_names),
+                          'MODE': mode}))
+        timeseries.add_rows_with_defaults(
+            pd.DataFrame({'NO': numbers[is_own],
+                          'NAME': ts_names[is_own]}))
+        demandtimeseries.add_rows_with_defaults(
+            pd.DataFrame({'NO': numbers,
+                          'CODE': gl_names,
+                          'NAME': gl_names,
+                          'TIMESERIESNO': gl_numbers}))
+
+        # in sekunden, Intervalle von 3600 sec.
+        #  haps without trips have no shares (NaN) and get no items
+        hap_pos, hour_pos = np.nonzero((np.nan_to_num(shares) != 0) &
+                                       is_own[:, np.newaxis])
+        starttimes = hours[hour_pos] * 3600
+        timeseriesitems.add_rows_with_defaults(
+            pd.DataFrame({'TIMESERIESNO': numbers[hap_pos],
+                          'STARTTIME': starttimes,
+                          'ENDTIME': starttimes + 3600,
+                          'WEIGHT': shares[hap_pos, hour_pos]}))
+
+        demand_description.add_rows_with_defaults(
+            pd.DataFrame({'DSEGCODE': gl_names,
+                          'DEMANDTIMESERIESNO': numbers,
+                          'MATRIXREF': [f'MATRIX([CODE]="Visem_OV_{name}")'
+                                        for name in hap_names]}))